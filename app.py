@@ -1,19 +1,35 @@
 import os
 import json
+import io
+import re
+import shutil
+import secrets
+import base64
+import atexit
+import mimetypes
+import hashlib
+import click
 import stripe
 import smtplib
 import ssl
+import threading
+import queue
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from datetime import datetime, date, time, timedelta
+from datetime import datetime, date, time, timedelta, timezone
 from calendar import monthrange
-from werkzeug.utils import secure_filename
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.utils import secure_filename, safe_join
+from flask import Flask, Response, render_template, request, redirect, url_for, session, flash, jsonify, send_file, stream_with_context, g, make_response, before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from werkzeug.security import generate_password_hash, check_password_hash
 from dotenv import load_dotenv
-from PIL import Image
+from PIL import Image, ImageFilter, ImageOps
+from jinja2 import FileSystemBytecodeCache
 import stripe
 
 # ------------------------
@@ -35,6 +51,11 @@ def get_database_url():
     import psycopg2
     import time
     
+    # An explicit SQLite URL (local development, tests) needs no probing
+    if DATABASE_URL.startswith("sqlite"):
+        print(f"✅ Using SQLite database: {DATABASE_URL}")
+        return DATABASE_URL
+    
     # Primary Neon URL (with pooler)
     primary_url = DATABASE_URL
     
@@ -126,6 +147,9 @@ SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
 SMTP_USERNAME = os.getenv("SMTP_USERNAME")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
 SMTP_USE_TLS = os.getenv("SMTP_USE_TLS", "true").lower() == "true"
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))  # seconds per SMTP command
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))  # concurrent authenticated sessions
+SMTP_RATE_LIMIT = float(os.getenv("SMTP_RATE_LIMIT", "10"))  # messages per second, 0 = unlimited
 MAIL_DEFAULT_SENDER = os.getenv("SENDER_EMAIL", "no-reply@tiffintrack.com")  # Changed from MAIL_DEFAULT_SENDER to SENDER_EMAIL
 
 
@@ -134,42 +158,203 @@ def is_email_configured() -> bool:
     return all([SMTP_HOST, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD, MAIL_DEFAULT_SENDER])
 
 
+class SMTPConnectionPool:
+    """
+    Thread-safe pool of authenticated SMTP sessions.
+    Sessions are reused across messages so bulk sends pay the TCP connect,
+    TLS handshake and login once per session instead of once per message.
+    """
+
+    def __init__(self, host, port, username=None, password=None, security="starttls",
+                 size=4, timeout=30, idle_timeout=60, max_messages=100):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.security = security  # "starttls", "ssl" or "plain"
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout  # servers drop idle sessions, so don't reuse old ones
+        self.max_messages = max_messages  # many providers cap messages per session
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _connect(self):
+        if self.security == "ssl":
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout,
+                                      context=ssl.create_default_context())
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            if self.security == "starttls":
+                server.starttls(context=ssl.create_default_context())
+        if self.username:
+            server.login(self.username, self.password)
+        return server
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+    def _checkout(self):
+        while True:
+            try:
+                server, last_used, sent = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect(), 0
+            if time_module.monotonic() - last_used < self.idle_timeout:
+                return server, sent
+            self._close(server)
+
+    def send(self, sender, recipients, message):
+        """Send one message on a pooled session, reconnecting once if the session went stale"""
+        with self._slots:
+            for attempt in range(2):
+                server, sent = self._checkout()
+                try:
+                    server.sendmail(sender, recipients, message)
+                except (smtplib.SMTPServerDisconnected, smtplib.SMTPSenderRefused, ConnectionError) as e:
+                    self._close(server)
+                    # A reused session may have been dropped by the server - retry on a fresh one
+                    if attempt == 0 and sent > 0 and not isinstance(e, smtplib.SMTPSenderRefused):
+                        continue
+                    raise
+                except Exception:
+                    self._close(server)
+                    raise
+
+                if sent + 1 >= self.max_messages:
+                    self._close(server)
+                else:
+                    self._idle.put((server, time_module.monotonic(), sent + 1))
+                return
+
+    def close_all(self):
+        while True:
+            try:
+                server, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(server)
+
+
+class RateLimiter:
+    """Token bucket limiting how many messages per second leave the pool"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self._tokens = self.capacity
+        self._updated = time_module.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time_module.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time_module.sleep(delay)
+
+
+_smtp_pool = None
+_smtp_pool_lock = threading.Lock()
+
+
+def get_smtp_pool():
+    """Return the shared SMTP pool built from the SMTP_* settings"""
+    global _smtp_pool
+    with _smtp_pool_lock:
+        if _smtp_pool is None:
+            _smtp_pool = SMTPConnectionPool(
+                SMTP_HOST,
+                SMTP_PORT,
+                username=SMTP_USERNAME,
+                password=SMTP_PASSWORD,
+                security="starttls" if SMTP_USE_TLS else "ssl",
+                size=SMTP_POOL_SIZE,
+                timeout=SMTP_TIMEOUT,
+            )
+        return _smtp_pool
+
+
+def build_email_message(to_email: str, subject: str, html_body: str, text_body: str | None = None) -> str:
+    """Build the multipart/alternative message string for an email."""
+    msg = MIMEMultipart("alternative")
+    msg["Subject"] = subject
+    msg["From"] = MAIL_DEFAULT_SENDER
+    msg["To"] = to_email
+
+    if not text_body:
+        text_body = html_body
+
+    # Explicit charset skips MIMEText's trial ASCII encode of every body
+    part_text = MIMEText(text_body, "plain", "utf-8")
+    part_html = MIMEText(html_body, "html", "utf-8")
+    msg.attach(part_text)
+    msg.attach(part_html)
+    return msg.as_string()
+
+
 def send_email(to_email: str, subject: str, html_body: str, text_body: str | None = None) -> tuple[bool, str | None]:
     """
-    Send an email using SMTP settings from environment variables.
+    Send a single email right away (used by docs/test_email.py; app emails go through the outbox).
     Returns (success, error_message).
     """
-    if not is_email_configured():
-        return False, "Email service is not configured. Please set SMTP_* environment variables."
-
-    try:
-        msg = MIMEMultipart("alternative")
-        msg["Subject"] = subject
-        msg["From"] = MAIL_DEFAULT_SENDER
-        msg["To"] = to_email
+    return send_emails_bulk([(to_email, subject, html_body, text_body)])[0]
 
-        if not text_body:
-            text_body = html_body
 
-        part_text = MIMEText(text_body, "plain")
-        part_html = MIMEText(html_body, "html")
-        msg.attach(part_text)
-        msg.attach(part_html)
+def send_emails_bulk(emails, pool=None, max_workers=None, rate_limit=SMTP_RATE_LIMIT):
+    """
+    Send many emails concurrently over pooled SMTP sessions.
+    `emails` is a list of (to_email, subject, html_body, text_body) tuples.
+    Returns a list of (success, error_message) in the same order.
+    """
+    if pool is None:
+        if not is_email_configured():
+            error = "Email service is not configured. Please set SMTP_* environment variables."
+            return [(False, error)] * len(emails)
+        pool = get_smtp_pool()
 
-        if SMTP_USE_TLS:
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-                server.starttls(context=ssl.create_default_context())
-                server.login(SMTP_USERNAME, SMTP_PASSWORD)
-                server.sendmail(MAIL_DEFAULT_SENDER, [to_email], msg.as_string())
-        else:
-            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=ssl.create_default_context()) as server:
-                server.login(SMTP_USERNAME, SMTP_PASSWORD)
-                server.sendmail(MAIL_DEFAULT_SENDER, [to_email], msg.as_string())
+    limiter = RateLimiter(rate_limit)
 
-        return True, None
-    except Exception as e:
-        print(f"❌ Error sending email: {e}")
-        return False, str(e)
+    def deliver(email):
+        to_email, subject, html_body, text_body = email
+        try:
+            message = build_email_message(to_email, subject, html_body, text_body)
+            limiter.wait()
+            pool.send(MAIL_DEFAULT_SENDER, [to_email], message)
+            return True, None
+        except Exception as e:
+            print(f"❌ Error sending email to {to_email}: {e}")
+            return False, str(e)
+
+    workers = max(1, min(max_workers or pool.size, pool.size, len(emails) or 1))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(deliver, emails))
+
+
+# Email templates live in templates/emails/<name>.html and <name>.txt; jinja_env caches the compiled
+# templates and honours TEMPLATES_AUTO_RELOAD
+def render_email(name, **context):
+    """Render the HTML and plain-text parts of an email template. Returns (html_body, text_body)."""
+    html_template = app.jinja_env.get_template(f"emails/{name}.html")
+    text_template = app.jinja_env.get_template(f"emails/{name}.txt")
+    started = time_module.perf_counter()
+    rendered = html_template.render(**context), text_template.render(**context)
+    record_metric("template.render_ms", (time_module.perf_counter() - started) * 1000, template=f"emails/{name}")
+    return rendered
 
 # File Upload Configuration
 UPLOAD_FOLDER = 'static/uploads/dishes'
@@ -187,7 +372,7 @@ migrate = Migrate(app, db)
 # Database retry decorator for handling connection drops
 from functools import wraps
 import time as time_module
-from sqlalchemy.exc import OperationalError, DisconnectionError
+from sqlalchemy.exc import OperationalError, DisconnectionError, IntegrityError
 
 def db_retry(max_retries=3, delay=1):
     """Decorator to retry database operations on connection failures"""
@@ -284,6 +469,45 @@ elif "postgresql" in working_db_url:
 else:
     print(f"🔗 Using SQLite database for development")
 
+# ------------------------
+# Template Rendering
+# ------------------------
+
+# Compiled templates are kept on disk, so restarts and new workers skip the Jinja compiler.
+# TEMPLATES_AUTO_RELOAD unset follows debug mode: only `app.run(debug=True)` re-checks template files.
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", os.path.join(app.instance_path, "jinja_cache"))
+PRECOMPILE_TEMPLATES = os.getenv("PRECOMPILE_TEMPLATES", "true").lower() == "true"
+if os.getenv("TEMPLATES_AUTO_RELOAD"):
+    app.config["TEMPLATES_AUTO_RELOAD"] = os.getenv("TEMPLATES_AUTO_RELOAD").lower() == "true"
+
+os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+app.jinja_options = {**app.jinja_options, "bytecode_cache": FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)}
+
+_template_render_starts = threading.local()  # template name -> perf_counter() at render start, per thread
+
+
+def precompile_templates():
+    """Compile every page and email template (loading bytecode when it is current). Returns the count."""
+    names = app.jinja_env.list_templates(extensions=("html", "txt"))
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    if not hasattr(_template_render_starts, "starts"):
+        _template_render_starts.starts = {}
+    _template_render_starts.starts[template.name] = time_module.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def record_template_render_time(sender, template, context, **extra):
+    started = getattr(_template_render_starts, "starts", {}).pop(template.name, None)
+    if started is not None:
+        record_metric("template.render_ms", (time_module.perf_counter() - started) * 1000, template=template.name)
+
+
 # Template filters
 @app.template_filter('strptime')
 def strptime_filter(date_string, format='%Y-%m-%d'):
@@ -305,15 +529,278 @@ def from_json_filter(json_string):
     except:
         return []
 
+# ------------------------
+# Static Assets
+# ------------------------
+
+# `flask build-assets` writes content-hashed copies of static files (plus .gz/.br variants) to
+# static/dist/ with a manifest. url_for('static') then points at the hashed names, which are
+# served with far-future immutable caching. Without a build, files are served as before.
+STATIC_BUILD_DIR = "dist"
+STATIC_FINGERPRINTS = os.getenv("STATIC_FINGERPRINTS", "true").lower() == "true"
+STATIC_SKIP_DIRS = {"uploads", STATIC_BUILD_DIR}  # Uploads change at runtime, not at deploy
+STATIC_COMPRESSIBLE = {".css", ".js", ".svg", ".json", ".webmanifest", ".txt", ".xml", ".ico"}
+STATIC_REWRITE_REFERENCES = {".css", ".webmanifest", ".json"}  # Text assets that link other assets by URL
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+
+
+def asset_manifest_path():
+    return os.path.join(app.static_folder, STATIC_BUILD_DIR, "manifest.json")
+
+
+def load_asset_manifest():
+    """{source path: fingerprinted path} from the last build, or {} when fingerprints are off or unbuilt"""
+    if not STATIC_FINGERPRINTS:
+        return {}
+    try:
+        with open(asset_manifest_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+_asset_manifest = load_asset_manifest()
+
+
+def build_static_assets(clean=False):
+    """
+    Fingerprint every static file into static/dist/ and write gzip and brotli variants of text assets.
+    References to /static/... inside CSS and manifests are rewritten to the hashed names.
+    Returns (manifest, number of compressed variants written).
+    """
+    import gzip
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+        print("ℹ️ Install Brotli to also write .br variants")
+    
+    build_root = os.path.join(app.static_folder, STATIC_BUILD_DIR)
+    sources = []
+    for root, dirs, files in os.walk(app.static_folder):
+        if root == app.static_folder:
+            dirs[:] = [d for d in dirs if d not in STATIC_SKIP_DIRS]
+        for filename in files:
+            sources.append(os.path.relpath(os.path.join(root, filename), app.static_folder).replace(os.sep, "/"))
+    
+    # Assets that reference others are hashed last, after their references are rewritten
+    sources.sort(key=lambda path: (os.path.splitext(path)[1] in STATIC_REWRITE_REFERENCES, path))
+    manifest = {}
+    compressed = 0
+    
+    for source in sources:
+        with open(os.path.join(app.static_folder, source), "rb") as f:
+            data = f.read()
+        
+        extension = os.path.splitext(source)[1].lower()
+        if extension in STATIC_REWRITE_REFERENCES:
+            data = re.sub(
+                rb"/static/([\w./-]+)",
+                lambda match: b"/static/" + manifest.get(match.group(1).decode(), match.group(1).decode()).encode(),
+                data
+            )
+        
+        stem, _ = os.path.splitext(source)
+        fingerprinted = f"{STATIC_BUILD_DIR}/{stem}.{hashlib.sha256(data).hexdigest()[:12]}{extension}"
+        target = os.path.join(app.static_folder, fingerprinted)
+        manifest[source] = fingerprinted
+        if os.path.exists(target):
+            continue  # Same content as an earlier build
+        
+        variants = [("", data)]
+        if extension in STATIC_COMPRESSIBLE:
+            variants.append((".gz", gzip.compress(data, compresslevel=9, mtime=0)))
+            if brotli is not None:
+                variants.append((".br", brotli.compress(data, quality=11)))
+        
+        for suffix, content in variants:
+            if suffix and len(content) >= len(data) * 0.9:
+                continue  # Not worth a Content-Encoding round trip
+            write_snapshot_file(target + suffix, content)
+            compressed += bool(suffix)
+    
+    write_snapshot_file(asset_manifest_path(), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    
+    if clean:
+        # Drop outputs of older builds (keep them for a while if old pages may still be cached)
+        current = {os.path.join(app.static_folder, path) for path in manifest.values()}
+        for root, _, files in os.walk(build_root):
+            for filename in files:
+                path = os.path.join(root, filename)
+                if path != asset_manifest_path() and path.removesuffix(".gz").removesuffix(".br") not in current:
+                    os.remove(path)
+    
+    return manifest, compressed
+
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == "static" and _asset_manifest:
+        values["filename"] = _asset_manifest.get(values.get("filename"), values.get("filename"))
+
+
+def serve_static(filename):
+    """Fingerprinted builds and content-addressed uploads are immutable; builds are also served precompressed"""
+    if filename.startswith(f"{STATIC_BUILD_DIR}/") and not filename.endswith((".gz", ".br")):
+        path = safe_join(app.static_folder, filename)
+        if path and os.path.isfile(path):
+            mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            for encoding, suffix in (("br", ".br"), ("gzip", ".gz")):
+                if request.accept_encodings[encoding] and os.path.isfile(path + suffix):
+                    response = send_file(path + suffix, mimetype=mimetype, max_age=STATIC_IMMUTABLE_MAX_AGE)
+                    response.content_encoding = encoding
+                    break
+            else:
+                response = send_file(path, mimetype=mimetype, max_age=STATIC_IMMUTABLE_MAX_AGE)
+            response.vary.add("Accept-Encoding")
+            response.cache_control.public = True
+            response.cache_control.immutable = True
+            return response
+    
+    response = app.send_static_file(filename)
+    if filename.startswith("uploads/") and CONTENT_ADDRESSED_IMAGE.match(os.path.basename(filename)):
+        # Plan images are named by their content hash, so a URL never changes what it serves
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = STATIC_IMMUTABLE_MAX_AGE
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
+
+app.view_functions["static"] = serve_static
+
+
 # Helper functions
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def resize_image(image_path, max_size=(800, 600)):
-    """Resize image to max dimensions while maintaining aspect ratio"""
-    with Image.open(image_path) as img:
-        img.thumbnail(max_size, Image.Resampling.LANCZOS)
-        img.save(image_path, optimize=True, quality=85)
+def month_sequence(end_date, count):
+    """Return the last `count` (year, month) pairs up to and including end_date's month, oldest first"""
+    months = []
+    year, month = end_date.year, end_date.month
+    for _ in range(count):
+        months.append((year, month))
+        month -= 1
+        if month == 0:
+            year, month = year - 1, 12
+    months.reverse()
+    return months
+
+
+def month_index(value):
+    """Months since year 0 for a date, so consecutive months differ by one"""
+    return value.year * 12 + value.month - 1
+
+
+def sql_month_index(column):
+    """month_index() of a date column, computed by the database"""
+    return db.cast(db.extract('year', column), db.Integer) * 12 + db.cast(db.extract('month', column), db.Integer) - 1
+
+# ------------------------
+# Report Cache
+# ------------------------
+
+REPORT_CACHE_TTL = int(os.getenv("REPORT_CACHE_TTL", "300"))  # seconds a result counts as fresh
+REPORT_CACHE_STALE_TTL = int(os.getenv("REPORT_CACHE_STALE_TTL", "3600"))  # seconds a stale result may still be served
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv("REPORT_CACHE_MAX_ENTRIES", "5000"))  # oldest results are dropped beyond this
+REPORT_CACHE_SWEEP_INTERVAL = 60  # seconds between sweeps for entries past their stale window
+
+_report_cache = {}  # key -> (computed_at, expires_at, value), oldest stored first
+_report_refreshing = {}  # key -> threading.Event set once the in-flight computation finishes
+_report_invalidated = set()  # in-flight keys invalidated since they started; their results are dropped
+_report_cache_lock = threading.Lock()
+_report_cache_swept_at = 0.0
+
+
+def _sweep_report_cache(now):
+    """Drop entries past their stale window, then the oldest ones over the size limit. Call with the lock held."""
+    global _report_cache_swept_at
+    if now - _report_cache_swept_at >= REPORT_CACHE_SWEEP_INTERVAL:
+        _report_cache_swept_at = now
+        for key in [k for k, entry in _report_cache.items() if entry[1] <= now]:
+            del _report_cache[key]
+    while len(_report_cache) > REPORT_CACHE_MAX_ENTRIES:
+        del _report_cache[next(iter(_report_cache))]
+
+
+def _store_report(key, started_at, max_age, value):
+    with _report_cache_lock:
+        if key in _report_invalidated:
+            return
+        _report_cache.pop(key, None)
+        _report_cache[key] = (started_at, started_at + max_age, value)
+        _sweep_report_cache(time_module.monotonic())
+
+
+def _finish_report_refresh(key):
+    with _report_cache_lock:
+        _report_refreshing.pop(key).set()
+        _report_invalidated.discard(key)
+
+
+def _refresh_report_in_background(key, compute, started_at, max_age):
+    """Recompute a stale report outside the request so the caller can return the stale value"""
+    def run():
+        try:
+            with app.app_context():
+                _store_report(key, started_at, max_age, compute())
+        except Exception as e:
+            print(f"⚠️ Background refresh of report '{key}' failed: {e}")
+        finally:
+            _finish_report_refresh(key)
+
+    threading.Thread(target=run, name=f"report-refresh-{key}", daemon=True).start()
+
+
+def cached_report(key, compute, ttl=REPORT_CACHE_TTL, stale_ttl=REPORT_CACHE_STALE_TTL, force=False):
+    """
+    Return the cached result for `key` using stale-while-revalidate:
+    - younger than `ttl`: served from cache
+    - younger than `ttl + stale_ttl`: served stale while one background thread recomputes it
+    - missing, too old or `force`: computed now
+    Only one computation per key runs at a time; concurrent callers wait for it and share its result.
+    """
+    while True:
+        now = time_module.monotonic()
+        with _report_cache_lock:
+            entry = _report_cache.get(key)
+            if entry and not force:
+                age = now - entry[0]
+                if age < ttl:
+                    return entry[2]
+                if age < ttl + stale_ttl:
+                    if key not in _report_refreshing:
+                        _report_refreshing[key] = threading.Event()
+                        _refresh_report_in_background(key, compute, now, ttl + stale_ttl)
+                    return entry[2]
+
+            pending = _report_refreshing.get(key)
+            if pending is None:
+                _report_refreshing[key] = threading.Event()
+                break
+
+        # Someone else is computing this report; use their result once it lands
+        pending.wait()
+        force = False
+
+    try:
+        value = compute()
+        _store_report(key, now, ttl + stale_ttl, value)
+        return value
+    finally:
+        _finish_report_refresh(key)
+
+
+def invalidate_report_cache(prefix=None):
+    """Drop cached reports whose key starts with `prefix` (or everything if no prefix is given)"""
+    with _report_cache_lock:
+        _report_invalidated.update(k for k in _report_refreshing if prefix is None or k.startswith(prefix))
+        if prefix is None:
+            _report_cache.clear()
+            return
+        for key in [k for k in _report_cache if k.startswith(prefix)]:
+            del _report_cache[key]
 
 # ------------------------
 # Models
@@ -334,6 +821,7 @@ class User(db.Model):
     state = db.Column(db.String(100), nullable=False, default="Maharashtra")
     pincode = db.Column(db.String(10), nullable=False)
     is_admin = db.Column(db.Boolean, default=False)
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default="0")  # Bumped with every write to the customer's data
     created_at = db.Column(db.DateTime, server_default=db.func.now())
 
 
@@ -346,6 +834,8 @@ class Plan(db.Model):
     description = db.Column(db.Text)  # Changed from String(255) to Text for longer descriptions
     items = db.Column(db.Text)  # JSON string of menu items
     image_filename = db.Column(db.String(255))  # Image file name
+    image_status = db.Column(db.String(20))  # Derivative build: pending, ready or failed
+    image_variants = db.Column(db.Text)  # JSON: derivative widths, original size and placeholder
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, server_default=db.func.now())
 
@@ -373,62 +863,1720 @@ class PausedDate(db.Model):
 
 class Bill(db.Model):
     __tablename__ = "bills"
+    __table_args__ = (
+        db.Index("ix_bills_year_month", "year", "month"),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
     month = db.Column(db.Integer, nullable=False)  # 1-12
     year = db.Column(db.Integer, nullable=False)
     total_days = db.Column(db.Integer, nullable=False)
     paused_days = db.Column(db.Integer, nullable=False)
     billable_days = db.Column(db.Integer, nullable=False)
     amount = db.Column(db.Integer, nullable=False)
-    is_paid = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    is_paid = db.Column(db.Boolean, default=False, index=True)
+    created_at = db.Column(db.DateTime, server_default=db.func.now(), index=True)
 
 
 class Menu(db.Model):
     __tablename__ = "menus"
 
-    id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.Date, nullable=False)
-    plan_id = db.Column(db.Integer, db.ForeignKey("plans.id"), nullable=False)
-    items = db.Column(db.Text, nullable=False)  # JSON string
-    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    id = db.Column(db.Integer, primary_key=True)
+    date = db.Column(db.Date, nullable=False)
+    plan_id = db.Column(db.Integer, db.ForeignKey("plans.id"), nullable=False)
+    items = db.Column(db.Text, nullable=False)  # JSON string
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+
+class Payment(db.Model):
+    __tablename__ = "payments"
+
+    id = db.Column(db.Integer, primary_key=True)
+    bill_id = db.Column(db.Integer, db.ForeignKey("bills.id"), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    stripe_payment_intent_id = db.Column(db.String(255), unique=True, nullable=False)
+    amount = db.Column(db.Integer, nullable=False)  # Amount in paise (₹1 = 100 paise)
+    currency = db.Column(db.String(3), default="inr", nullable=False)
+    status = db.Column(db.String(50), nullable=False)  # succeeded, pending, failed
+    payment_method = db.Column(db.String(50))  # card, upi, netbanking, etc.
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+
+class PaymentLog(db.Model):
+    __tablename__ = "payment_logs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    payment_id = db.Column(db.Integer, db.ForeignKey("payments.id"), nullable=False)
+    bill_id = db.Column(db.Integer, db.ForeignKey("bills.id"), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    payment_method = db.Column(db.String(50))
+    stripe_payment_intent_id = db.Column(db.String(255), unique=True, nullable=False)
+    billing_period = db.Column(db.String(20))  # "MM/YYYY" format
+    status = db.Column(db.String(50), default="completed")
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    
+    # Relationships for easy access
+    payment = db.relationship("Payment", backref="logs")
+    bill = db.relationship("Bill", backref="payment_logs")
+    customer = db.relationship("User", backref="payment_logs")
+
+
+class MonthlyRollup(db.Model):
+    __tablename__ = "monthly_rollups"
+    __table_args__ = (
+        db.UniqueConstraint("year", "month", "area", "plan_id", name="uq_monthly_rollups_key"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, nullable=False)
+    month = db.Column(db.Integer, nullable=False)  # 1-12
+    area = db.Column(db.String(100), nullable=False, default="")
+    plan_id = db.Column(db.Integer, nullable=False, default=0)  # 0 = metric not tied to a plan
+    revenue = db.Column(db.BigInteger, nullable=False, default=0)  # Paid bill amounts in ₹
+    payments = db.Column(db.Integer, nullable=False, default=0)  # Bills paid
+    bills_issued = db.Column(db.Integer, nullable=False, default=0)
+    new_customers = db.Column(db.Integer, nullable=False, default=0)
+    active_plans = db.Column(db.Integer, nullable=False, default=0)  # Customer plans running in the month
+    plan_days = db.Column(db.Integer, nullable=False, default=0)  # Scheduled meal days
+    pause_days = db.Column(db.Integer, nullable=False, default=0)
+    version = db.Column(db.Integer, nullable=False, default=1)  # Bumped on every change; the table's sum is its version
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+
+class DailyFact(db.Model):
+    __tablename__ = "daily_facts"
+
+    id = db.Column(db.Integer, primary_key=True)
+    fact_date = db.Column(db.Date, nullable=False, unique=True)
+    scheduled_meals = db.Column(db.Integer, nullable=False, default=0)  # Customer plan days falling on the date
+    paused_meals = db.Column(db.Integer, nullable=False, default=0)
+    late_paused_meals = db.Column(db.Integer, nullable=False, default=0)  # Paused on the day itself, after prep planning
+    delivered_meals = db.Column(db.Integer, nullable=False, default=0)
+    revenue_accrued = db.Column(db.BigInteger, nullable=False, default=0)  # Daily rates of delivered meals in ₹
+    active_customers = db.Column(db.Integer, nullable=False, default=0)  # Customers with at least one running plan
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+
+class CohortRetention(db.Model):
+    __tablename__ = "cohort_retention"
+    __table_args__ = (
+        db.UniqueConstraint("basis", "cohort_year", "cohort_month", "months_since", name="uq_cohort_retention_cell"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    basis = db.Column(db.String(20), nullable=False)  # 'first_plan' or 'signup'
+    cohort_year = db.Column(db.Integer, nullable=False)
+    cohort_month = db.Column(db.Integer, nullable=False)  # 1-12
+    months_since = db.Column(db.Integer, nullable=False)  # 0 = the cohort month itself
+    cohort_size = db.Column(db.Integer, nullable=False, default=0)
+    active_customers = db.Column(db.Integer, nullable=False, default=0)  # Cohort members with a plan running that month
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+
+class AppCounter(db.Model):
+    __tablename__ = "app_counters"
+
+    name = db.Column(db.String(50), primary_key=True)  # e.g. 'cohort_retention_stale_from'
+    value = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+
+class Metric(db.Model):
+    __tablename__ = "metrics"
+    __table_args__ = (
+        db.Index("ix_metrics_name_bucket", "name", "bucket_start"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)  # e.g. 'payment.amount', 'request.duration_ms'
+    tags = db.Column(db.String(255), nullable=False, default="")  # Sorted 'key=value' pairs joined by ','
+    resolution = db.Column(db.Integer, nullable=False, default=60)  # Bucket width in seconds
+    bucket_start = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Float, nullable=False, default=0)
+    min_value = db.Column(db.Float, nullable=False)
+    max_value = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+
+class EmailOutbox(db.Model):
+    __tablename__ = "email_outbox"
+    __table_args__ = (
+        db.Index("ix_email_outbox_status_next_attempt", "status", "next_attempt_at"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # bill_reminder, plan_receipt, test
+    to_email = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    html_body = db.Column(db.Text, nullable=False)
+    text_body = db.Column(db.Text)
+    customer_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    bill_id = db.Column(db.Integer, db.ForeignKey("bills.id"))
+    dedupe_key = db.Column(db.String(255), unique=True)  # e.g. "bill_reminder:<bill_id>:<YYYY-MM-DD>"
+    status = db.Column(db.String(20), nullable=False, default="pending")  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    sent_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+
+# ------------------------
+# Email Outbox
+# ------------------------
+
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "5"))
+EMAIL_RETRY_BASE_DELAY = int(os.getenv("EMAIL_RETRY_BASE_DELAY", "60"))  # seconds, doubled on every retry
+EMAIL_RETRY_MAX_DELAY = int(os.getenv("EMAIL_RETRY_MAX_DELAY", "3600"))
+EMAIL_OUTBOX_BATCH_SIZE = int(os.getenv("EMAIL_OUTBOX_BATCH_SIZE", "50"))
+EMAIL_OUTBOX_LOCK_TIMEOUT = int(os.getenv("EMAIL_OUTBOX_LOCK_TIMEOUT", "600"))  # reclaim rows from crashed workers
+EMAIL_WORKER_POLL_INTERVAL = float(os.getenv("EMAIL_WORKER_POLL_INTERVAL", "5"))
+# "inline" runs the worker as a thread inside the web process, "external" expects `flask email-worker`
+EMAIL_WORKER_MODE = os.getenv("EMAIL_WORKER_MODE", "inline")
+
+_outbox_wakeup = threading.Event()
+_email_worker_thread = None
+_email_worker_lock = threading.Lock()
+
+
+def enqueue_email(to_email, subject, html_body, text_body=None, kind="generic",
+                  customer_id=None, bill_id=None, dedupe_key=None):
+    """
+    Add an email to the outbox as part of the current transaction.
+    The caller commits and then calls notify_email_worker().
+    """
+    entry = EmailOutbox(
+        kind=kind,
+        to_email=to_email,
+        subject=subject,
+        html_body=html_body,
+        text_body=text_body,
+        customer_id=customer_id,
+        bill_id=bill_id,
+        dedupe_key=dedupe_key,
+        status="pending",
+        attempts=0,
+        next_attempt_at=datetime.now()
+    )
+    db.session.add(entry)
+    return entry
+
+
+def notify_email_worker():
+    """Wake the delivery worker, starting the in-process thread if it isn't running yet"""
+    global _email_worker_thread
+    if EMAIL_WORKER_MODE == "inline":
+        with _email_worker_lock:
+            if _email_worker_thread is None or not _email_worker_thread.is_alive():
+                _email_worker_thread = threading.Thread(
+                    target=run_email_worker, name="email-outbox-worker", daemon=True
+                )
+                _email_worker_thread.start()
+    _outbox_wakeup.set()
+
+
+def email_retry_delay(attempts):
+    """Exponential backoff before the next delivery attempt"""
+    return min(EMAIL_RETRY_BASE_DELAY * (2 ** max(attempts - 1, 0)), EMAIL_RETRY_MAX_DELAY)
+
+
+def claim_outbox_batch(batch_size=EMAIL_OUTBOX_BATCH_SIZE):
+    """Mark a batch of due emails as sending and return (id, to, subject, html, text, attempts) tuples"""
+    now = datetime.now()
+    
+    # Requeue rows left in "sending" by a worker that died mid-batch
+    EmailOutbox.query.filter(
+        EmailOutbox.status == "sending",
+        EmailOutbox.locked_at < now - timedelta(seconds=EMAIL_OUTBOX_LOCK_TIMEOUT)
+    ).update({"status": "pending", "locked_at": None}, synchronize_session=False)
+    
+    rows = EmailOutbox.query.filter(
+        EmailOutbox.status == "pending",
+        EmailOutbox.next_attempt_at <= now
+    ).order_by(EmailOutbox.next_attempt_at, EmailOutbox.id).limit(batch_size).with_for_update(skip_locked=True).all()
+    
+    batch = []
+    for row in rows:
+        # Conditional update so two workers never claim the same row (SQLite has no SKIP LOCKED)
+        claimed = EmailOutbox.query.filter(
+            EmailOutbox.id == row.id,
+            EmailOutbox.status == "pending"
+        ).update({"status": "sending", "locked_at": now}, synchronize_session=False)
+        if claimed:
+            batch.append((row.id, row.to_email, row.subject, row.html_body, row.text_body, row.attempts))
+    db.session.commit()
+    return batch
+
+
+def deliver_pending_emails(batch_size=EMAIL_OUTBOX_BATCH_SIZE):
+    """Deliver one batch from the outbox and record the outcome. Returns the number of emails attempted."""
+    if not is_email_configured():
+        return 0
+    
+    batch = claim_outbox_batch(batch_size)
+    if not batch:
+        return 0
+    
+    results = send_emails_bulk([(to, subject, html, text) for _, to, subject, html, text, _ in batch])
+    now = datetime.now()
+    
+    for (outbox_id, to_email, _, _, _, attempts), (success, error) in zip(batch, results):
+        entry = db.session.get(EmailOutbox, outbox_id)
+        if entry is None:
+            continue
+        entry.attempts = attempts + 1
+        entry.locked_at = None
+        if success:
+            entry.status = "sent"
+            entry.sent_at = now
+            entry.last_error = None
+        elif entry.attempts >= EMAIL_MAX_ATTEMPTS:
+            entry.status = "failed"
+            entry.last_error = error
+            print(f"❌ Giving up on email {outbox_id} to {to_email} after {entry.attempts} attempts: {error}")
+        else:
+            entry.status = "pending"
+            entry.last_error = error
+            entry.next_attempt_at = now + timedelta(seconds=email_retry_delay(entry.attempts))
+    
+    db.session.commit()
+    return len(batch)
+
+
+def run_email_worker(poll_interval=EMAIL_WORKER_POLL_INTERVAL, once=False):
+    """Deliver outbox emails until stopped (or until nothing is due, with `once`), sleeping between empty polls"""
+    while True:
+        with app.app_context():
+            try:
+                delivered = deliver_pending_emails()
+            except Exception as e:
+                print(f"⚠️ Email worker error: {e}")
+                db.session.rollback()
+                delivered = 0
+        
+        if not delivered:
+            if once:
+                return
+            _outbox_wakeup.wait(poll_interval)
+            _outbox_wakeup.clear()
+
+
+# ------------------------
+# Plan Image Store
+# ------------------------
+
+# Uploads are named by the SHA-256 of their content, so re-uploading a dish reuses the stored file
+# (and its derivatives) and URLs never change content, which allows immutable caching. Plans
+# referencing a file are its reference count: a file is deleted when the last plan lets go of it
+# (unless it was stored within IMAGE_GC_MIN_AGE), and `flask gc-images` sweeps anything else no
+# plan points at.
+IMAGE_GC_MIN_AGE = int(os.getenv("IMAGE_GC_MIN_AGE", "3600"))  # seconds; spares uploads whose plan isn't saved yet
+IMAGE_STORE_CHUNK_SIZE = 64 * 1024
+CONTENT_ADDRESSED_IMAGE = re.compile(r"^[0-9a-f]{64}(-\d+w\.[0-9a-f]+)?\.[a-z]+$")  # Originals and derivatives
+IMAGE_UPLOAD_FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif"}  # Detected format -> stored extension
+# Decompression-bomb guard: uploads with more pixels than this are refused (Pillow itself only
+# raises past twice its limit and warns below that, so the header size is checked explicitly)
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", "50000000"))
+Image.MAX_IMAGE_PIXELS = IMAGE_MAX_PIXELS
+# Resumable uploads: the admin form sends images in chunks of this size before submitting
+IMAGE_UPLOAD_CHUNK_SIZE = int(os.getenv("IMAGE_UPLOAD_CHUNK_SIZE", str(1024 * 1024)))
+IMAGE_UPLOAD_MAX_BYTES = app.config['MAX_CONTENT_LENGTH']
+UPLOAD_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def store_image_file(path):
+    """
+    Move a fully received upload into the store under its content hash and return the filename.
+    Only the header is decoded to check the format and pixel count; raises ValueError for
+    anything that isn't a PNG, JPEG or GIF within IMAGE_MAX_PIXELS (the file is then deleted).
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    try:
+        try:
+            with Image.open(path) as probe:
+                image_format = probe.format
+                too_large = probe.width * probe.height > IMAGE_MAX_PIXELS
+        except Image.DecompressionBombError:
+            too_large = True
+        except OSError:
+            raise ValueError("Uploaded file is not a readable image")
+        if too_large:
+            raise ValueError(f"Image is too large, the limit is {IMAGE_MAX_PIXELS / 1_000_000:.0f} megapixels")
+        if image_format not in IMAGE_UPLOAD_FORMATS:
+            raise ValueError("Only PNG, JPG and GIF images are supported")
+        
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(IMAGE_STORE_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        
+        image_filename = f"{digest.hexdigest()}.{IMAGE_UPLOAD_FORMATS[image_format]}"
+        try:
+            # Duplicate of a stored image: touch it so a concurrent release leaves it alone
+            # until the plan that will reference it has been saved
+            os.utime(os.path.join(folder, image_filename))
+            os.remove(path)
+        except FileNotFoundError:
+            os.replace(path, os.path.join(folder, image_filename))
+    except BaseException:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return image_filename
+
+
+def store_plan_image(file):
+    """Stream an uploaded file to disk in small chunks and store it (see store_image_file)"""
+    temporary_path = os.path.join(app.config['UPLOAD_FOLDER'], f".upload-{secrets.token_hex(16)}.tmp")
+    try:
+        with open(temporary_path, "xb") as temporary:
+            shutil.copyfileobj(file.stream, temporary, IMAGE_STORE_CHUNK_SIZE)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return store_image_file(temporary_path)
+
+
+def chunked_upload_paths(upload_id):
+    """(data, metadata) paths of a resumable upload; the bytes received so far are the data file's size"""
+    folder = app.config['UPLOAD_FOLDER']
+    return os.path.join(folder, f".upload-{upload_id}.part"), os.path.join(folder, f".upload-{upload_id}.json")
+
+
+def chunked_upload_status(upload_id):
+    """{"upload_id", "size", "received", "chunk_size"} for an upload in progress, or None"""
+    if not UPLOAD_ID_PATTERN.match(upload_id):
+        return None
+    data_path, meta_path = chunked_upload_paths(upload_id)
+    try:
+        with open(meta_path) as f:
+            size = json.load(f)["size"]
+        received = os.path.getsize(data_path)
+    except (OSError, ValueError, KeyError):
+        return None
+    return {"upload_id": upload_id, "size": size, "received": received, "chunk_size": IMAGE_UPLOAD_CHUNK_SIZE}
+
+
+def start_chunked_upload(filename, size):
+    """Open a resumable upload and return its status; raises ValueError for unsupported files"""
+    if not allowed_file(filename):
+        raise ValueError("Only PNG, JPG and GIF images are supported")
+    if not 0 < size <= IMAGE_UPLOAD_MAX_BYTES:
+        raise ValueError(f"Images must be under {IMAGE_UPLOAD_MAX_BYTES // (1024 * 1024)}MB")
+    
+    upload_id = secrets.token_hex(16)
+    data_path, meta_path = chunked_upload_paths(upload_id)
+    open(data_path, "wb").close()
+    write_snapshot_file(meta_path, json.dumps({"filename": filename, "size": size}).encode())
+    return chunked_upload_status(upload_id)
+
+
+def append_upload_chunk(upload_id, offset, stream):
+    """
+    Append a chunk read from `stream` if it starts where the upload left off.
+    Returns (status, appended): not appended when the offset doesn't match, so the client can
+    resume from status["received"]. Raises ValueError if the chunk runs past the declared size.
+    """
+    status = chunked_upload_status(upload_id)
+    if status is None or offset != status["received"]:
+        return status, False
+    
+    data_path, _ = chunked_upload_paths(upload_id)
+    allowed = min(IMAGE_UPLOAD_CHUNK_SIZE, status["size"] - offset)
+    written = 0
+    with open(data_path, "r+b") as f:
+        f.seek(offset)
+        for chunk in iter(lambda: stream.read(IMAGE_STORE_CHUNK_SIZE), b""):
+            written += len(chunk)
+            if written > allowed:
+                f.truncate(offset)  # Drop the partial chunk; the client resumes from `offset`
+                raise ValueError("Chunk runs past the end of the upload")
+            f.write(chunk)
+    
+    status["received"] = offset + written
+    return status, True
+
+
+def finish_chunked_upload(upload_id):
+    """Store a completely received chunked upload and return the image filename"""
+    status = chunked_upload_status(upload_id)
+    if status is None or status["received"] != status["size"]:
+        raise ValueError("The image upload did not finish, please choose the image again")
+    data_path, meta_path = chunked_upload_paths(upload_id)
+    os.remove(meta_path)
+    return store_image_file(data_path)
+
+
+def store_image_from_request():
+    """Store the image sent with a plan form (a finished chunked upload or a file field); None if there is none"""
+    upload_id = request.form.get("image_upload_id", "").strip()
+    if upload_id:
+        return finish_chunked_upload(upload_id)
+    file = request.files.get('image')
+    if file and file.filename != '' and allowed_file(file.filename):
+        return store_plan_image(file)
+    return None
+
+
+def stored_image_state(image_filename):
+    """(image_status, image_variants) to give a plan using this file: copied from a plan that already has it"""
+    existing = db.session.execute(
+        db.select(Plan.image_status, Plan.image_variants)
+        .where(Plan.image_filename == image_filename, Plan.image_status.in_(["ready", "failed"]))
+        .limit(1)
+    ).first()
+    return tuple(existing) if existing else ("pending", None)
+
+
+def release_plan_image(image_filename, image_variants=None):
+    """
+    Delete a stored image and its derivatives once no plan references it (call after committing).
+    Files stored or re-uploaded within IMAGE_GC_MIN_AGE are kept, as a plan being saved may be
+    about to reference them; `flask gc-images` removes them later if none does.
+    """
+    if not image_filename:
+        return False
+    if db.session.execute(db.select(db.func.count(Plan.id)).where(Plan.image_filename == image_filename)).scalar():
+        return False
+    try:
+        if os.path.getmtime(os.path.join(app.config['UPLOAD_FOLDER'], image_filename)) > time_module.time() - IMAGE_GC_MIN_AGE:
+            return False
+    except FileNotFoundError:
+        pass
+    remove_plan_image_files(image_filename, image_variants)
+    return True
+
+
+def live_image_files():
+    """Paths (relative to the upload folder) of every original and derivative a plan references"""
+    live = set()
+    rows = db.session.execute(
+        db.select(Plan.image_filename, Plan.image_variants).where(Plan.image_filename.isnot(None))
+    ).all()
+    for image_filename, image_variants in rows:
+        live.update(plan_image_paths(image_filename, image_variants))
+    return live
+
+
+def collect_image_garbage(min_age=IMAGE_GC_MIN_AGE, dry_run=False):
+    """
+    Delete uploads, derivatives and abandoned temporary files that no plan references and that are
+    older than `min_age` seconds. Returns a list of (relative path, size in bytes).
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    live = live_image_files()
+    cutoff = time_module.time() - min_age
+    removed = []
+    
+    for root, _, files in os.walk(folder):
+        for filename in files:
+            path = os.path.join(root, filename)
+            relative = os.path.relpath(path, folder).replace(os.sep, "/")
+            stat = os.stat(path)
+            if relative in live or stat.st_mtime > cutoff:
+                continue
+            if not dry_run:
+                os.remove(path)
+            removed.append((relative, stat.st_size))
+    return removed
+
+
+def rehash_plan_images():
+    """
+    Move plan images saved under upload names to content-addressed names, merging duplicates.
+    Old files are left for collect_image_garbage. Returns {old filename: new filename}.
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    names = db.session.execute(
+        db.select(Plan.image_filename).where(Plan.image_filename.isnot(None)).distinct()
+    ).scalars().all()
+    
+    renamed = {}
+    for old_name in names:
+        if CONTENT_ADDRESSED_IMAGE.match(old_name):
+            continue
+        digest = hashlib.sha256()
+        try:
+            with open(os.path.join(folder, old_name), "rb") as f:
+                for chunk in iter(lambda: f.read(IMAGE_STORE_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+        except FileNotFoundError:
+            print(f"⚠️ Plan image {old_name} is missing, leaving it as is")
+            continue
+        
+        extension = old_name.rsplit('.', 1)[-1].lower().replace("jpeg", "jpg")
+        new_name = f"{digest.hexdigest()}.{extension}"
+        target = os.path.join(folder, new_name)
+        if not os.path.exists(target):
+            shutil.copy2(os.path.join(folder, old_name), target)
+        
+        # Derivatives are rebuilt under the new name by the image worker
+        Plan.query.filter_by(image_filename=old_name).update(
+            {"image_filename": new_name, "image_status": "pending", "image_variants": None},
+            synchronize_session=False
+        )
+        renamed[old_name] = new_name
+    
+    db.session.commit()
+    return renamed
+
+
+# ------------------------
+# Plan Image Derivatives
+# ------------------------
+
+# Uploads are stored as-is and queued (Plan.image_status = "pending"); a background worker writes
+# WebP and JPEG copies at several widths plus a tiny blurred placeholder, so pages can serve
+# srcsets instead of one large JPEG and the admin request never waits on resampling.
+IMAGE_DERIVATIVE_WIDTHS = sorted(int(width) for width in os.getenv("IMAGE_DERIVATIVE_WIDTHS", "320,640,960,1280").split(","))
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "82"))
+IMAGE_PLACEHOLDER_WIDTH = 16
+IMAGE_DERIVATIVE_DIR = "derived"  # Inside the upload folder
+# Encoder settings are part of derivative names, so a rebuild never changes the content behind a URL
+IMAGE_DERIVATIVE_VERSION = hashlib.sha256(f"{IMAGE_WEBP_QUALITY}:{IMAGE_JPEG_QUALITY}".encode()).hexdigest()[:8]
+IMAGE_WORKER_POLL_INTERVAL = float(os.getenv("IMAGE_WORKER_POLL_INTERVAL", "30"))
+# "inline" runs the worker as a thread inside the web process, "external" expects `flask image-worker`
+IMAGE_WORKER_MODE = os.getenv("IMAGE_WORKER_MODE", "inline")
+
+_image_wakeup = threading.Event()
+_image_worker_thread = None
+_image_worker_lock = threading.Lock()
+
+
+def image_derivative_name(image_filename, width, extension, version=IMAGE_DERIVATIVE_VERSION):
+    """Path of a derivative relative to the upload folder"""
+    stem = os.path.splitext(image_filename)[0]
+    return f"{IMAGE_DERIVATIVE_DIR}/{stem}-{width}w.{version}.{extension}"
+
+
+def plan_image_paths(image_filename, image_variants=None):
+    """The original and every derivative recorded for it, relative to the upload folder"""
+    paths = [image_filename]
+    if image_variants:
+        variants = json.loads(image_variants)
+        for width in variants["widths"]:
+            paths += [image_derivative_name(image_filename, width, extension, variants["version"])
+                      for extension in ("webp", "jpg")]
+    return paths
+
+
+def encode_image(img, format, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, format=format, **options)
+    return buffer.getvalue()
+
+
+def generate_image_derivatives(image_filename):
+    """
+    Write WebP and JPEG copies of an upload at every configured width (never upscaled).
+    Returns the metadata stored in Plan.image_variants.
+    """
+    with Image.open(os.path.join(app.config['UPLOAD_FOLDER'], image_filename)) as img:
+        width, height = img.size
+        # JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale, as long as that still covers the largest
+        # derivative, so a phone photo never has to be held in memory at full resolution
+        largest = max(IMAGE_DERIVATIVE_WIDTHS)
+        img.draft("RGB", (largest, largest))
+        ImageOps.exif_transpose(img, in_place=True)  # Phone photos carry their rotation in EXIF
+        if (img.width > img.height) != (width > height):
+            width, height = height, width  # Rotated by a quarter turn
+        
+        if img.mode in ("RGBA", "LA", "P"):
+            rgba = img.convert("RGBA")
+            img = Image.new("RGB", rgba.size, "white")  # JPEG has no alpha channel
+            img.paste(rgba, mask=rgba.getchannel("A"))
+            del rgba
+        elif img.mode != "RGB":
+            img = img.convert("RGB")
+        
+        widths = sorted({min(target, width) for target in IMAGE_DERIVATIVE_WIDTHS})
+        
+        # Largest first, each size resampled from the previous one rather than the full original.
+        # reducing_gap box-shrinks by an integer factor before the LANCZOS pass, which keeps
+        # resampling of large non-JPEG sources cheap.
+        current = img
+        for target in reversed(widths):
+            current = current.resize((target, max(1, round(height * target / width))), Image.Resampling.LANCZOS,
+                                     reducing_gap=3.0)
+            write_snapshot_file(os.path.join(app.config['UPLOAD_FOLDER'], image_derivative_name(image_filename, target, "webp")),
+                                encode_image(current, "WEBP", quality=IMAGE_WEBP_QUALITY, method=4))
+            write_snapshot_file(os.path.join(app.config['UPLOAD_FOLDER'], image_derivative_name(image_filename, target, "jpg")),
+                                encode_image(current, "JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True, progressive=True))
+    
+    tiny = current.resize((IMAGE_PLACEHOLDER_WIDTH, max(1, round(height * IMAGE_PLACEHOLDER_WIDTH / width))),
+                          Image.Resampling.BILINEAR).filter(ImageFilter.GaussianBlur(1))
+    placeholder = base64.b64encode(encode_image(tiny, "JPEG", quality=40)).decode()
+    
+    return {
+        "version": IMAGE_DERIVATIVE_VERSION,
+        "widths": widths,
+        "width": width,
+        "height": height,
+        "placeholder": f"data:image/jpeg;base64,{placeholder}",
+    }
+
+
+def remove_plan_image_files(image_filename, image_variants=None):
+    """Delete an upload and any derivatives written for it"""
+    for path in plan_image_paths(image_filename, image_variants):
+        try:
+            os.remove(os.path.join(app.config['UPLOAD_FOLDER'], path))
+        except FileNotFoundError:
+            pass
+
+
+def notify_image_worker():
+    """Wake the derivative worker, starting the in-process thread if it isn't running yet"""
+    global _image_worker_thread
+    if IMAGE_WORKER_MODE == "inline":
+        with _image_worker_lock:
+            if _image_worker_thread is None or not _image_worker_thread.is_alive():
+                _image_worker_thread = threading.Thread(
+                    target=run_image_worker, name="image-derivative-worker", daemon=True
+                )
+                _image_worker_thread.start()
+    _image_wakeup.set()
+
+
+def process_pending_images(limit=10):
+    """Build derivatives for up to `limit` queued images (once per stored file). Returns the number processed."""
+    pending = db.session.execute(
+        db.select(Plan.image_filename)
+        .where(Plan.image_status == "pending", Plan.image_filename.isnot(None))
+        .distinct().limit(limit)
+    ).scalars().all()
+    
+    for image_filename in pending:
+        started = time_module.perf_counter()
+        try:
+            variants = json.dumps(generate_image_derivatives(image_filename))
+            status = "ready"
+            record_metric("image.derivatives_ms", (time_module.perf_counter() - started) * 1000)
+        except Exception as e:
+            print(f"⚠️ Could not build derivatives for {image_filename}: {e}")
+            variants, status = None, "failed"
+        
+        # Every plan sharing the file; none if it was replaced or removed while processing
+        updated = Plan.query.filter_by(image_filename=image_filename, image_status="pending").update(
+            {"image_status": status, "image_variants": variants}, synchronize_session=False
+        )
+        if updated:
+            bump_customer_data_version()  # Cached /plans pages should pick up the new srcsets
+        db.session.commit()
+        if not updated:
+            release_plan_image(image_filename, variants)
+    
+    return len(pending)
+
+
+def run_image_worker(poll_interval=IMAGE_WORKER_POLL_INTERVAL, once=False):
+    """Process queued plan images until stopped (or until none are pending, with `once`)"""
+    while True:
+        with app.app_context():
+            try:
+                processed = process_pending_images()
+            except Exception as e:
+                print(f"⚠️ Image worker error: {e}")
+                db.session.rollback()
+                processed = 0
+        
+        if not processed:
+            if once:
+                return
+            _image_wakeup.wait(poll_interval)
+            _image_wakeup.clear()
+
+
+_image_backlog_checked = False
+
+
+@app.before_request
+def resume_image_backlog():
+    """
+    On each process's first request, start the inline worker if images are already queued,
+    e.g. the existing uploads the derivatives migration marked pending
+    """
+    global _image_backlog_checked
+    if _image_backlog_checked or IMAGE_WORKER_MODE != "inline":
+        return
+    _image_backlog_checked = True
+    try:
+        backlog = db.session.query(Plan.id).filter(Plan.image_status == "pending").first()
+    except Exception as e:
+        print(f"⚠️ Could not check for queued plan images: {e}")
+        db.session.rollback()
+        return
+    if backlog:
+        notify_image_worker()
+
+
+@app.template_global()
+def plan_image(plan):
+    """
+    URLs for a plan's picture: `src` always works (the original until derivatives are ready),
+    plus WebP/JPEG srcsets, intrinsic size and a blurred placeholder once they are.
+    """
+    if not plan.image_filename:
+        return None
+    
+    image = {"src": url_for("static", filename=f"uploads/dishes/{plan.image_filename}")}
+    if plan.image_status != "ready" or not plan.image_variants:
+        return image
+    
+    variants = json.loads(plan.image_variants)
+    
+    def derivative_url(width, extension):
+        name = image_derivative_name(plan.image_filename, width, extension, variants["version"])
+        return url_for("static", filename=f"uploads/dishes/{name}")
+    
+    srcsets = {
+        extension: ", ".join(f"{derivative_url(width, extension)} {width}w" for width in variants["widths"])
+        for extension in ("webp", "jpg")
+    }
+    largest = variants["widths"][-1]
+    image.update(
+        src=derivative_url(largest, "jpg"),
+        webp_srcset=srcsets["webp"],
+        jpeg_srcset=srcsets["jpg"],
+        width=largest,
+        height=round(variants["height"] * largest / variants["width"]),
+        placeholder=variants["placeholder"],
+    )
+    return image
+
+
+# ------------------------
+# Metrics Store
+# ------------------------
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "10"))  # seconds between batched writes
+METRICS_FLUSH_SIZE = int(os.getenv("METRICS_FLUSH_SIZE", "500"))  # buffered buckets that trigger an early flush
+METRICS_MINUTE_RETENTION_HOURS = int(os.getenv("METRICS_MINUTE_RETENTION_HOURS", "48"))  # then rolled up to hours
+METRICS_HOUR_RETENTION_DAYS = int(os.getenv("METRICS_HOUR_RETENTION_DAYS", "30"))  # then rolled up to days
+METRICS_RETENTION_DAYS = int(os.getenv("METRICS_RETENTION_DAYS", "730"))  # daily buckets are deleted after this
+METRIC_STEPS = {"minute": 60, "hour": 3600, "day": 86400}
+
+_metrics_buffer = {}  # (name, tags, bucket_start) -> [count, total, min, max]
+_metrics_lock = threading.Lock()
+_metrics_wakeup = threading.Event()
+_metrics_flusher = None
+
+
+def format_metric_tags(tags):
+    return ",".join(f"{key}={value}" for key, value in sorted(tags.items()) if value is not None)[:255]
+
+
+def parse_metric_tags(tags):
+    return dict(pair.split("=", 1) for pair in tags.split(",") if "=" in pair)
+
+
+def metric_bucket(moment, resolution):
+    """Start of the `resolution`-second bucket containing `moment`"""
+    if resolution >= METRIC_STEPS["day"]:
+        return datetime.combine(moment.date(), time.min)
+    if resolution >= METRIC_STEPS["hour"]:
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(second=0, microsecond=0)
+
+
+def _merge_metric_point(points, key, count, total, low, high):
+    point = points.get(key)
+    if point is None:
+        points[key] = [count, total, low, high]
+    else:
+        point[0] += count
+        point[1] += total
+        point[2] = min(point[2], low)
+        point[3] = max(point[3], high)
+
+
+def _metric_rows(points, resolution):
+    return [
+        {"name": name, "tags": tags, "resolution": resolution, "bucket_start": bucket_start,
+         "count": count, "total": total, "min_value": low, "max_value": high}
+        for (name, tags, bucket_start), (count, total, low, high) in points.items()
+    ]
+
+
+def record_metric(name, value=1, **tags):
+    """
+    Count one observation of `value` for `name`. Observations are summed into
+    per-minute buckets in memory and written in batches by a background thread.
+    """
+    if not METRICS_ENABLED:
+        return
+    key = (name, format_metric_tags(tags), metric_bucket(datetime.now(), METRIC_STEPS["minute"]))
+    value = float(value)
+    with _metrics_lock:
+        _merge_metric_point(_metrics_buffer, key, 1, value, value, value)
+        buffered = len(_metrics_buffer)
+    
+    start_metrics_flusher()
+    if buffered >= METRICS_FLUSH_SIZE:
+        _metrics_wakeup.set()
+
+
+def flush_metrics():
+    """Append buffered buckets to the metrics table. Returns the number of rows written."""
+    global _metrics_buffer
+    with _metrics_lock:
+        if not _metrics_buffer:
+            return 0
+        points, _metrics_buffer = _metrics_buffer, {}
+    
+    rows = _metric_rows(points, METRIC_STEPS["minute"])
+    try:
+        with app.app_context():
+            db.session.execute(db.insert(Metric), rows)
+            db.session.commit()
+    except Exception as e:
+        # Metrics are best effort; never let them break the request path
+        print(f"⚠️ Dropped {len(rows)} metric buckets: {e}")
+        return 0
+    return len(rows)
+
+
+def run_metrics_flusher():
+    while True:
+        _metrics_wakeup.wait(METRICS_FLUSH_INTERVAL)
+        _metrics_wakeup.clear()
+        flush_metrics()
+
+
+def start_metrics_flusher():
+    global _metrics_flusher
+    if _metrics_flusher is not None and _metrics_flusher.is_alive():
+        return
+    with _metrics_lock:
+        if _metrics_flusher is None or not _metrics_flusher.is_alive():
+            _metrics_flusher = threading.Thread(target=run_metrics_flusher, name="metrics-flusher", daemon=True)
+            _metrics_flusher.start()
+
+
+atexit.register(flush_metrics)
+
+
+def compact_metrics(now=None):
+    """
+    Downsample old buckets (minute -> hour -> day) and delete days past retention.
+    Rows are append-only and queries sum overlapping buckets, so compaction never
+    has to merge into existing rows. Returns {resolution: (rows read, rows written)}.
+    """
+    now = now or datetime.now()
+    stages = (
+        (METRIC_STEPS["minute"], METRIC_STEPS["hour"], timedelta(hours=METRICS_MINUTE_RETENTION_HOURS)),
+        (METRIC_STEPS["hour"], METRIC_STEPS["day"], timedelta(days=METRICS_HOUR_RETENTION_DAYS)),
+    )
+    summary = {}
+    
+    for resolution, target, keep in stages:
+        # Align to the coarser bucket so only complete target buckets are rolled up
+        cutoff = metric_bucket(now - keep, target)
+        stale = Metric.query.filter(Metric.resolution == resolution, Metric.bucket_start < cutoff)
+        points = {}
+        for name, tags, bucket_start, count, total, low, high in stale.with_entities(
+            Metric.name, Metric.tags, Metric.bucket_start, Metric.count,
+            Metric.total, Metric.min_value, Metric.max_value
+        ):
+            _merge_metric_point(points, (name, tags, metric_bucket(bucket_start, target)), count, total, low, high)
+        
+        read = stale.delete(synchronize_session=False)
+        if points:
+            db.session.execute(db.insert(Metric), _metric_rows(points, target))
+        summary[resolution] = (read, len(points))
+    
+    summary["expired"] = Metric.query.filter(
+        Metric.bucket_start < metric_bucket(now - timedelta(days=METRICS_RETENTION_DAYS), METRIC_STEPS["day"])
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    return summary
+
+
+def query_metric(name, start, end=None, step="day", group_by=None, **tags):
+    """
+    Aggregate `name` over [start, end) into `step` buckets ('minute', 'hour', 'day', or None
+    for a single total), split by the `group_by` tag and filtered on the given tag values.
+    Returns [{'bucket', 'group', 'count', 'total', 'avg', 'min', 'max'}] sorted by bucket and group.
+    Buckets already downsampled past `step` are reported at their own start.
+    """
+    query = db.session.query(
+        Metric.tags, Metric.bucket_start, Metric.count, Metric.total, Metric.min_value, Metric.max_value
+    ).filter(Metric.name == name, Metric.bucket_start >= start)
+    if end is not None:
+        query = query.filter(Metric.bucket_start < end)
+    
+    points = {}
+    for row_tags, bucket_start, count, total, low, high in query:
+        parsed = parse_metric_tags(row_tags)
+        if any(parsed.get(key) != str(value) for key, value in tags.items()):
+            continue
+        bucket = metric_bucket(bucket_start, METRIC_STEPS[step]) if step else None
+        group = parsed.get(group_by) if group_by else None
+        _merge_metric_point(points, (bucket, group), count, total, low, high)
+    
+    return [
+        {"bucket": bucket, "group": group, "count": count, "total": total,
+         "avg": total / count if count else 0, "min": low, "max": high}
+        for (bucket, group), (count, total, low, high) in sorted(
+            points.items(), key=lambda item: (item[0][0] or datetime.min, item[0][1] or "")
+        )
+    ]
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time_module.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop("request_started", None)
+    if started is not None and request.endpoint not in (None, "static"):
+        record_metric("request.duration_ms", (time_module.perf_counter() - started) * 1000,
+                      endpoint=request.endpoint, status=f"{response.status_code // 100}xx")
+    return response
+
+
+# ------------------------
+# Monthly Rollups
+# ------------------------
+
+ROLLUP_METRICS = ("revenue", "payments", "bills_issued", "new_customers", "active_plans", "plan_days", "pause_days")
+
+
+def bump_rollup(year, month, area, plan_id=0, **deltas):
+    """
+    Add `deltas` to the rollup row for (year, month, area, plan) inside the current transaction.
+    Uses an atomic upsert so concurrent requests can bump the same row.
+    """
+    deltas = {metric: value for metric, value in deltas.items() if value}
+    if not deltas:
+        return
+    
+    key = {"year": year, "month": month, "area": area or "", "plan_id": plan_id or 0}
+    dialect = db.session.get_bind().dialect.name
+    
+    if dialect in ("postgresql", "sqlite"):
+        if dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        values = dict(key, version=1, **{metric: deltas.get(metric, 0) for metric in ROLLUP_METRICS})
+        stmt = upsert(MonthlyRollup).values(**values)
+        update = {metric: getattr(MonthlyRollup, metric) + stmt.excluded[metric] for metric in deltas}
+        update["version"] = MonthlyRollup.version + 1
+        update["updated_at"] = db.func.now()
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=["year", "month", "area", "plan_id"], set_=update
+        ))
+    else:
+        row = MonthlyRollup.query.filter_by(**key).with_for_update().first()
+        if row is None:
+            row = MonthlyRollup(**key, **{metric: 0 for metric in ROLLUP_METRICS}, version=0)
+            db.session.add(row)
+        for metric, value in deltas.items():
+            setattr(row, metric, getattr(row, metric) + value)
+        row.version += 1
+
+
+def plan_month_spans(start_date, end_date):
+    """Yield (year, month, days) for every calendar month the date range touches"""
+    current = date(start_date.year, start_date.month, 1)
+    while current <= end_date:
+        month_end = date(current.year, current.month, monthrange(current.year, current.month)[1])
+        days = (min(end_date, month_end) - max(start_date, current)).days + 1
+        yield current.year, current.month, days
+        current = month_end + timedelta(days=1)
+
+
+def rollup_customer_plan(customer_plan, area, sign=1):
+    """Count a customer plan in (sign=1) or out of (sign=-1) every month it runs"""
+    for year, month, days in plan_month_spans(customer_plan.start_date, customer_plan.end_date):
+        bump_rollup(year, month, area, customer_plan.plan_id, active_plans=sign, plan_days=sign * days)
+    mark_cohorts_stale(customer_plan.start_date)
+
+
+def rollup_bill_paid(bill, area, amount=None):
+    """Record revenue for a bill that has just become paid"""
+    bump_rollup(bill.year, bill.month, area, revenue=bill.amount if amount is None else amount, payments=1)
+
+
+def customer_area(customer_id):
+    return db.session.query(User.area).filter(User.id == customer_id).scalar()
+
+
+def collect_rollup_totals(customer_id=None):
+    """
+    Recompute rollup metrics from the raw tables, keyed on (year, month, area, plan_id).
+    Limited to one customer when `customer_id` is given.
+    """
+    totals = defaultdict(lambda: dict.fromkeys(ROLLUP_METRICS, 0))
+    
+    def for_customer(query, column):
+        return query if customer_id is None else query.filter(column == customer_id)
+    
+    # Bills issued and paid revenue
+    bill_rows = for_customer(db.session.query(
+        Bill.year,
+        Bill.month,
+        User.area,
+        db.func.count(Bill.id),
+        db.func.sum(db.case((Bill.is_paid == True, 1), else_=0)),
+        db.func.sum(db.case((Bill.is_paid == True, Bill.amount), else_=0))
+    ).join(User, Bill.customer_id == User.id), Bill.customer_id).group_by(Bill.year, Bill.month, User.area)
+    for year, month, area, issued, paid_count, revenue in bill_rows:
+        row = totals[(year, month, area or "", 0)]
+        row["bills_issued"] += issued
+        row["payments"] += int(paid_count or 0)
+        row["revenue"] += int(revenue or 0)
+    
+    # New customers by signup month
+    signup_year = db.extract('year', User.created_at)
+    signup_month = db.extract('month', User.created_at)
+    customer_rows = for_customer(db.session.query(
+        signup_year, signup_month, User.area, db.func.count(User.id)
+    ).filter(User.is_admin == False, User.created_at.isnot(None)), User.id).group_by(signup_year, signup_month, User.area)
+    for year, month, area, count in customer_rows:
+        totals[(int(year), int(month), area or "", 0)]["new_customers"] += count
+    
+    # Paused days
+    pause_year = db.extract('year', PausedDate.pause_date)
+    pause_month = db.extract('month', PausedDate.pause_date)
+    pause_rows = for_customer(db.session.query(
+        pause_year, pause_month, User.area, db.func.count(PausedDate.id)
+    ).join(User, PausedDate.customer_id == User.id), PausedDate.customer_id).group_by(pause_year, pause_month, User.area)
+    for year, month, area, count in pause_rows:
+        totals[(int(year), int(month), area or "", 0)]["pause_days"] += count
+    
+    # Plans running in each month
+    plan_rows = for_customer(db.session.query(
+        CustomerPlan.start_date, CustomerPlan.end_date, CustomerPlan.plan_id, User.area
+    ).join(User, CustomerPlan.customer_id == User.id), CustomerPlan.customer_id).yield_per(1000)
+    for start_date, end_date, plan_id, area in plan_rows:
+        for year, month, days in plan_month_spans(start_date, end_date):
+            row = totals[(year, month, area or "", plan_id)]
+            row["active_plans"] += 1
+            row["plan_days"] += days
+    
+    return totals
+
+
+def rebuild_monthly_rollups():
+    """Recompute every rollup row from the raw tables. Returns the number of rows written."""
+    totals = collect_rollup_totals()
+    MonthlyRollup.query.delete()
+    db.session.bulk_insert_mappings(MonthlyRollup, [
+        dict(year=year, month=month, area=area, plan_id=plan_id, version=1, **metrics)
+        for (year, month, area, plan_id), metrics in totals.items()
+    ])
+    db.session.commit()
+    return len(totals)
+
+
+def rebucket_customer_rollups(customer_id, old_area, new_area):
+    """
+    Move a customer's whole history from one area's rollups to another's inside the
+    current transaction, so area slices keep matching a rebuild after a profile change.
+    """
+    if (old_area or "") == (new_area or ""):
+        return
+    for (year, month, _, plan_id), metrics in collect_rollup_totals(customer_id).items():
+        bump_rollup(year, month, old_area, plan_id, **{metric: -value for metric, value in metrics.items()})
+        bump_rollup(year, month, new_area, plan_id, **metrics)
+
+
+# ------------------------
+# Revenue Cube
+# ------------------------
+
+class RevenueCube:
+    """
+    Area x plan x month metrics held in dense NumPy arrays of shape (areas, plans, months).
+
+    Collected revenue and pauses are recorded per area and month, not per plan, so they are
+    attributed to the plans running in that area-month in proportion to their scheduled value
+    (meal days x daily rate) and meal days respectively. Area-months with no running plan keep
+    them under the "Other" plan. "active_plans" counts customer plans running in a month, so a
+    customer on two plans counts twice and a range of months counts plan-months.
+    """
+
+    METRICS = ("revenue", "meals", "pauses", "active_plans")
+    AXES = ("area", "plan", "month")
+
+    def __init__(self, areas, plans, months, arrays):
+        self.areas = areas  # area names
+        self.plans = plans  # plan names, "Other" last
+        self.months = months  # (year, month) pairs, oldest first
+        self.arrays = arrays  # metric -> ndarray
+        self.version = None  # (etag, last_modified) of the rollups it was built from
+        self._positions = {
+            "area": {name: i for i, name in enumerate(areas)},
+            "plan": {name: i for i, name in enumerate(plans)},
+            "month": {key: i for i, key in enumerate(months)},
+        }
+
+    def _selection(self, area=None, plan=None, months=None):
+        """Index arrays for each axis; None keeps the whole axis, unknown labels select nothing"""
+        selection = []
+        for axis, wanted in zip(self.AXES, (area, plan, months)):
+            positions = self._positions[axis]
+            if wanted is None:
+                selection.append(list(range(len(positions))))
+            else:
+                if axis != "month" and isinstance(wanted, str):
+                    wanted = [wanted]
+                selection.append([positions[label] for label in wanted if label in positions])
+        return selection
+
+    def total(self, metric, area=None, plan=None, months=None):
+        """Sum of `metric` over the selected cells"""
+        import numpy as np
+        cells = self.arrays[metric][np.ix_(*self._selection(area, plan, months))]
+        return round(float(cells.sum()))
+
+    def by(self, metric, axis, area=None, plan=None, months=None):
+        """`metric` rolled up onto `axis` as [(label, value)], skipping zero rows"""
+        import numpy as np
+        selection = self._selection(area, plan, months)
+        cells = self.arrays[metric][np.ix_(*selection)]
+        keep = self.AXES.index(axis)
+        totals = cells.sum(axis=tuple(i for i in range(len(self.AXES)) if i != keep))
+        labels = (self.areas, self.plans, self.months)[keep]
+        return [
+            (labels[index], round(float(value)))
+            for index, value in zip(selection[keep], totals)
+            if value
+        ]
+
+
+def build_revenue_cube():
+    """Build the RevenueCube from one aggregate over the monthly rollups joined to plans"""
+    import numpy as np
+
+    rows = db.session.query(
+        MonthlyRollup.year,
+        MonthlyRollup.month,
+        MonthlyRollup.area,
+        Plan.name,
+        db.func.coalesce(Plan.daily_rate, 0),
+        db.func.sum(MonthlyRollup.revenue),
+        db.func.sum(MonthlyRollup.pause_days),
+        db.func.sum(MonthlyRollup.plan_days),
+        db.func.sum(MonthlyRollup.active_plans)
+    ).outerjoin(Plan, Plan.id == MonthlyRollup.plan_id).group_by(
+        MonthlyRollup.year, MonthlyRollup.month, MonthlyRollup.area, Plan.name, Plan.daily_rate
+    ).all()
+
+    if not rows:
+        return RevenueCube([], ["Other"], [], {
+            metric: np.zeros((0, 1, 0)) for metric in RevenueCube.METRICS
+        })
+
+    years, months, areas, plan_names, daily_rates, revenue, pauses, plan_days, active_plans = (
+        np.array(column) for column in zip(*rows)
+    )
+    plan_names = np.array([name or "Other" for name in plan_names])
+
+    area_labels, area_index = np.unique(areas, return_inverse=True)
+    plan_labels = sorted(str(name) for name in set(plan_names) - {"Other"}) + ["Other"]
+    plan_index = np.searchsorted(np.array(plan_labels[:-1]), plan_names)
+    plan_index[plan_names == "Other"] = len(plan_labels) - 1
+    month_keys, month_positions = np.unique(years.astype(np.int64) * 12 + months.astype(np.int64) - 1,
+                                            return_inverse=True)
+
+    shape = (len(area_labels), len(plan_labels), len(month_keys))
+    cell = (area_index, plan_index, month_positions)
+
+    meals = np.zeros(shape)
+    np.add.at(meals, cell, plan_days.astype(float))
+    running_plans = np.zeros(shape)
+    np.add.at(running_plans, cell, active_plans.astype(float))
+    scheduled_value = np.zeros(shape)
+    np.add.at(scheduled_value, cell, plan_days.astype(float) * daily_rates.astype(float))
+
+    # Area-month totals that are not tied to a plan
+    area_month_revenue = np.zeros((shape[0], shape[2]))
+    np.add.at(area_month_revenue, (area_index, month_positions), revenue.astype(float))
+    area_month_pauses = np.zeros((shape[0], shape[2]))
+    np.add.at(area_month_pauses, (area_index, month_positions), pauses.astype(float))
+
+    def attribute(totals, weights):
+        weight_sums = weights.sum(axis=1, keepdims=True)
+        shares = np.divide(weights, weight_sums, out=np.zeros(shape), where=weight_sums > 0)
+        spread = shares * totals[:, None, :]
+        spread[:, -1, :] += np.where(weight_sums[:, 0, :] > 0, 0, totals)
+        return spread
+
+    return RevenueCube(
+        [str(area) for area in area_labels],
+        plan_labels,
+        [(int(key) // 12, int(key) % 12 + 1) for key in month_keys],
+        {
+            "revenue": attribute(area_month_revenue, scheduled_value),
+            "meals": meals,
+            "pauses": attribute(area_month_pauses, meals),
+            "active_plans": running_plans,
+        },
+    )
+
+
+def get_revenue_cube(force=False):
+    def compute():
+        # Read the version first so a bump during the build makes the result look older, not newer
+        version = analytics_source_version(("rollups",))
+        cube = build_revenue_cube()
+        cube.version = version
+        return cube
+
+    return cached_report("analytics:revenue_cube", compute, force=force)
+
+
+# ------------------------
+# Daily Facts
+# ------------------------
+
+DAILY_FACTS_INITIAL_DAYS = int(os.getenv("DAILY_FACTS_INITIAL_DAYS", "90"))  # history written by the first nightly run
+
+
+def compute_daily_facts(start_date, end_date):
+    """
+    Per-day meal and revenue figures for [start_date, end_date] as {date: {column: value}}.
+    Plans become +1/-1 steps in difference arrays that a cumulative sum turns into daily
+    counts, so the cost grows with the number of plans and pauses, not plans x days.
+    """
+    import numpy as np
+
+    days = (end_date - start_date).days + 1
+    day_zero = start_date.toordinal()
+
+    plans = db.session.query(
+        CustomerPlan.customer_id, CustomerPlan.start_date, CustomerPlan.end_date, Plan.daily_rate
+    ).join(Plan, CustomerPlan.plan_id == Plan.id).filter(
+        CustomerPlan.start_date <= end_date,
+        CustomerPlan.end_date >= start_date
+    ).order_by(CustomerPlan.customer_id, CustomerPlan.start_date).all()
+
+    pauses = db.session.query(
+        PausedDate.customer_id, PausedDate.pause_date, PausedDate.created_at
+    ).filter(PausedDate.pause_date.between(start_date, end_date)).all()
+
+    scheduled = np.zeros(days + 1, dtype=np.int64)
+    scheduled_value = np.zeros(days + 1, dtype=np.int64)
+    customers = np.zeros(days + 1, dtype=np.int64)
+    paused = np.zeros(days, dtype=np.int64)
+    late_paused = np.zeros(days, dtype=np.int64)
+    paused_value = np.zeros(days, dtype=np.int64)
+
+    customer_plans = defaultdict(list)
+    if plans:
+        customer_ids, starts, ends, rates = zip(*plans)
+        first = np.clip(np.array([d.toordinal() for d in starts]) - day_zero, 0, days)
+        after_last = np.clip(np.array([d.toordinal() for d in ends]) - day_zero + 1, 0, days)
+        rates = np.array(rates, dtype=np.int64)
+        np.add.at(scheduled, first, 1)
+        np.add.at(scheduled, after_last, -1)
+        np.add.at(scheduled_value, first, rates)
+        np.add.at(scheduled_value, after_last, -rates)
+
+        # Distinct customers per day: merge each customer's overlapping plans first
+        merged = []
+        for customer_id, begin, end, rate in zip(customer_ids, first, after_last, rates):
+            customer_plans[customer_id].append((begin, end, int(rate)))
+            if merged and merged[-1][0] == customer_id and begin <= merged[-1][2]:
+                merged[-1][2] = max(merged[-1][2], end)
+            else:
+                merged.append([customer_id, begin, end])
+        for _, begin, end in merged:
+            customers[begin] += 1
+            customers[end] -= 1
+
+    # A pause skips every plan the customer has running that day
+    for customer_id, pause_date, created_at in pauses:
+        offset = pause_date.toordinal() - day_zero
+        running = [rate for begin, end, rate in customer_plans.get(customer_id, ()) if begin <= offset < end]
+        paused[offset] += len(running)
+        paused_value[offset] += sum(running)
+        if created_at and created_at.date() >= pause_date:
+            late_paused[offset] += len(running)
+
+    scheduled = np.cumsum(scheduled)[:days]
+    scheduled_value = np.cumsum(scheduled_value)[:days]
+    customers = np.cumsum(customers)[:days]
+
+    return {
+        start_date + timedelta(days=offset): {
+            "scheduled_meals": int(scheduled[offset]),
+            "paused_meals": int(paused[offset]),
+            "late_paused_meals": int(late_paused[offset]),
+            "delivered_meals": int(scheduled[offset] - paused[offset]),
+            "revenue_accrued": int(scheduled_value[offset] - paused_value[offset]),
+            "active_customers": int(customers[offset]),
+        }
+        for offset in range(days)
+    }
+
+
+def build_daily_facts(start_date, end_date):
+    """(Re)write the daily_facts rows for [start_date, end_date]. Returns the number of days written."""
+    if end_date < start_date:
+        return 0
+    facts = compute_daily_facts(start_date, end_date)
+    DailyFact.query.filter(DailyFact.fact_date.between(start_date, end_date)).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(DailyFact, [
+        dict(fact_date=fact_date, **columns) for fact_date, columns in facts.items()
+    ])
+    db.session.commit()
+    return len(facts)
+
+
+def ensure_daily_facts(through=None):
+    """Fill any days missing since the last fact row, up to `through` (default yesterday)"""
+    through = through or date.today() - timedelta(days=1)
+    latest = db.session.query(db.func.max(DailyFact.fact_date)).scalar()
+    start = latest + timedelta(days=1) if latest else through - timedelta(days=DAILY_FACTS_INITIAL_DAYS - 1)
+    return build_daily_facts(start, through)
+
+
+DAILY_FACT_COLUMNS = ("scheduled_meals", "paused_meals", "late_paused_meals", "delivered_meals",
+                      "revenue_accrued", "active_customers")
+
+
+def daily_fact_rows(start_date, end_date):
+    """
+    Facts per day for [start_date, end_date] up to yesterday as {date: {column: value}}.
+    Read from daily_facts; days the nightly job hasn't written yet are computed in memory,
+    so request handlers never write the table.
+    """
+    end_date = min(end_date, date.today() - timedelta(days=1))
+    if end_date < start_date:
+        return {}
+    rows = {
+        row[0]: dict(zip(DAILY_FACT_COLUMNS, row[1:]))
+        for row in db.session.query(
+            DailyFact.fact_date, *(getattr(DailyFact, column) for column in DAILY_FACT_COLUMNS)
+        ).filter(DailyFact.fact_date.between(start_date, end_date))
+    }
+    missing = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)
+               if start_date + timedelta(days=offset) not in rows]
+    if missing:
+        computed = compute_daily_facts(missing[0], missing[-1])
+        rows.update((day, computed[day]) for day in missing)
+    return rows
+
+
+def daily_fact_totals(start_date, end_date):
+    """Summed facts for a date range, plus active customers on its first and last day"""
+    rows = daily_fact_rows(start_date, end_date)
+    totals = {column: sum(row[column] for row in rows.values()) for column in DAILY_FACT_COLUMNS[:-1]}
+    totals["first_active_customers"] = rows[min(rows)]["active_customers"] if rows else 0
+    totals["last_active_customers"] = rows[max(rows)]["active_customers"] if rows else 0
+    return totals
+
+
+# ------------------------
+# Cohort Retention
+# ------------------------
+
+COHORT_BASES = ("first_plan", "signup")
+
+
+def compute_cohort_retention(basis, from_index=None):
+    """
+    Cohort retention cells for activity months from `from_index` (a month_index) through this month,
+    as {(cohort_index, months_since): (cohort_size, active_customers)}.
+    Customers are grouped by the month of their first plan or of signup. Every plan is expanded
+    into the months it touches in one vectorised pass, and (customer, month) pairs are
+    de-duplicated so a customer with several plans counts once per month.
+    """
+    import numpy as np
+
+    current = month_index(date.today())
+
+    if basis == "signup":
+        members = db.session.query(
+            User.id.label("customer_id"), sql_month_index(User.created_at).label("cohort")
+        ).filter(User.is_admin == False, User.created_at.isnot(None))
+    else:
+        members = db.session.query(
+            CustomerPlan.customer_id.label("customer_id"),
+            db.func.min(sql_month_index(CustomerPlan.start_date)).label("cohort")
+        ).group_by(CustomerPlan.customer_id)
+    members = members.subquery()
+
+    # Cohort sizes are counted by the database; only customers with plans in the window are loaded
+    cohort_sizes = dict(db.session.query(members.c.cohort, db.func.count()).filter(
+        members.c.cohort <= current
+    ).group_by(members.c.cohort).all())
+    if not cohort_sizes:
+        return {}
+
+    # Activity before the earliest cohort cannot count towards any cohort
+    from_index = min(cohort_sizes) if from_index is None else from_index
+    first_month_start = date(from_index // 12, from_index % 12 + 1, 1)
+    plan_rows = db.session.query(
+        CustomerPlan.customer_id,
+        members.c.cohort,
+        sql_month_index(CustomerPlan.start_date),
+        sql_month_index(CustomerPlan.end_date)
+    ).join(members, members.c.customer_id == CustomerPlan.customer_id).filter(
+        CustomerPlan.end_date >= first_month_start,
+        CustomerPlan.start_date <= date.today()
+    ).all()
+
+    active_counts = {}
+    if plan_rows:
+        customer_ids, cohorts, starts, ends = (np.array(column, dtype=np.int64) for column in zip(*plan_rows))
+        first = np.maximum(starts, from_index)
+        last = np.minimum(ends, current)
+        spans = np.maximum(last - first + 1, 0)
+
+        # Expand every plan into one entry per month it runs
+        total = int(spans.sum())
+        offsets = np.arange(total) - np.repeat(np.cumsum(spans) - spans, spans)
+        months = np.repeat(first, spans) + offsets
+        width = current - from_index + 1
+        _, unique_positions = np.unique(np.repeat(customer_ids, spans) * width + (months - from_index), return_index=True)
+
+        months = months[unique_positions]
+        member_cohorts = np.repeat(cohorts, spans)[unique_positions]
+        since = months - member_cohorts
+        counted = since >= 0
+        cells, counts = np.unique(member_cohorts[counted] * 10000 + since[counted], return_counts=True)
+        active_counts = {(int(cell // 10000), int(cell % 10000)): int(count) for cell, count in zip(cells, counts)}
+
+    result = {}
+    for cohort, size in cohort_sizes.items():
+        cohort = int(cohort)
+        for month in range(max(cohort, from_index), current + 1):
+            result[(cohort, month - cohort)] = (int(size), active_counts.get((cohort, month - cohort), 0))
+    return result
+
+
+COHORT_STALE_FROM = "cohort_retention_stale_from"  # month_index from which stored cells may be out of date
+
+
+def mark_cohorts_stale(since):
+    """Flag stored cohort cells from the month of `since` onward as stale, inside the current transaction"""
+    db.session.execute(db.update(AppCounter).where(
+        AppCounter.name == COHORT_STALE_FROM, AppCounter.value > month_index(since)
+    ).values(value=month_index(since)))
+
+
+def cohort_stale_from():
+    """First month whose stored cells may be stale, or None when cells have never been written"""
+    return db.session.query(AppCounter.value).filter(AppCounter.name == COHORT_STALE_FROM).scalar()
+
+
+def refresh_cohort_retention(full=False):
+    """
+    Rewrite the materialized cohort_retention cells. Plan changes mark the months they touch as
+    stale, and the month in progress is always stale, so an incremental refresh recomputes from
+    the earliest stale month (at least the last month refreshed) onward. Use `full` after bulk
+    imports. Returns the number of cells written (zero when nothing changed).
+    """
+    current = month_index(date.today())
+    stale_from = cohort_stale_from()
+    from_index = None if full or stale_from is None else min(stale_from, current)
+
+    written = 0
+    for basis in COHORT_BASES:
+        cells = compute_cohort_retention(basis, from_index)
+        stale = CohortRetention.query.filter(CohortRetention.basis == basis)
+        if from_index is not None:
+            activity_month = CohortRetention.cohort_year * 12 + CohortRetention.cohort_month - 1 + CohortRetention.months_since
+            stale = stale.filter(activity_month >= from_index)
+        
+        # Leave unchanged cells alone so updated_at keeps meaning "last changed"
+        existing = {
+            (row.cohort_year * 12 + row.cohort_month - 1, row.months_since): (row.cohort_size, row.active_customers)
+            for row in stale
+        }
+        if existing == cells:
+            continue
+        stale.delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(CohortRetention, [
+            dict(basis=basis, cohort_year=cohort // 12, cohort_month=cohort % 12 + 1, months_since=since,
+                 cohort_size=size, active_customers=active)
+            for (cohort, since), (size, active) in cells.items()
+        ])
+        written += len(cells)
+    
+    # Only move the marker forward if no plan change lowered it while we were computing
+    if stale_from is None:
+        db.session.add(AppCounter(name=COHORT_STALE_FROM, value=current))
+    else:
+        db.session.execute(db.update(AppCounter).where(
+            AppCounter.name == COHORT_STALE_FROM, AppCounter.value == stale_from
+        ).values(value=current))
+    db.session.commit()
+    return written
+
+
+def cohort_retention_cells(basis):
+    """
+    Cohort cells as {(cohort_index, months_since): (cohort_size, active_customers)}: stored cells
+    for settled months, with months marked stale since the last refresh computed in memory.
+    Request handlers read through this and never write the table.
+    """
+    stale_from = cohort_stale_from()
+    if stale_from is None:
+        return compute_cohort_retention(basis)
+    stale_from = min(stale_from, month_index(date.today()))
+    activity_month = CohortRetention.cohort_year * 12 + CohortRetention.cohort_month - 1 + CohortRetention.months_since
+    cells = {
+        (row.cohort_year * 12 + row.cohort_month - 1, row.months_since): (row.cohort_size, row.active_customers)
+        for row in CohortRetention.query.filter(CohortRetention.basis == basis, activity_month < stale_from)
+    }
+    cells.update(compute_cohort_retention(basis, stale_from))
+    return cells
+
+
+def cohort_retention_matrix(basis="first_plan", cohorts=6):
+    """The latest `cohorts` cohorts as [{'cohort': (year, month), 'size': n, 'retention': [% per month since]}]"""
+    matrix = {}
+    for (cohort, since), (size, active) in sorted(cohort_retention_cells(basis).items(), key=lambda cell: (-cell[0][0], cell[0][1])):
+        key = (cohort // 12, cohort % 12 + 1)
+        if key not in matrix:
+            if len(matrix) == cohorts:
+                break
+            matrix[key] = {'cohort': key, 'size': size, 'retention': []}
+        matrix[key]['retention'].append(round(active / size * 100, 1) if size else 0)
+    return list(reversed(matrix.values()))
+
+
+# ------------------------
+# Revenue Projection
+# ------------------------
+
+PROJECTION_HISTORY_DAYS = int(os.getenv("PROJECTION_HISTORY_DAYS", "180"))  # pause history used for probabilities
+WEEKDAY_NAMES = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+
+def learn_pause_probabilities(history_days=PROJECTION_HISTORY_DAYS):
+    """Share of scheduled meals paused on each weekday (Mon..Sun) over the recent daily facts"""
+    import numpy as np
+
+    end_date = date.today() - timedelta(days=1)
+    rows = daily_fact_rows(end_date - timedelta(days=history_days - 1), end_date)
+
+    scheduled = np.zeros(7)
+    paused = np.zeros(7)
+    for fact_date, facts in rows.items():
+        scheduled[fact_date.weekday()] += facts["scheduled_meals"]
+        paused[fact_date.weekday()] += facts["paused_meals"]
+    return np.divide(paused, scheduled, out=np.zeros(7), where=scheduled > 0)
+
+
+def project_revenue(start_date, end_date, pause_probabilities=None):
+    """
+    Expected billable days and revenue per customer for [start_date, end_date].
+    Every scheduled plan day counts as billable with probability 1 - p(weekday). Days the
+    customer has already paused count as zero. Per-plan sums come from a prefix sum over the
+    horizon, so the batch costs O(plans + pauses + days).
+    Returns {'customer_ids', 'scheduled_days', 'expected_days', 'expected_revenue'} as arrays
+    (one entry per customer with a plan in range) plus the probabilities used.
+    """
+    import numpy as np
+
+    if pause_probabilities is None:
+        pause_probabilities = learn_pause_probabilities()
+    days = (end_date - start_date).days + 1
+    day_zero = start_date.toordinal()
+
+    # Expected billable share of each horizon day, and its running total
+    weekdays = (np.arange(days) + start_date.weekday()) % 7
+    keep = 1.0 - pause_probabilities[weekdays]
+    keep_before = np.concatenate(([0.0], np.cumsum(keep)))
+
+    plans = db.session.query(
+        CustomerPlan.customer_id, CustomerPlan.start_date, CustomerPlan.end_date, Plan.daily_rate
+    ).join(Plan, CustomerPlan.plan_id == Plan.id).filter(
+        CustomerPlan.is_active == True,
+        CustomerPlan.start_date <= end_date,
+        CustomerPlan.end_date >= start_date
+    ).all()
+    if not plans:
+        empty = np.zeros(0)
+        return {
+            'customer_ids': np.zeros(0, dtype=np.int64),
+            'scheduled_days': empty,
+            'expected_days': empty,
+            'expected_revenue': empty,
+            'pause_probabilities': pause_probabilities
+        }
+
+    plan_customers, starts, ends, rates = zip(*plans)
+    first = np.clip(np.array([d.toordinal() for d in starts]) - day_zero, 0, days)
+    after_last = np.clip(np.array([d.toordinal() for d in ends]) - day_zero + 1, 0, days)
+    rates = np.array(rates, dtype=float)
+    customer_ids, positions = np.unique(np.array(plan_customers, dtype=np.int64), return_inverse=True)
 
+    plan_expected = keep_before[after_last] - keep_before[first]
 
-class Payment(db.Model):
-    __tablename__ = "payments"
+    # Known pauses remove that day's expected share from every plan the customer has running
+    pauses = db.session.query(PausedDate.customer_id, PausedDate.pause_date).filter(
+        PausedDate.pause_date.between(start_date, end_date),
+        PausedDate.customer_id.in_(db.session.query(CustomerPlan.customer_id).filter(
+            CustomerPlan.start_date <= end_date, CustomerPlan.end_date >= start_date
+        ))
+    ).all()
+    if pauses:
+        plans_by_customer = defaultdict(list)
+        for plan_index, customer_id in enumerate(plan_customers):
+            plans_by_customer[customer_id].append(plan_index)
+        for customer_id, pause_date in pauses:
+            offset = pause_date.toordinal() - day_zero
+            for plan_index in plans_by_customer.get(customer_id, ()):
+                if first[plan_index] <= offset < after_last[plan_index]:
+                    plan_expected[plan_index] -= keep[offset]
+
+    return {
+        'customer_ids': customer_ids,
+        'scheduled_days': np.bincount(positions, weights=after_last - first, minlength=len(customer_ids)),
+        'expected_days': np.bincount(positions, weights=plan_expected, minlength=len(customer_ids)),
+        'expected_revenue': np.bincount(positions, weights=plan_expected * rates, minlength=len(customer_ids)),
+        'pause_probabilities': pause_probabilities
+    }
 
-    id = db.Column(db.Integer, primary_key=True)
-    bill_id = db.Column(db.Integer, db.ForeignKey("bills.id"), nullable=False)
-    customer_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    stripe_payment_intent_id = db.Column(db.String(255), unique=True, nullable=False)
-    amount = db.Column(db.Integer, nullable=False)  # Amount in paise (₹1 = 100 paise)
-    currency = db.Column(db.String(3), default="inr", nullable=False)
-    status = db.Column(db.String(50), nullable=False)  # succeeded, pending, failed
-    payment_method = db.Column(db.String(50))  # card, upi, netbanking, etc.
-    created_at = db.Column(db.DateTime, server_default=db.func.now())
-    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
 
+def projection_horizons(today=None):
+    """(label, start_date, end_date) for next month and the next three months"""
+    today = today or date.today()
+    next_month = date(today.year, today.month, monthrange(today.year, today.month)[1]) + timedelta(days=1)
+    quarter_year, quarter_month = next_month.year + (next_month.month + 1) // 12, (next_month.month + 1) % 12 + 1
+    quarter_end = date(quarter_year, quarter_month, monthrange(quarter_year, quarter_month)[1])
+    return [
+        ("Next month", next_month, date(next_month.year, next_month.month, monthrange(next_month.year, next_month.month)[1])),
+        ("Next quarter", next_month, quarter_end),
+    ]
 
-class PaymentLog(db.Model):
-    __tablename__ = "payment_logs"
 
-    id = db.Column(db.Integer, primary_key=True)
-    payment_id = db.Column(db.Integer, db.ForeignKey("payments.id"), nullable=False)
-    bill_id = db.Column(db.Integer, db.ForeignKey("bills.id"), nullable=False)
-    customer_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
-    amount = db.Column(db.Integer, nullable=False)
-    payment_method = db.Column(db.String(50))
-    stripe_payment_intent_id = db.Column(db.String(255), unique=True, nullable=False)
-    billing_period = db.Column(db.String(20))  # "MM/YYYY" format
-    status = db.Column(db.String(50), default="completed")
-    created_at = db.Column(db.DateTime, server_default=db.func.now())
-    
-    # Relationships for easy access
-    payment = db.relationship("Payment", backref="logs")
-    bill = db.relationship("Bill", backref="payment_logs")
-    customer = db.relationship("User", backref="payment_logs")
+def revenue_projection_summary():
+    """Totals for each projection horizon, for the analytics page"""
+    pause_probabilities = learn_pause_probabilities()
+    summaries = []
+    for label, start_date, end_date in projection_horizons():
+        projection = project_revenue(start_date, end_date, pause_probabilities)
+        scheduled = float(projection['scheduled_days'].sum())
+        expected = float(projection['expected_days'].sum())
+        summaries.append({
+            'label': label,
+            'period': f"{start_date.strftime('%b %d')} - {end_date.strftime('%b %d, %Y')}",
+            'revenue': round(float(projection['expected_revenue'].sum())),
+            'billable_days': round(expected),
+            'scheduled_days': round(scheduled),
+            'customers': len(projection['customer_ids']),
+            'expected_pause_rate': round((1 - expected / scheduled) * 100 if scheduled > 0 else 0, 1)
+        })
+    return summaries
 
 
 # ------------------------
@@ -650,6 +2798,7 @@ def register():
         )
 
         db.session.add(user)
+        bump_rollup(date.today().year, date.today().month, user.area, new_customers=1)
         db.session.commit()
         flash("Account created successfully!", "success")
         return redirect(url_for("login"))
@@ -719,7 +2868,10 @@ def profile():
         user.city = city
         user.state = state
         user.pincode = pincode
+        if area != user.area:
+            rebucket_customer_rollups(user.id, user.area, area)
         user.area = area
+        bump_customer_data_version(user.id)
 
         db.session.commit()
 
@@ -831,31 +2983,55 @@ def admin_test_email():
     admin_user = User.query.get(session.get("user_id"))
     to_email = admin_user.email if admin_user else os.getenv("TEST_EMAIL") or MAIL_DEFAULT_SENDER
 
-    html_body = """
-        <p>Hi from <strong>TiffinTrack</strong> 👋</p>
-        <p>This is a <strong>test email</strong> to confirm that your email service is configured correctly.</p>
-        <p>If you received this, your SMTP settings are working.</p>
-    """
-    text_body = (
-        "Hi from TiffinTrack,\n\n"
-        "This is a test email to confirm that your email service is configured correctly.\n"
-        "If you received this, your SMTP settings are working."
-    )
+    html_body, text_body = render_email("test_email")
 
-    success, error = send_email(
+    enqueue_email(
         to_email=to_email,
         subject="TiffinTrack – Test Email",
         html_body=html_body,
         text_body=text_body,
+        kind="test",
+        customer_id=admin_user.id if admin_user else None,
     )
+    db.session.commit()
+    notify_email_worker()
 
-    if success:
-        flash(f"Test email sent to {to_email}. Please check that inbox.", "success")
-    else:
-        flash(f"Failed to send test email: {error}", "error")
+    flash(f"Test email queued for {to_email}. Please check that inbox, or the email outbox if it doesn't arrive.", "success")
 
     return redirect(url_for("admin_dashboard"))
 
+
+@app.route("/admin/email-outbox")
+def admin_email_outbox():
+    """Delivery status of the email outbox"""
+    if not session.get("is_admin"):
+        return jsonify({"error": "Unauthorized"}), 401
+
+    counts = dict(
+        db.session.query(EmailOutbox.status, db.func.count(EmailOutbox.id)).group_by(EmailOutbox.status).all()
+    )
+    recent_failures = EmailOutbox.query.filter(
+        EmailOutbox.last_error.isnot(None),
+        EmailOutbox.status != "sent"
+    ).order_by(EmailOutbox.id.desc()).limit(10).all()
+
+    return jsonify({
+        "email_configured": is_email_configured(),
+        "counts": {status: counts.get(status, 0) for status in ("pending", "sending", "sent", "failed")},
+        "recent_failures": [
+            {
+                "id": entry.id,
+                "kind": entry.kind,
+                "to_email": entry.to_email,
+                "status": entry.status,
+                "attempts": entry.attempts,
+                "next_attempt_at": entry.next_attempt_at.isoformat() if entry.next_attempt_at else None,
+                "error": entry.last_error,
+            }
+            for entry in recent_failures
+        ],
+    })
+
 # ---------- Admin Plan Management ----------
 @app.route("/admin/plans")
 def admin_plans():
@@ -876,24 +3052,6 @@ def add_plan():
         description = request.form.get("description", "").strip()
         items = request.form.getlist("items")
         
-        # Handle image upload
-        image_filename = None
-        if 'image' in request.files:
-            file = request.files['image']
-            if file and file.filename != '' and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                # Add timestamp to avoid conflicts
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_")
-                image_filename = timestamp + filename
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], image_filename)
-                file.save(file_path)
-                
-                # Resize image
-                try:
-                    resize_image(file_path)
-                except Exception as e:
-                    print(f"Error resizing image: {e}")
-        
         # Validate inputs
         if not name or not daily_rate:
             flash("Name and daily rate are required", "error")
@@ -909,17 +3067,32 @@ def add_plan():
                                  plan=None, 
                                  areas=NAVI_MUMBAI_AREAS)
         
+        # Handle image upload (stored by content hash; sizes and formats are built by the image worker)
+        try:
+            image_filename = store_image_from_request()
+        except ValueError as e:
+            flash(str(e), "error")
+            return render_template("admin_plan_form.html", 
+                                 plan=None, 
+                                 areas=NAVI_MUMBAI_AREAS)
+        image_status, image_variants = stored_image_state(image_filename) if image_filename else (None, None)
+        
         # Create new plan
         plan = Plan(
             name=name,
             daily_rate=daily_rate,
             description=description,
             items=json.dumps(items) if items else None,
-            image_filename=image_filename
+            image_filename=image_filename,
+            image_status=image_status,
+            image_variants=image_variants
         )
         
         db.session.add(plan)
+        bump_customer_data_version()  # New plan on every customer's /plans page
         db.session.commit()
+        if image_status == "pending":
+            notify_image_worker()
         
         flash(f"Plan '{name}' created successfully!", "success")
         return redirect(url_for("admin_plans"))
@@ -950,35 +3123,68 @@ def edit_plan(plan_id):
         items = request.form.getlist("items")
         plan.items = json.dumps(items) if items else None
         
-        # Handle image upload
-        if 'image' in request.files:
-            file = request.files['image']
-            if file and file.filename != '' and allowed_file(file.filename):
-                # Delete old image if exists
-                if plan.image_filename:
-                    old_path = os.path.join(app.config['UPLOAD_FOLDER'], plan.image_filename)
-                    if os.path.exists(old_path):
-                        os.remove(old_path)
-                
-                # Save new image
-                filename = secure_filename(file.filename)
-                timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_")
-                plan.image_filename = timestamp + filename
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], plan.image_filename)
-                file.save(file_path)
-                
-                # Resize image
-                try:
-                    resize_image(file_path)
-                except Exception as e:
-                    print(f"Error resizing image: {e}")
+        # Handle image upload (stored by content hash; sizes and formats are built by the image worker)
+        try:
+            image_filename = store_image_from_request()
+        except ValueError as e:
+            flash(str(e), "error")
+            return render_template("admin_plan_form.html", 
+                                 plan=plan, 
+                                 areas=NAVI_MUMBAI_AREAS)
+        old_image = None
+        if image_filename:
+            old_image = (plan.image_filename, plan.image_variants)
+            image_status, image_variants = stored_image_state(image_filename)
+            plan.image_filename = image_filename
+            plan.image_status = image_status
+            plan.image_variants = image_variants
         
+        bump_customer_data_version()
         db.session.commit()
+        if old_image:
+            release_plan_image(*old_image)  # Deleted unless another plan uses the same image
+        if plan.image_status == "pending":
+            notify_image_worker()
         flash(f"Plan '{plan.name}' updated successfully!", "success")
         return redirect(url_for("admin_plans"))
     
     return render_template("admin_plan_form.html", plan=plan, areas=NAVI_MUMBAI_AREAS)
 
+@app.route("/admin/uploads", methods=["POST"])
+def start_image_upload():
+    """Open a resumable image upload: JSON {filename, size} -> {upload_id, chunk_size, received}"""
+    if not session.get("is_admin"):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        status = start_chunked_upload(secure_filename(str(data.get("filename", ""))), int(data.get("size", 0)))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(status), 201
+
+@app.route("/admin/uploads/<upload_id>", methods=["GET", "PUT"])
+def image_upload(upload_id):
+    """GET reports how much has been received; PUT appends the body at the `Upload-Offset` header"""
+    if not session.get("is_admin"):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    if request.method == "GET":
+        status = chunked_upload_status(upload_id)
+        return (jsonify(status), 200) if status else (jsonify({"error": "Unknown upload"}), 404)
+    
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        return jsonify({"error": "Upload-Offset header is required"}), 400
+    try:
+        status, appended = append_upload_chunk(upload_id, offset, request.stream)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 413
+    if status is None:
+        return jsonify({"error": "Unknown upload"}), 404
+    return jsonify(status), 200 if appended else 409
+
 @app.route("/admin/plans/delete/<int:plan_id>", methods=["POST"])
 def delete_plan(plan_id):
     if not session.get("is_admin"):
@@ -992,15 +3198,12 @@ def delete_plan(plan_id):
         flash(f"Cannot delete plan '{plan.name}' - it has {active_subscriptions} active subscriptions", "error")
         return redirect(url_for("admin_plans"))
     
-    # Delete image file if exists
-    if plan.image_filename:
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], plan.image_filename)
-        if os.path.exists(image_path):
-            os.remove(image_path)
-    
     plan_name = plan.name
+    old_image = (plan.image_filename, plan.image_variants)
     db.session.delete(plan)
+    bump_customer_data_version()
     db.session.commit()
+    release_plan_image(*old_image)  # Image files go unless another plan uses them
     
     flash(f"Plan '{plan_name}' deleted successfully!", "success")
     return redirect(url_for("admin_plans"))
@@ -1012,6 +3215,7 @@ def toggle_plan_status(plan_id):
     
     plan = Plan.query.get_or_404(plan_id)
     plan.is_active = not plan.is_active
+    bump_customer_data_version()
     db.session.commit()
     
     status = "activated" if plan.is_active else "deactivated"
@@ -1088,6 +3292,7 @@ def add_customer():
     )
     
     db.session.add(customer)
+    bump_rollup(date.today().year, date.today().month, customer.area, new_customers=1)
     db.session.commit()
     
     return jsonify({'success': True, 'message': 'Customer added successfully'})
@@ -1099,6 +3304,10 @@ def kitchen_report():
     if not session.get("is_admin"):
         return redirect(url_for("login"))
     
+    return render_kitchen_report()
+
+
+def render_kitchen_report():
     today = date.today()
     
     # Get all active plans for today
@@ -1227,60 +3436,132 @@ def delivery_routes():
 
 
 # ---------- Bill Management ----------
+BILLS_PER_PAGE = 25
+
+
+def get_bill_summary(current_year, current_month, force=False):
+    """
+    Billing totals and paid revenue per month for the bill management page.
+    Cached per billing month since it only changes when bills are generated or paid.
+    """
+    def compute():
+        is_overdue = bill_overdue_clause(current_year, current_month)
+        
+        # Calculate billing statistics in a single aggregate query
+        stats = db.session.query(
+            db.func.count(Bill.id),
+            db.func.sum(db.case((Bill.is_paid == True, 1), else_=0)),
+            db.func.sum(Bill.amount),
+            db.func.sum(db.case((Bill.is_paid == True, Bill.amount), else_=0)),
+            db.func.sum(db.case((is_overdue, 1), else_=0))
+        ).one()
+        
+        total_bills = stats[0] or 0
+        paid_bills = int(stats[1] or 0)
+        total_revenue = int(stats[2] or 0)
+        paid_amount = int(stats[3] or 0)
+        
+        bill_stats = {
+            'total_bills': total_bills,
+            'paid_bills': paid_bills,
+            'pending_bills': total_bills - paid_bills,
+            'total_revenue': total_revenue,
+            'paid_amount': paid_amount,
+            'pending_amount': total_revenue - paid_amount,
+            'overdue_count': int(stats[4] or 0),
+            'collection_rate': round((paid_bills / total_bills * 100) if total_bills > 0 else 0, 1)
+        }
+        
+        # Paid revenue per month for the chart
+        rows = db.session.query(
+            Bill.year,
+            Bill.month,
+            db.func.sum(Bill.amount)
+        ).filter(Bill.is_paid == True).group_by(Bill.year, Bill.month).order_by(Bill.year, Bill.month).all()
+        monthly_revenue = {f"{year}-{month:02d}": int(total or 0) for year, month, total in rows}
+        
+        return bill_stats, monthly_revenue
+
+    return cached_report(f"bills:summary:{current_year}-{current_month:02d}", compute, force=force)
+
+
+def bill_overdue_clause(current_year, current_month):
+    """Bills from a month before the current one that are still unpaid"""
+    return db.and_(
+        Bill.is_paid == False,
+        db.or_(
+            Bill.year < current_year,
+            db.and_(Bill.year == current_year, Bill.month < current_month)
+        )
+    )
+
+
 @app.route("/bills")
 def bill_management():
     if not session.get("is_admin"):
         return redirect(url_for("login"))
     
+    return render_bill_management()
+
+
+def render_bill_management():
     # Get current month and year
     current_month = date.today().month
     current_year = date.today().year
     
-    # Get all bills with customer information
-    bills = db.session.query(Bill, User).join(User).order_by(Bill.created_at.desc()).all()
-    
-    # Calculate billing statistics
-    total_bills = len(bills)
-    paid_bills = sum(1 for bill, user in bills if bill.is_paid)
-    pending_bills = total_bills - paid_bills
-    total_revenue = sum(bill.amount for bill, user in bills)
-    paid_amount = sum(bill.amount for bill, user in bills if bill.is_paid)
-    pending_amount = sum(bill.amount for bill, user in bills if not bill.is_paid)
-    
-    # Get monthly revenue data for chart
-    monthly_revenue = {}
-    for bill, user in bills:
-        if bill.is_paid:
-            month_key = f"{bill.year}-{bill.month:02d}"
-            if month_key not in monthly_revenue:
-                monthly_revenue[month_key] = 0
-            monthly_revenue[month_key] += bill.amount
+    # Table filters
+    page = request.args.get('page', 1, type=int)
+    per_page = min(request.args.get('per_page', BILLS_PER_PAGE, type=int), 100)
+    search = request.args.get('q', '').strip()
+    status = request.args.get('status', '')  # 'paid', 'pending' or '' for all
+    filter_month = request.args.get('month', type=int)
+    filter_year = request.args.get('year', type=int)
+    
+    # Cached aggregates; ?refresh=1 recomputes them now
+    bill_stats, monthly_revenue = get_bill_summary(
+        current_year, current_month, force=request.args.get('refresh') == '1'
+    )
     
     # Get recent payments (last 10)
-    recent_payments = [(bill, user) for bill, user in bills if bill.is_paid][:10]
+    recent_payments = db.session.query(Bill, User).join(User).filter(
+        Bill.is_paid == True
+    ).order_by(Bill.created_at.desc()).limit(10).all()
     
     # Get overdue bills (older than current month)
-    overdue_bills = []
-    for bill, user in bills:
-        if not bill.is_paid:
-            bill_date = date(bill.year, bill.month, 1)
-            current_date = date(current_year, current_month, 1)
-            if bill_date < current_date:
-                overdue_bills.append((bill, user))
-    
-    bill_stats = {
-        'total_bills': total_bills,
-        'paid_bills': paid_bills,
-        'pending_bills': pending_bills,
-        'total_revenue': total_revenue,
-        'paid_amount': paid_amount,
-        'pending_amount': pending_amount,
-        'overdue_count': len(overdue_bills),
-        'collection_rate': round((paid_bills / total_bills * 100) if total_bills > 0 else 0, 1)
+    overdue_bills = db.session.query(Bill, User).join(User).filter(
+        bill_overdue_clause(current_year, current_month)
+    ).order_by(Bill.year, Bill.month).limit(10).all()
+    
+    # Paginated bill list with customer information
+    bills_query = db.session.query(Bill, User).join(User)
+    
+    if search:
+        bills_query = bills_query.filter(User.fullname.ilike(f"%{search}%"))
+    if status == 'paid':
+        bills_query = bills_query.filter(Bill.is_paid == True)
+    elif status == 'pending':
+        bills_query = bills_query.filter(Bill.is_paid == False)
+    if filter_month:
+        bills_query = bills_query.filter(Bill.month == filter_month)
+    if filter_year:
+        bills_query = bills_query.filter(Bill.year == filter_year)
+    
+    pagination = bills_query.order_by(Bill.created_at.desc(), Bill.id.desc()).paginate(
+        page=page, per_page=per_page, error_out=False
+    )
+    
+    bill_filters = {
+        'q': search,
+        'status': status,
+        'month': filter_month,
+        'year': filter_year,
+        'per_page': per_page
     }
     
     return render_template("bill_management.html", 
-                         bills=bills,
+                         bills=pagination.items,
+                         pagination=pagination,
+                         bill_filters=bill_filters,
                          bill_stats=bill_stats,
                          monthly_revenue=monthly_revenue,
                          recent_payments=recent_payments,
@@ -1289,6 +3570,48 @@ def bill_management():
                          current_year=current_year)
 
 
+def calculate_month_bill(plans, pause_dates, year, month):
+    """
+    Itemized bill for one month from a customer's [(customer_plan, plan)] and sorted pause dates.
+    Each plan is charged its days in the month minus the pauses falling inside them.
+    """
+    first_day = date(year, month, 1)
+    last_day = date(year, month, monthrange(year, month)[1])
+    
+    items = []
+    for cp, plan in plans:
+        plan_start = max(cp.start_date, first_day)
+        plan_end = min(cp.end_date, last_day)
+        if plan_start > plan_end:
+            continue
+        
+        plan_days = (plan_end - plan_start).days + 1
+        plan_paused = bisect_right(pause_dates, plan_end) - bisect_left(pause_dates, plan_start)
+        items.append({
+            'plan_id': plan.id,
+            'plan_name': plan.name,
+            'start_date': plan_start,
+            'end_date': plan_end,
+            'days': plan_days,
+            'paused_days': plan_paused,
+            'billable_days': plan_days - plan_paused,
+            'daily_rate': plan.daily_rate,
+            'amount': (plan_days - plan_paused) * plan.daily_rate
+        })
+    
+    total_days = sum(item['days'] for item in items)
+    paused_days = sum(item['paused_days'] for item in items)
+    return {
+        'year': year,
+        'month': month,
+        'items': items,
+        'total_days': total_days,
+        'paused_days': paused_days,
+        'billable_days': total_days - paused_days,
+        'amount': sum(item['amount'] for item in items)
+    }
+
+
 @app.route("/bills/generate/<int:month>/<int:year>")
 def generate_monthly_bills(month, year):
     if not session.get("is_admin"):
@@ -1322,52 +3645,30 @@ def generate_monthly_bills(month, year):
         if not active_plans:
             continue
         
-        # Calculate total amount and actual plan days
-        total_amount = 0
-        actual_plan_days = 0
-        total_paused_days = 0
-        
-        # Calculate amount based on active plans
-        for cp, plan in active_plans:
-            # Calculate overlap days between plan and billing month
-            plan_start = max(cp.start_date, first_day)
-            plan_end = min(cp.end_date, last_day)
-            
-            if plan_start <= plan_end:  # Plan overlaps with this month
-                plan_days_in_month = (plan_end - plan_start).days + 1
-                actual_plan_days += plan_days_in_month
-                
-                # Get paused days for this specific plan period in this month
-                plan_paused = PausedDate.query.filter(
-                    PausedDate.customer_id == customer.id,
-                    PausedDate.pause_date >= plan_start,
-                    PausedDate.pause_date <= plan_end
-                ).count()
-                
-                total_paused_days += plan_paused
-                plan_billable_days = plan_days_in_month - plan_paused
-                total_amount += plan_billable_days * plan.daily_rate
-        
-        # Use actual plan days instead of month days
-        total_days = actual_plan_days
-        paused_days = total_paused_days
-        billable_days = total_days - paused_days
+        pause_dates = [pause_date for (pause_date,) in db.session.query(PausedDate.pause_date).filter(
+            PausedDate.customer_id == customer.id,
+            PausedDate.pause_date.between(first_day, last_day)
+        ).order_by(PausedDate.pause_date)]
+        month_bill = calculate_month_bill(active_plans, pause_dates, year, month)
         
         # Create bill
         bill = Bill(
             customer_id=customer.id,
             month=month,
             year=year,
-            total_days=total_days,
-            paused_days=paused_days,
-            billable_days=billable_days,
-            amount=total_amount,
+            total_days=month_bill['total_days'],
+            paused_days=month_bill['paused_days'],
+            billable_days=month_bill['billable_days'],
+            amount=month_bill['amount'],
             is_paid=False
         )
         
         db.session.add(bill)
+        bump_rollup(year, month, customer.area, bills_issued=1)
+        bump_customer_data_version(customer.id)
     
     db.session.commit()
+    invalidate_report_cache("bills:")
     flash(f"Bills generated for {month}/{year}", "success")
     return redirect(url_for("bill_management"))
 
@@ -1378,8 +3679,18 @@ def mark_bill_paid(bill_id):
         return redirect(url_for("login"))
     
     bill = Bill.query.get_or_404(bill_id)
+    newly_paid = not bill.is_paid
+    if newly_paid:
+        rollup_bill_paid(bill, customer_area(bill.customer_id))
     bill.is_paid = True
+    bump_customer_data_version(bill.customer_id)
     db.session.commit()
+    invalidate_report_cache("bills:")
+    
+    if newly_paid:
+        record_metric("payment.amount", bill.amount, method="manual", kind="bill")
+        if bill.created_at:
+            record_metric("payment.days_to_pay", (datetime.now() - bill.created_at).days)
     
     flash("Bill marked as paid", "success")
     return redirect(url_for("bill_management"))
@@ -1412,96 +3723,68 @@ def send_bill_reminders():
                 "failed": 0
             })
         
-        sent_count = 0
-        failed_count = 0
-        errors = []
+        # One reminder per bill per day - skip bills already reminded today.
+        # Match on the same dedupe keys we insert so the check and the unique
+        # constraint always agree on what "today" means
+        today = date.today()
+        dedupe_keys = {bill.id: f"bill_reminder:{bill.id}:{today.isoformat()}" for bill, _ in unpaid_bills}
+        reminded_today = {
+            key for (key,) in db.session.query(EmailOutbox.dedupe_key).filter(
+                EmailOutbox.dedupe_key.in_(list(dedupe_keys.values()))
+            )
+        }
+        
+        queued_count = 0
+        skipped_count = 0
+        login_url = f"{request.url_root}login"
         
         for bill, user in unpaid_bills:
+            if dedupe_keys[bill.id] in reminded_today:
+                skipped_count += 1
+                continue
+            
             # Prepare email content
             subject = f"Payment Reminder - TiffinTrack Bill for {bill.month}/{bill.year}"
+            html_body, text_body = render_email("bill_reminder", user=user, bill=bill, login_url=login_url)
             
-            html_body = f"""
-            <html>
-            <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
-                <div style="max-width: 600px; margin: 0 auto; padding: 20px;">
-                    <h2 style="color: #ff6b35;">Payment Reminder</h2>
-                    <p>Dear {user.fullname},</p>
-                    <p>This is a friendly reminder that you have an unpaid bill for your TiffinTrack meal service.</p>
-                    
-                    <div style="background: #f5f5f5; padding: 15px; border-radius: 8px; margin: 20px 0;">
-                        <h3 style="margin-top: 0;">Bill Details:</h3>
-                        <p><strong>Bill Period:</strong> {bill.month}/{bill.year}</p>
-                        <p><strong>Amount Due:</strong> ₹{bill.amount}</p>
-                        <p><strong>Days:</strong> {bill.billable_days} days</p>
-                    </div>
-                    
-                    <p>Please log in to your account to make the payment:</p>
-                    <p style="text-align: center; margin: 30px 0;">
-                        <a href="{request.url_root}login" 
-                           style="background: #ff6b35; color: white; padding: 12px 30px; text-decoration: none; border-radius: 5px; display: inline-block;">
-                            Pay Now
-                        </a>
-                    </p>
-                    
-                    <p>If you have already made the payment, please disregard this reminder.</p>
-                    <p>Thank you for choosing TiffinTrack!</p>
-                    
-                    <hr style="border: none; border-top: 1px solid #ddd; margin: 30px 0;">
-                    <p style="font-size: 12px; color: #666;">
-                        TiffinTrack - Fresh, Healthy Meals Delivered Daily<br>
-                        This is an automated reminder. Please do not reply to this email.
-                    </p>
-                </div>
-            </body>
-            </html>
-            """
-            
-            text_body = f"""
-            Payment Reminder - TiffinTrack
-            
-            Dear {user.fullname},
-            
-            This is a friendly reminder that you have an unpaid bill for your TiffinTrack meal service.
-            
-            Bill Details:
-            - Period: {bill.month}/{bill.year}
-            - Amount Due: ₹{bill.amount}
-            - Days: {bill.billable_days} days
-            
-            Please log in to your account to make the payment: {request.url_root}login
-            
-            If you have already made the payment, please disregard this reminder.
-            
-            Thank you for choosing TiffinTrack!
-            """
-            
-            # Send email
-            success, error = send_email(user.email, subject, html_body, text_body)
-            
-            if success:
-                sent_count += 1
-            else:
-                failed_count += 1
-                errors.append(f"{user.fullname} ({user.email}): {error}")
-                print(f"Failed to send reminder to {user.email}: {error}")
+            enqueue_email(
+                user.email, subject, html_body, text_body,
+                kind="bill_reminder",
+                customer_id=user.id,
+                bill_id=bill.id,
+                dedupe_key=dedupe_keys[bill.id]
+            )
+            queued_count += 1
+        
+        # Delivery happens in the background worker, with retries
+        db.session.commit()
+        if queued_count:
+            notify_email_worker()
         
         # Prepare response message
-        if sent_count > 0 and failed_count == 0:
-            message = f"Successfully sent {sent_count} reminder(s)!"
-        elif sent_count > 0 and failed_count > 0:
-            message = f"Sent {sent_count} reminder(s), but {failed_count} failed"
+        if queued_count > 0 and skipped_count == 0:
+            message = f"Queued {queued_count} reminder(s) for delivery!"
+        elif queued_count > 0:
+            message = f"Queued {queued_count} reminder(s); {skipped_count} customer(s) were already reminded today"
         else:
-            message = f"Failed to send all {failed_count} reminder(s)"
+            message = f"All {skipped_count} customer(s) with unpaid bills were already reminded today"
         
         return jsonify({
-            "success": sent_count > 0,
+            "success": True,
             "message": message,
-            "sent": sent_count,
-            "failed": failed_count,
-            "errors": errors[:5] if errors else []  # Return first 5 errors
+            "queued": queued_count,
+            "skipped": skipped_count
         })
         
+    except IntegrityError:
+        # Another request queued the same reminders between our check and commit
+        db.session.rollback()
+        return jsonify({
+            "success": False,
+            "error": "Reminders are already being queued by another request. Please refresh and try again."
+        }), 409
     except Exception as e:
+        db.session.rollback()
         print(f"Error sending reminders: {e}")
         return jsonify({
             "success": False,
@@ -1509,6 +3792,111 @@ def send_bill_reminders():
         }), 500
 
 
+BILL_EXPORT_HEADER = [
+    'Bill ID',
+    'Customer Name',
+    'Customer Email',
+    'Customer Phone',
+    'Customer Area',
+    'Month',
+    'Year',
+    'Total Days',
+    'Paused Days',
+    'Billable Days',
+    'Amount (₹)',
+    'Status',
+    'Created Date',
+    'Payment Date'
+]
+BILL_EXPORT_BATCH_SIZE = 1000
+
+
+def bill_export_query(month=None, year=None, status=None):
+    """Build the column query behind bill exports, applying the export filters"""
+    # Latest successful Stripe payment per bill (bills paid at plan checkout have none)
+    paid_at = db.session.query(
+        Payment.bill_id.label('bill_id'),
+        db.func.max(Payment.updated_at).label('paid_at')
+    ).filter(Payment.status == 'succeeded').group_by(Payment.bill_id).subquery()
+    
+    query = db.session.query(
+        Bill.id,
+        User.fullname,
+        User.email,
+        User.phone,
+        User.area,
+        Bill.month,
+        Bill.year,
+        Bill.total_days,
+        Bill.paused_days,
+        Bill.billable_days,
+        Bill.amount,
+        Bill.is_paid,
+        Bill.created_at,
+        paid_at.c.paid_at
+    ).select_from(Bill).join(User, Bill.customer_id == User.id).outerjoin(
+        paid_at, paid_at.c.bill_id == Bill.id
+    )
+    
+    if month:
+        query = query.filter(Bill.month == month)
+    if year:
+        query = query.filter(Bill.year == year)
+    if status == 'paid':
+        query = query.filter(Bill.is_paid == True)
+    elif status == 'unpaid':
+        query = query.filter(Bill.is_paid == False)
+    
+    return query.order_by(Bill.created_at.desc(), Bill.id.desc())
+
+
+def generate_bills_csv(query, batch_size=BILL_EXPORT_BATCH_SIZE):
+    """Yield CSV chunks for the export query, streaming rows from a server-side cursor"""
+    import csv
+    from io import StringIO
+    
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    
+    def flush():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return chunk
+    
+    # Send the header straight away so the download starts before the query runs
+    writer.writerow(BILL_EXPORT_HEADER)
+    yield flush()
+    
+    rows_in_chunk = 0
+    for row in query.yield_per(batch_size):
+        (bill_id, fullname, email, phone, area, month, year, total_days,
+         paused_days, billable_days, amount, is_paid, created_at, paid_at) = row
+        writer.writerow([
+            bill_id,
+            fullname,
+            email,
+            phone,
+            area,
+            month,
+            year,
+            total_days,
+            paused_days,
+            billable_days,
+            amount,
+            'Paid' if is_paid else 'Unpaid',
+            created_at.strftime('%Y-%m-%d %H:%M:%S') if created_at else '',
+            paid_at.strftime('%Y-%m-%d %H:%M:%S') if is_paid and paid_at else ''
+        ])
+        rows_in_chunk += 1
+        if rows_in_chunk >= batch_size:
+            yield flush()
+            rows_in_chunk = 0
+    
+    if rows_in_chunk:
+        yield flush()
+
+
 @app.route("/bills/export")
 def export_bills():
     """Export billing data to CSV"""
@@ -1516,82 +3904,280 @@ def export_bills():
         return redirect(url_for("login"))
     
     try:
-        import csv
-        from io import StringIO
-        
         # Get filter parameters
         month = request.args.get('month', type=int)
         year = request.args.get('year', type=int)
         status = request.args.get('status')  # 'paid', 'unpaid', or 'all'
         
-        # Build query
-        query = db.session.query(Bill, User).join(User)
+        query = bill_export_query(month, year, status)
+        filename = f"tiffintrack_bills_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        
+        return Response(
+            stream_with_context(generate_bills_csv(query)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        )
         
+    except Exception as e:
+        print(f"Error exporting bills: {e}")
+        flash("Failed to export bills", "error")
+        return redirect(url_for("bill_management"))
+
+
+COLUMNAR_EXPORT_DATASETS = ("bills", "payments", "pauses")
+COLUMNAR_EXPORT_FORMATS = {
+    "parquet": ("parquet", "application/vnd.apache.parquet"),
+    "arrow": ("arrow", "application/vnd.apache.arrow.file"),
+}
+
+
+def columnar_export_spec(dataset, month=None, year=None, status=None):
+    """
+    Describe a columnar export: the Arrow schema, the query feeding it, a function
+    turning a query row into a record in schema order, and the month partition key.
+    Rows come back ordered by that key so partitions can be written one at a time.
+    """
+    import pyarrow as pa
+    
+    if dataset == "bills":
+        schema = pa.schema([
+            ("bill_id", pa.int64()),
+            ("customer_id", pa.int64()),
+            ("customer_name", pa.string()),
+            ("customer_email", pa.string()),
+            ("customer_area", pa.string()),
+            ("billing_month", pa.date32()),
+            ("month", pa.int8()),
+            ("year", pa.int16()),
+            ("total_days", pa.int16()),
+            ("paused_days", pa.int16()),
+            ("billable_days", pa.int16()),
+            ("amount", pa.int64()),
+            ("is_paid", pa.bool_()),
+            ("created_at", pa.timestamp("s")),
+        ])
+        query = db.session.query(
+            Bill.id, Bill.customer_id, User.fullname, User.email, User.area,
+            Bill.month, Bill.year, Bill.total_days, Bill.paused_days,
+            Bill.billable_days, Bill.amount, Bill.is_paid, Bill.created_at
+        ).select_from(Bill).join(User, Bill.customer_id == User.id)
         if month:
             query = query.filter(Bill.month == month)
         if year:
             query = query.filter(Bill.year == year)
-        if status == 'paid':
+        if status == "paid":
             query = query.filter(Bill.is_paid == True)
-        elif status == 'unpaid':
+        elif status == "unpaid":
             query = query.filter(Bill.is_paid == False)
+        query = query.order_by(Bill.year, Bill.month, Bill.id)
+        
+        def to_record(row):
+            bill_id, customer_id, name, email, area, m, y, total, paused, billable, amount, is_paid, created = row
+            return (bill_id, customer_id, name, email, area, date(y, m, 1), m, y,
+                    total, paused, billable, amount, bool(is_paid), created)
         
-        bills = query.order_by(Bill.created_at.desc()).all()
+        def partition_key(record):
+            return record[5].strftime("%Y-%m")
+    
+    elif dataset == "payments":
+        schema = pa.schema([
+            ("payment_id", pa.int64()),
+            ("bill_id", pa.int64()),
+            ("customer_id", pa.int64()),
+            ("customer_name", pa.string()),
+            ("customer_area", pa.string()),
+            ("billing_month", pa.date32()),
+            ("stripe_payment_intent_id", pa.string()),
+            ("amount_paise", pa.int64()),
+            ("currency", pa.string()),
+            ("status", pa.string()),
+            ("payment_method", pa.string()),
+            ("created_at", pa.timestamp("s")),
+            ("updated_at", pa.timestamp("s")),
+        ])
+        query = db.session.query(
+            Payment.id, Payment.bill_id, Payment.customer_id, User.fullname, User.area,
+            Bill.month, Bill.year, Payment.stripe_payment_intent_id, Payment.amount,
+            Payment.currency, Payment.status, Payment.payment_method,
+            Payment.created_at, Payment.updated_at
+        ).select_from(Payment).join(User, Payment.customer_id == User.id).join(Bill, Payment.bill_id == Bill.id)
+        if month:
+            query = query.filter(Bill.month == month)
+        if year:
+            query = query.filter(Bill.year == year)
+        if status == "paid":
+            query = query.filter(Payment.status == "succeeded")
+        elif status == "unpaid":
+            query = query.filter(Payment.status != "succeeded")
+        query = query.order_by(Bill.year, Bill.month, Payment.id)
         
-        # Create CSV
-        output = StringIO()
-        writer = csv.writer(output)
+        def to_record(row):
+            (payment_id, bill_id, customer_id, name, area, m, y, intent_id, amount,
+             currency, payment_status, method, created, updated) = row
+            return (payment_id, bill_id, customer_id, name, area, date(y, m, 1), intent_id,
+                    amount, currency, payment_status, method, created, updated)
         
-        # Write header
-        writer.writerow([
-            'Bill ID',
-            'Customer Name',
-            'Customer Email',
-            'Customer Phone',
-            'Customer Area',
-            'Month',
-            'Year',
-            'Total Days',
-            'Paused Days',
-            'Billable Days',
-            'Amount (₹)',
-            'Status',
-            'Created Date',
-            'Payment Date'
+        def partition_key(record):
+            return record[5].strftime("%Y-%m")
+    
+    elif dataset == "pauses":
+        schema = pa.schema([
+            ("pause_id", pa.int64()),
+            ("customer_id", pa.int64()),
+            ("customer_name", pa.string()),
+            ("customer_area", pa.string()),
+            ("pause_date", pa.date32()),
+            ("created_at", pa.timestamp("s")),
         ])
+        query = db.session.query(
+            PausedDate.id, PausedDate.customer_id, User.fullname, User.area,
+            PausedDate.pause_date, PausedDate.created_at
+        ).select_from(PausedDate).join(User, PausedDate.customer_id == User.id)
+        if year:
+            first_day = date(year, month or 1, 1)
+            last_day = date(year, month or 12, monthrange(year, month or 12)[1])
+            query = query.filter(PausedDate.pause_date >= first_day, PausedDate.pause_date <= last_day)
+        query = query.order_by(PausedDate.pause_date, PausedDate.id)
         
-        # Write data
-        for bill, user in bills:
-            writer.writerow([
-                bill.id,
-                user.fullname,
-                user.email,
-                user.phone,
-                user.area,
-                bill.month,
-                bill.year,
-                bill.total_days,
-                bill.paused_days,
-                bill.billable_days,
-                bill.amount,
-                'Paid' if bill.is_paid else 'Unpaid',
-                bill.created_at.strftime('%Y-%m-%d %H:%M:%S') if bill.created_at else '',
-                bill.updated_at.strftime('%Y-%m-%d %H:%M:%S') if bill.is_paid and bill.updated_at else ''
-            ])
-        
-        # Prepare response
-        output.seek(0)
-        filename = f"tiffintrack_bills_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv"
+        def to_record(row):
+            return tuple(row)
         
-        return Response(
-            output.getvalue(),
-            mimetype='text/csv',
-            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        def partition_key(record):
+            return record[4].strftime("%Y-%m")
+    
+    else:
+        raise ValueError(f"Unknown export dataset: {dataset}")
+    
+    return schema, query, to_record, partition_key
+
+
+def write_columnar_export(dataset, file_format, target_dir, month=None, year=None, status=None,
+                          partition_by_month=False, batch_size=BILL_EXPORT_BATCH_SIZE):
+    """
+    Write an export into `target_dir` one row group per batch and return the written paths.
+    With `partition_by_month`, files are laid out Hive-style as billing_month=YYYY-MM/part-0.<ext>.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    schema, query, to_record, partition_key = columnar_export_spec(dataset, month, year, status)
+    extension = COLUMNAR_EXPORT_FORMATS[file_format][0]
+    
+    def open_writer(path):
+        if file_format == "parquet":
+            return pq.ParquetWriter(path, schema, compression="zstd")
+        return pa.ipc.new_file(path, schema)
+    
+    def write_batch(writer, records):
+        columns = list(zip(*records))
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema
         )
+        if file_format == "parquet":
+            writer.write_batch(batch, row_group_size=batch_size)
+        else:
+            writer.write_batch(batch)
+    
+    paths = []
+    writer = None
+    current_key = None
+    records = []
+    
+    try:
+        for row in query.yield_per(batch_size):
+            record = to_record(row)
+            key = partition_key(record) if partition_by_month else None
+            
+            if writer is None or key != current_key:
+                if records:
+                    write_batch(writer, records)
+                    records = []
+                if writer is not None:
+                    writer.close()
+                if partition_by_month:
+                    partition_dir = os.path.join(target_dir, f"billing_month={key}")
+                    os.makedirs(partition_dir, exist_ok=True)
+                    path = os.path.join(partition_dir, f"part-0.{extension}")
+                else:
+                    path = os.path.join(target_dir, f"{dataset}.{extension}")
+                writer = open_writer(path)
+                paths.append(path)
+                current_key = key
+            
+            records.append(record)
+            if len(records) >= batch_size:
+                write_batch(writer, records)
+                records = []
+        
+        if writer is None:
+            # No rows matched - still produce a valid, empty file with the schema
+            path = os.path.join(target_dir, f"{dataset}.{extension}")
+            writer = open_writer(path)
+            paths.append(path)
+        elif records:
+            write_batch(writer, records)
+    finally:
+        if writer is not None:
+            writer.close()
+    
+    return paths
+
+
+@app.route("/bills/export/columnar")
+def export_bills_columnar():
+    """Export bills, payments or pauses as typed Parquet/Arrow files for finance"""
+    if not session.get("is_admin"):
+        return redirect(url_for("login"))
+    
+    import shutil
+    import tempfile
+    import zipfile
+    
+    dataset = request.args.get('dataset', 'bills')
+    file_format = request.args.get('format', 'parquet')
+    month = request.args.get('month', type=int)
+    year = request.args.get('year', type=int)
+    status = request.args.get('status')
+    partition_by_month = request.args.get('partition') == 'month'
+    
+    if dataset not in COLUMNAR_EXPORT_DATASETS or file_format not in COLUMNAR_EXPORT_FORMATS:
+        flash("Unsupported export type", "error")
+        return redirect(url_for("bill_management"))
+    
+    try:
+        extension, mimetype = COLUMNAR_EXPORT_FORMATS[file_format]
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        
+        with tempfile.TemporaryDirectory() as work_dir:
+            paths = write_columnar_export(
+                dataset, file_format, work_dir,
+                month=month, year=year, status=status,
+                partition_by_month=partition_by_month
+            )
+            
+            # The temp file is removed once the response has been sent
+            output = tempfile.TemporaryFile()
+            if partition_by_month:
+                with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as archive:
+                    for path in paths:
+                        archive.write(path, os.path.relpath(path, work_dir))
+                mimetype = "application/zip"
+                download_name = f"tiffintrack_{dataset}_{timestamp}.zip"
+            else:
+                with open(paths[0], "rb") as exported:
+                    shutil.copyfileobj(exported, output)
+                download_name = f"tiffintrack_{dataset}_{timestamp}.{extension}"
+            output.seek(0)
         
+        return send_file(output, mimetype=mimetype, as_attachment=True, download_name=download_name)
+    
+    except ImportError:
+        flash("Columnar export requires pyarrow. Please install it with pip install pyarrow.", "error")
+        return redirect(url_for("bill_management"))
     except Exception as e:
-        print(f"Error exporting bills: {e}")
-        flash("Failed to export bills", "error")
+        print(f"Error exporting {dataset}: {e}")
+        flash("Failed to export data", "error")
         return redirect(url_for("bill_management"))
 
 
@@ -1622,153 +4208,107 @@ def pay_bill(bill_id):
 
 
 # ---------- Analytics Dashboard ----------
-@app.route("/analytics")
-def analytics_dashboard():
-    if not session.get("is_admin"):
-        return redirect(url_for("login"))
-    
-    # Get date range (default to last 30 days)
-    end_date = date.today()
-    start_date = end_date - timedelta(days=30)
-    date_range = f"{start_date.strftime('%B %d')} - {end_date.strftime('%B %d, %Y')}"
-    
-    # Calculate key metrics
-    total_customers = User.query.filter_by(is_admin=False).count()
-    active_customers = db.session.query(CustomerPlan).filter(
-        CustomerPlan.is_active == True,
-        CustomerPlan.end_date >= date.today()
-    ).distinct(CustomerPlan.customer_id).count()
+def rollup_summary(end_date):
+    """
+    One scan of the monthly rollups, aggregated for the dashboard's KPIs and widgets.
+    Its size depends on months x areas x plans rather than on raw table sizes.
+    """
+    current_key = (end_date.year, end_date.month)
+    rollup_rows = db.session.query(
+        MonthlyRollup.year,
+        MonthlyRollup.month,
+        MonthlyRollup.area,
+        Plan.name,
+        MonthlyRollup.revenue,
+        MonthlyRollup.payments,
+        MonthlyRollup.bills_issued,
+        MonthlyRollup.new_customers,
+        MonthlyRollup.active_plans
+    ).outerjoin(Plan, Plan.id == MonthlyRollup.plan_id).all()
+    
+    summary = {
+        'revenue_by_month': defaultdict(int),
+        'new_customers_by_month': defaultdict(int),
+        'area_customers': defaultdict(int),
+        'area_revenue': defaultdict(int),  # Current month
+        'plan_counts': defaultdict(int),  # Plans running this month
+        'bills_issued': 0,
+        'payments': 0
+    }
     
-    # Revenue calculations
-    total_revenue = db.session.query(db.func.sum(Bill.amount)).filter(
-        Bill.is_paid == True
-    ).scalar() or 0
+    for (year, month, area, plan_name, revenue, payments, bills_issued,
+         new_customers, active_plans) in rollup_rows:
+        summary['revenue_by_month'][(year, month)] += revenue
+        summary['new_customers_by_month'][(year, month)] += new_customers
+        summary['bills_issued'] += bills_issued
+        summary['payments'] += payments
+        if new_customers:
+            summary['area_customers'][area] += new_customers
+        if (year, month) == current_key:
+            summary['area_revenue'][area] += revenue
+            if plan_name and active_plans:
+                summary['plan_counts'][plan_name] += active_plans
     
-    monthly_revenue = db.session.query(db.func.sum(Bill.amount)).filter(
-        Bill.is_paid == True,
-        Bill.month == end_date.month,
-        Bill.year == end_date.year
-    ).scalar() or 0
+    return summary
+
+
+def compute_analytics_report(start_date, end_date):
+    """Headline figures on the analytics dashboard for the period [start_date, end_date]"""
+    current_key = (end_date.year, end_date.month)
+    prev_key = month_sequence(end_date, 2)[0]
     
-    # Calculate growth rates (comparing to previous period)
-    prev_month = end_date.month - 1 if end_date.month > 1 else 12
-    prev_year = end_date.year if end_date.month > 1 else end_date.year - 1
+    summary = rollup_summary(end_date)
+    revenue_by_month = summary['revenue_by_month']
     
-    prev_monthly_revenue = db.session.query(db.func.sum(Bill.amount)).filter(
-        Bill.is_paid == True,
-        Bill.month == prev_month,
-        Bill.year == prev_year
-    ).scalar() or 0
+    # Revenue calculations
+    total_revenue = sum(revenue_by_month.values())
+    monthly_revenue = revenue_by_month.get(current_key, 0)
+    prev_monthly_revenue = revenue_by_month.get(prev_key, 0)
     
     revenue_growth = round(((monthly_revenue - prev_monthly_revenue) / prev_monthly_revenue * 100) if prev_monthly_revenue > 0 else 0, 1)
     
-    # Customer growth
-    prev_month_customers = db.session.query(CustomerPlan).filter(
-        CustomerPlan.created_at < date(end_date.year, end_date.month, 1)
-    ).distinct(CustomerPlan.customer_id).count()
-    
-    customer_growth = round(((active_customers - prev_month_customers) / prev_month_customers * 100) if prev_month_customers > 0 else 0, 1)
-    
-    # Meal statistics
-    total_meals = db.session.query(CustomerPlan).filter(
-        CustomerPlan.is_active == True
-    ).count() * 30  # Approximate monthly meals
+    total_customers = sum(summary['area_customers'].values())
     
-    meals_growth = 12.5  # Mock data
-    
-    avg_order_value = round(total_revenue / total_customers if total_customers > 0 else 0, 2)
+    # Distinct customers with a running plan now, and with any plan before this month
+    month_start = date(end_date.year, end_date.month, 1)
+    active_customers, prev_month_customers = db.session.query(
+        db.func.count(db.distinct(db.case(
+            (db.and_(CustomerPlan.is_active == True, CustomerPlan.end_date >= end_date), CustomerPlan.customer_id)
+        ))),
+        db.func.count(db.distinct(db.case(
+            (CustomerPlan.created_at < month_start, CustomerPlan.customer_id)
+        )))
+    ).one()
     
-    # Plan popularity
-    plan_popularity = db.session.query(
-        Plan.name, 
-        db.func.count(CustomerPlan.id).label('count')
-    ).select_from(Plan).join(CustomerPlan, Plan.id == CustomerPlan.plan_id).filter(
-        CustomerPlan.is_active == True
-    ).group_by(Plan.name).all()
-    
-    # Create plan distribution data for charts
-    plan_labels = [plan_name for plan_name, count in plan_popularity]
-    plan_data = [count for plan_name, count in plan_popularity]
-    total_plans = sum(plan_data) if plan_data else 1
-    plan_distribution = [
-        {
-            'name': plan_name,
-            'percentage': round((count / total_plans) * 100, 1),
-            'color': ['#ff6b35', '#4ecdc4', '#ffd54f', '#3b82f6'][i % 4]
-        }
-        for i, (plan_name, count) in enumerate(plan_popularity)
-    ]
+    customer_growth = round(((active_customers - prev_month_customers) / prev_month_customers * 100) if prev_month_customers > 0 else 0, 1)
     
-    # Area-wise distribution
-    area_distribution = db.session.query(
-        User.area,
-        db.func.count(User.id).label('count')
-    ).filter(User.is_admin == False).group_by(User.area).all()
-    
-    # Create area performance data
-    area_performance = []
-    total_area_revenue = sum(monthly_revenue / len(area_distribution) for area, count in area_distribution) if area_distribution else 0
-    
-    for area, count in area_distribution:
-        area_revenue = (monthly_revenue / len(area_distribution)) if area_distribution else 0
-        area_performance.append({
-            'name': area,
-            'customers': count,
-            'revenue': round(area_revenue),
-            'percentage': round((area_revenue / monthly_revenue * 100) if monthly_revenue > 0 else 0, 1)
-        })
+    # Meal statistics from the daily facts, against the period just before
+    period = daily_fact_totals(start_date, end_date)
+    previous_period = daily_fact_totals(start_date - (end_date - start_date) - timedelta(days=1), start_date - timedelta(days=1))
     
-    # Monthly revenue trend (last 6 months)
-    revenue_trend = []
-    revenue_labels = []
-    revenue_data = []
-    
-    for i in range(6):
-        month_date = end_date - timedelta(days=30*i)
-        month_revenue = db.session.query(db.func.sum(Bill.amount)).filter(
-            Bill.is_paid == True,
-            Bill.month == month_date.month,
-            Bill.year == month_date.year
-        ).scalar() or 0
-        revenue_trend.append({
-            'month': month_date.strftime('%B'),
-            'revenue': month_revenue
-        })
-        revenue_labels.append(month_date.strftime('%b'))
-        revenue_data.append(month_revenue)
+    total_meals = period['delivered_meals']
+    previous_meals = previous_period['delivered_meals']
+    meals_growth = round(((total_meals - previous_meals) / previous_meals * 100) if previous_meals > 0 else 0, 1)
     
-    revenue_trend.reverse()
-    revenue_labels.reverse()
-    revenue_data.reverse()
+    avg_order_value = round(total_revenue / total_customers if total_customers > 0 else 0, 2)
     
-    # Customer growth data (last 6 months)
-    customer_labels = []
-    customer_data = []
+    # Cohort retention: share of each cohort still on a plan the month after their first
+    retained = [(cohort['size'], cohort['retention'][1]) for cohort in cohort_retention_matrix() if len(cohort['retention']) > 1]
+    retained_size = sum(size for size, _ in retained)
+    retention_rate = round(sum(size * rate for size, rate in retained) / retained_size if retained_size > 0 else 0, 1)
+    first_active = period['first_active_customers']
+    retention_growth = round(((period['last_active_customers'] - first_active) / first_active * 100) if first_active > 0 else 0, 1)
     
-    for i in range(6):
-        month_date = end_date - timedelta(days=30*i)
-        new_customers = User.query.filter(
-            User.is_admin == False,
-            db.extract('month', User.created_at) == month_date.month,
-            db.extract('year', User.created_at) == month_date.year
-        ).count()
-        customer_labels.append(month_date.strftime('%b'))
-        customer_data.append(new_customers)
-    
-    customer_labels.reverse()
-    customer_data.reverse()
-    
-    # Customer retention rate
-    total_active_plans = CustomerPlan.query.filter_by(is_active=True).count()
-    retention_rate = round((total_active_plans / total_customers * 100) if total_customers > 0 else 0, 1)
-    retention_growth = 5.2  # Mock data
-    
-    # Operational metrics (mock data for demonstration)
+    # Operational metrics (delivery success and satisfaction are not tracked yet)
     delivery_success_rate = 96.8
-    pause_rate = 8.5
+    pause_rate = round((period['paused_meals'] / period['scheduled_meals'] * 100) if period['scheduled_meals'] > 0 else 0, 1)
     customer_satisfaction = 4.7
-    food_waste = 15.2
-    collection_efficiency = round((db.session.query(Bill).filter_by(is_paid=True).count() / db.session.query(Bill).count() * 100) if db.session.query(Bill).count() > 0 else 0, 1)
+    # Meals paused after the cutoff were already cooked, so they are wasted
+    food_waste = round((period['late_paused_meals'] / period['scheduled_meals'] * 100) if period['scheduled_meals'] > 0 else 0, 1)
+    collection_efficiency = round((summary['payments'] / summary['bills_issued'] * 100) if summary['bills_issued'] > 0 else 0, 1)
+    
+    # Forecasts from scheduled plans and weekday pause history
+    projections = revenue_projection_summary()
     
     # AI-powered insights (mock data)
     insights = [
@@ -1822,17 +4362,6 @@ def analytics_dashboard():
         'total_meals': total_meals,
         'meals_growth': meals_growth,
         'avg_order_value': avg_order_value,
-        'plan_popularity': plan_popularity,
-        'plan_distribution': plan_distribution,
-        'plan_labels': plan_labels,
-        'plan_data': plan_data,
-        'area_distribution': area_distribution,
-        'area_performance': area_performance,
-        'revenue_trend': revenue_trend,
-        'revenue_labels': revenue_labels,
-        'revenue_data': revenue_data,
-        'customer_labels': customer_labels,
-        'customer_data': customer_data,
         'retention_rate': retention_rate,
         'retention_growth': retention_growth,
         'total_customers': total_customers,
@@ -1841,124 +4370,713 @@ def analytics_dashboard():
         'customer_satisfaction': customer_satisfaction,
         'food_waste': food_waste,
         'collection_efficiency': collection_efficiency,
-        'insights': insights
+        'projections': projections,
+        'insights': insights,
+        'generated_at': datetime.now()
     }
     
+    return analytics_data
+
+
+@app.route("/analytics")
+def analytics_dashboard():
+    if not session.get("is_admin"):
+        return redirect(url_for("login"))
+    
+    return render_analytics_dashboard()
+
+
+def render_analytics_dashboard(widgets=None):
+    """Render the analytics page; `widgets` inlines widget data instead of fetching it (for snapshots)"""
+    # Get date range (default to last 30 days)
+    end_date = date.today()
+    start_date = end_date - timedelta(days=30)
+    date_range = f"{start_date.strftime('%B %d')} - {end_date.strftime('%B %d, %Y')}"
+    
+    # Served from the report cache (stale-while-revalidate); ?refresh=1 recomputes now
+    # Charts and tables load from /api/analytics/<widget> once the page is up
+    analytics_data = cached_report(
+        f"analytics:{start_date.isoformat()}:{end_date.isoformat()}",
+        lambda: compute_analytics_report(start_date, end_date),
+        force=request.args.get('refresh') == '1'
+    )
+    
     return render_template("analytics.html", 
                          analytics=analytics_data,
-                         date_range=date_range)
+                         date_range=date_range,
+                         widgets=widgets)
 
 
-@app.route("/dashboard")
-@db_retry(max_retries=3, delay=1)
-def customer_dashboard():
-    if "user_id" not in session or session.get("is_admin"):
-        return redirect(url_for("login"))
+# Tables behind each analytics widget; their versions drive the API's ETags
+ANALYTICS_SOURCES = {
+    "rollups": MonthlyRollup,
+    "cohorts": CohortRetention,
+}
+# The Activity card reads the metrics store, which changes with every flush; it has no cheap
+# version, so it is served from the report cache for this long instead of revalidated
+ANALYTICS_ACTIVITY_TTL = int(os.getenv("ANALYTICS_ACTIVITY_TTL", "60"))
+
+PLAN_COLORS = ['#ff6b35', '#4ecdc4', '#ffd54f', '#3b82f6']
+
+
+def analytics_source_version(sources):
+    """ETag and Last-Modified for data read from `sources` today"""
+    parts = [date.today().isoformat()]
+    last_modified = datetime.combine(date.today(), time.min)
     
-    customer_id = session["user_id"]
+    for name in sources:
+        model = ANALYTICS_SOURCES[name]
+        counter = db.func.sum(model.version) if hasattr(model, "version") else db.literal(0)
+        count, changed_at, total = db.session.query(
+            db.func.count(model.id), db.func.max(model.updated_at), db.func.coalesce(counter, 0)
+        ).one()
+        parts.append(f"{name}:{count}:{total}:{changed_at}")
+        if changed_at and changed_at > last_modified:
+            last_modified = changed_at
     
-    # Check for payment success message
-    payment_success = request.args.get('payment') == 'success'
-    recent_payment = None
+    etag = hashlib.sha1("|".join(parts).encode()).hexdigest()
+    return etag, last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+
+
+def client_copy_is_current(etag, last_modified):
+    """True when the request's If-None-Match (or, without one, If-Modified-Since) matches"""
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    return bool(last_modified and request.if_modified_since and last_modified <= request.if_modified_since)
+
+
+def set_revalidation_headers(response, etag, last_modified):
+    """Let the browser keep its copy but revalidate it on every use"""
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditional_json(etag, last_modified, build):
+    """JSON response that answers 304 without calling `build()` when the client's copy is current"""
+    response = Response(status=304) if client_copy_is_current(etag, last_modified) else jsonify(build())
+    return set_revalidation_headers(response, etag, last_modified)
+
+
+def analytics_revenue_trend(end_date):
+    revenue_by_month = rollup_summary(end_date)['revenue_by_month']
+    months = month_sequence(end_date, 6)
+    return {
+        'labels': [date(year, month, 1).strftime('%b') for year, month in months],
+        'data': [revenue_by_month.get(key, 0) for key in months]
+    }
+
+
+def analytics_customer_growth(end_date):
+    new_customers_by_month = rollup_summary(end_date)['new_customers_by_month']
+    months = month_sequence(end_date, 6)
+    return {
+        'labels': [date(year, month, 1).strftime('%b') for year, month in months],
+        'data': [new_customers_by_month.get(key, 0) for key in months]
+    }
+
+
+def analytics_plan_distribution(end_date):
+    plan_popularity = sorted(rollup_summary(end_date)['plan_counts'].items())
+    total_plans = sum(count for _, count in plan_popularity) or 1
+    return {
+        'plans': [
+            {
+                'name': plan_name,
+                'count': count,
+                'percentage': round((count / total_plans) * 100, 1),
+                'color': PLAN_COLORS[i % len(PLAN_COLORS)]
+            }
+            for i, (plan_name, count) in enumerate(plan_popularity)
+        ]
+    }
+
+
+def analytics_area_performance(end_date):
+    summary = rollup_summary(end_date)
+    monthly_revenue = sum(summary['area_revenue'].values())
+    return {
+        'areas': [
+            {
+                'name': area,
+                'customers': count,
+                'revenue': summary['area_revenue'].get(area, 0),
+                'percentage': round((summary['area_revenue'].get(area, 0) / monthly_revenue * 100) if monthly_revenue > 0 else 0, 1)
+            }
+            for area, count in sorted(summary['area_customers'].items())
+        ]
+    }
+
+
+def analytics_cohorts(end_date):
+    rows = [
+        {
+            'label': date(*cohort['cohort'], 1).strftime('%b %Y'),
+            'size': cohort['size'],
+            'retention': cohort['retention']
+        }
+        for cohort in cohort_retention_matrix()
+    ]
+    return {'months': max((len(row['retention']) for row in rows), default=0), 'rows': rows}
+
+
+def analytics_activity(end_date):
+    """Payment, pause and plan activity over the last 30 days and the slowest pages and templates today, from the metrics store"""
+    since = datetime.combine(end_date - timedelta(days=29), time.min)
+    until = datetime.combine(end_date + timedelta(days=1), time.min)
+    
+    def count(name):
+        return sum(point['count'] for point in query_metric(name, since, until, step=None))
+    
+    days_to_pay = query_metric("payment.days_to_pay", since, until, step=None)
+    def slowest(name, tag):
+        return sorted(
+            query_metric(name, datetime.combine(end_date, time.min), until, step=None, group_by=tag),
+            key=lambda point: point['avg'], reverse=True
+        )[:5]
+    
+    return {
+        'payment_methods': [
+            {'method': point['group'], 'payments': point['count'], 'amount': round(point['total'])}
+            for point in sorted(query_metric("payment.amount", since, until, step=None, group_by="method"),
+                                key=lambda point: point['total'], reverse=True)
+        ],
+        'avg_days_to_pay': round(days_to_pay[0]['avg'], 1) if days_to_pay else None,
+        'pauses_added': count("pause.added"),
+        'pauses_removed': count("pause.removed"),
+        'plans_subscribed': count("plan.subscribed"),
+        'plans_cancelled': count("plan.cancelled"),
+        'slowest_pages': [
+            {'endpoint': point['group'], 'requests': point['count'],
+             'avg_ms': round(point['avg'], 1), 'max_ms': round(point['max'], 1)}
+            for point in slowest("request.duration_ms", "endpoint")
+        ],
+        'slowest_templates': [
+            {'template': point['group'], 'renders': point['count'],
+             'avg_ms': round(point['avg'], 1), 'max_ms': round(point['max'], 1)}
+            for point in slowest("template.render_ms", "template")
+        ]
+    }
+
+
+# widget name -> (sources, builder(end_date)); widgets without sources are cached, not revalidated
+ANALYTICS_WIDGETS = {
+    "revenue-trend": (("rollups",), analytics_revenue_trend),
+    "customer-growth": (("rollups",), analytics_customer_growth),
+    "plans": (("rollups",), analytics_plan_distribution),
+    "areas": (("rollups",), analytics_area_performance),
+    "cohorts": (("cohorts", "rollups"), analytics_cohorts),  # Plan changes show up before the nightly refresh
+    "activity": (None, analytics_activity),
+}
+
+
+@app.route("/api/analytics/<widget>")
+def analytics_widget_api(widget):
+    """Compact JSON for one analytics dashboard widget, revalidated with ETag/Last-Modified"""
+    if not session.get("is_admin"):
+        return jsonify({"error": "Unauthorized"}), 401
+    if widget not in ANALYTICS_WIDGETS:
+        return jsonify({"error": "Unknown widget"}), 404
+    
+    sources, build = ANALYTICS_WIDGETS[widget]
+    if sources is None:
+        today = date.today()
+        response = jsonify(cached_report(f"analytics:{widget}:{today.isoformat()}", lambda: build(today),
+                                         ttl=ANALYTICS_ACTIVITY_TTL, stale_ttl=ANALYTICS_ACTIVITY_TTL))
+        response.cache_control.private = True
+        response.cache_control.max_age = ANALYTICS_ACTIVITY_TTL
+        return response
+    
+    etag, last_modified = analytics_source_version(sources)
+    return conditional_json(etag, last_modified, lambda: build(date.today()))
+
+
+@app.route("/api/metrics/<name>")
+def metrics_api(name):
+    """
+    Query the metrics store.
+    Query params: days (default 7), step (minute|hour|day|total), by (tag to group on),
+    any other param filters on that tag, e.g. /api/metrics/payment.amount?step=day&by=method
+    """
+    if not session.get("is_admin"):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    step = request.args.get("step", "day")
+    if step not in METRIC_STEPS and step != "total":
+        return jsonify({"error": f"step must be one of {', '.join(METRIC_STEPS)} or total"}), 400
+    days = request.args.get("days", 7, type=int)
+    tags = {key: value for key, value in request.args.items() if key not in ("days", "step", "by")}
+    
+    points = query_metric(name, datetime.now() - timedelta(days=days), step=None if step == "total" else step,
+                          group_by=request.args.get("by"), **tags)
+    return jsonify({
+        "metric": name,
+        "step": step,
+        "points": [
+            dict(point, bucket=point["bucket"].isoformat() if point["bucket"] else None)
+            for point in points
+        ]
+    })
+
+
+@app.route("/api/analytics/cube")
+def analytics_cube_api():
+    """
+    Slice and roll up the revenue cube.
+    ?metric=revenue|meals|pauses|active_plans&by=area|plan|month
+    &area=<name>&plan=<name> (repeatable) &from=YYYY-MM&to=YYYY-MM
+    """
+    if not session.get("is_admin"):
+        return jsonify({"error": "Unauthorized"}), 401
     
-    if payment_success:
-        # Get the most recent successful payment for this customer
-        recent_payment = db.session.query(Payment, Bill).join(Bill).filter(
-            Payment.customer_id == customer_id,
-            Payment.status == 'succeeded'
-        ).order_by(Payment.updated_at.desc()).first()
+    metric = request.args.get('metric', 'revenue')
+    axis = request.args.get('by', 'area')
+    if metric not in RevenueCube.METRICS or axis not in RevenueCube.AXES:
+        return jsonify({"error": "Invalid metric or dimension"}), 400
     
     try:
-        # Get customer's active plans (not expired)
-        active_plans = db.session.query(CustomerPlan, Plan).select_from(CustomerPlan).join(Plan, CustomerPlan.plan_id == Plan.id).filter(
-            CustomerPlan.customer_id == customer_id,
-            CustomerPlan.is_active == True,
-            CustomerPlan.end_date >= date.today()
-        ).order_by(CustomerPlan.end_date.asc()).all()
+        month_from = tuple(int(part) for part in request.args['from'].split('-')) if 'from' in request.args else None
+        month_to = tuple(int(part) for part in request.args['to'].split('-')) if 'to' in request.args else None
+    except ValueError:
+        return jsonify({"error": "Months must be formatted as YYYY-MM"}), 400
+    
+    cube = get_revenue_cube()
+    months = None
+    if month_from or month_to:
+        months = [key for key in cube.months
+                  if (not month_from or key >= month_from) and (not month_to or key <= month_to)]
+    areas = request.args.getlist('area') or None
+    plans = request.args.getlist('plan') or None
+    
+    def build():
+        rows = cube.by(metric, axis, area=areas, plan=plans, months=months)
+        if axis == "month":
+            rows = [(f"{year}-{month:02d}", value) for (year, month), value in rows]
+        return {
+            "metric": metric,
+            "by": axis,
+            "total": cube.total(metric, area=areas, plan=plans, months=months),
+            "rows": [{"label": label, "value": value} for label, value in rows]
+        }
+    
+    # The ETag describes the rollups the cached cube was built from
+    etag, last_modified = cube.version
+    return conditional_json(etag, last_modified, build)
+
+
+# ---------- Report Snapshots ----------
+REPORT_SNAPSHOT_DIR = os.getenv("REPORT_SNAPSHOT_DIR", os.path.join(app.instance_path, "reports"))
+REPORT_SNAPSHOT_KEEP_DAYS = int(os.getenv("REPORT_SNAPSHOT_KEEP_DAYS", "90"))
+
+
+def render_analytics_snapshot():
+    today = date.today()
+    return render_analytics_dashboard(widgets={
+        name: build(today) for name, (_, build) in ANALYTICS_WIDGETS.items()
+    })
+
+
+# report name -> (title, page path, renderer)
+SNAPSHOT_REPORTS = {
+    "analytics": ("Business Analytics", "/analytics", render_analytics_snapshot),
+    "bills": ("Bill Management", "/bills", render_bill_management),
+    "kitchen": ("Kitchen Production", "/kitchen-report", render_kitchen_report),
+}
+
+
+def snapshot_path(day, report, extension):
+    return os.path.join(REPORT_SNAPSHOT_DIR, day.isoformat(), f"{report}.{extension}")
+
+
+def write_snapshot_file(path, data):
+    """Write via a temporary file so readers never see a half-written snapshot"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Unique per thread, so concurrent writers of the same file (two image workers) don't collide
+    temporary_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(data)
+    os.replace(temporary_path, path)
+
+
+def html_to_pdf(html):
+    """Render snapshot HTML to PDF bytes with WeasyPrint, or None when it is not installed"""
+    try:
+        from weasyprint import HTML, default_url_fetcher
+    except ImportError:
+        return None
+    
+    def fetch_local_static(url):
+        # Snapshot pages link /static/... ; read those from disk instead of over HTTP
+        static_prefix = "file:///static/"
+        if url.startswith(static_prefix):
+            url = "file://" + os.path.join(app.static_folder, url[len(static_prefix):])
+        return default_url_fetcher(url)
+    
+    return HTML(string=html, base_url="file:///", url_fetcher=fetch_local_static).write_pdf()
+
+
+def write_report_snapshots(reports=None):
+    """Pre-render today's reports to HTML (and PDF when available). Returns the files written."""
+    day = date.today()
+    taken_at = datetime.now()
+    written = []
+    
+    for report in reports or SNAPSHOT_REPORTS:
+        title, path, render = SNAPSHOT_REPORTS[report]
+        with app.test_request_context(path):
+            html = render()
         
-        # Get upcoming plans (not started yet)
-        upcoming_plans = [
-            (cp, plan) for cp, plan in active_plans 
-            if cp.start_date > date.today()
-        ]
+        banner = (
+            '<div style="background: var(--info-light); color: var(--info-dark); padding: 8px 16px; '
+            'text-align: center; font-size: 14px;">'
+            f'<i class="fas fa-camera"></i> {title} snapshot taken {taken_at.strftime("%B %d, %Y %H:%M")}</div>'
+        )
+        html = html.replace("<body>", "<body>\n" + banner, 1)
         
-        # Get currently running plans
-        running_plans = [
-            (cp, plan) for cp, plan in active_plans 
-            if cp.start_date <= date.today() <= cp.end_date
-        ]
+        html_path = snapshot_path(day, report, "html")
+        write_snapshot_file(html_path, html.encode("utf-8"))
+        written.append(html_path)
         
-        # Get current month's paused days
-        current_month = date.today().month
-        current_year = date.today().year
-        paused_this_month = PausedDate.query.filter(
-            PausedDate.customer_id == customer_id,
-            db.extract('month', PausedDate.pause_date) == current_month,
-            db.extract('year', PausedDate.pause_date) == current_year
-        ).count()
-        
-        # Calculate estimated bill for current month and total plan days
-        estimated_bill = 0
-        total_plan_days = 0
-        current_month_start = date(current_year, current_month, 1)
-        current_month_end = date(current_year, current_month, monthrange(current_year, current_month)[1])
-        
-        for cp, plan in active_plans:
-            # Calculate overlap with current month
-            plan_start = max(cp.start_date, current_month_start)
-            plan_end = min(cp.end_date, current_month_end)
+        pdf = html_to_pdf(html)
+        if pdf is not None:
+            pdf_path = snapshot_path(day, report, "pdf")
+            write_snapshot_file(pdf_path, pdf)
+            written.append(pdf_path)
+    
+    return written
+
+
+def prune_report_snapshots(keep_days=REPORT_SNAPSHOT_KEEP_DAYS):
+    """Delete snapshot days older than `keep_days`. Returns the number of days removed."""
+    import shutil
+    
+    cutoff = date.today() - timedelta(days=keep_days)
+    removed = 0
+    for day, _ in list_report_snapshots():
+        if day < cutoff:
+            shutil.rmtree(os.path.join(REPORT_SNAPSHOT_DIR, day.isoformat()), ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def list_report_snapshots():
+    """[(day, {report: [extensions]})] for every snapshot day on disk, newest first"""
+    if not os.path.isdir(REPORT_SNAPSHOT_DIR):
+        return []
+    
+    archive = []
+    for name in os.listdir(REPORT_SNAPSHOT_DIR):
+        try:
+            day = date.fromisoformat(name)
+        except ValueError:
+            continue
+        reports = defaultdict(list)
+        for filename in sorted(os.listdir(os.path.join(REPORT_SNAPSHOT_DIR, name))):
+            report, _, extension = filename.partition(".")
+            if report in SNAPSHOT_REPORTS and extension in ("html", "pdf"):
+                reports[report].append(extension)
+        if reports:
+            archive.append((day, dict(reports)))
+    return sorted(archive, reverse=True)
+
+
+@app.route("/reports")
+def report_archive():
+    if not session.get("is_admin"):
+        return redirect(url_for("login"))
+    
+    return render_template("report_archive.html",
+                         archive=list_report_snapshots(),
+                         reports=SNAPSHOT_REPORTS)
+
+
+@app.route("/reports/<day>/<report>.<extension>")
+def report_snapshot(day, report, extension):
+    if not session.get("is_admin"):
+        return redirect(url_for("login"))
+    
+    if report not in SNAPSHOT_REPORTS or extension not in ("html", "pdf"):
+        return "Report not found", 404
+    
+    if day == "latest":
+        day = next((snapshot_day for snapshot_day, reports in list_report_snapshots()
+                    if extension in reports.get(report, ())), None)
+    else:
+        try:
+            day = date.fromisoformat(day)
+        except ValueError:
+            day = None
+    
+    path = snapshot_path(day, report, extension) if day else None
+    if not path or not os.path.exists(path):
+        return "Report not found", 404
+    
+    return send_file(path, mimetype="text/html" if extension == "html" else "application/pdf",
+                     max_age=0 if day == date.today() else 86400)
+
+
+# ---------- Customer Dashboard ----------
+CUSTOMER_SUMMARY_TTL = int(os.getenv("CUSTOMER_SUMMARY_TTL", "900"))  # safety net; writes change the cache key
+
+
+def snapshot_row(row):
+    """Detached, read-only copy of a model's columns that is safe to share between requests"""
+    return SimpleNamespace(**{column.key: getattr(row, column.key) for column in row.__table__.columns})
+
+
+def compute_customer_summary(customer_id, today):
+    """Plans, pauses, bills and payments behind /dashboard and /billing, from three queries"""
+    current_month_start = today.replace(day=1)
+    current_month_end = date(today.year, today.month, monthrange(today.year, today.month)[1])
+    
+    # Query 1: customer's active plans running this month or later
+    month_plans = db.session.query(CustomerPlan, Plan).select_from(CustomerPlan).join(Plan, CustomerPlan.plan_id == Plan.id).filter(
+        CustomerPlan.customer_id == customer_id,
+        CustomerPlan.is_active == True,
+        CustomerPlan.end_date >= current_month_start
+    ).order_by(CustomerPlan.end_date.asc()).all()
+    
+    # Query 2: this month's pauses plus the five most recently created ones.
+    # The derived table keeps LIMIT out of the IN clause for MySQL.
+    latest_pauses = db.select(PausedDate.id).filter(
+        PausedDate.customer_id == customer_id
+    ).order_by(PausedDate.created_at.desc()).limit(5).subquery()
+    pauses = PausedDate.query.filter(
+        PausedDate.customer_id == customer_id,
+        db.or_(
+            PausedDate.pause_date.between(current_month_start, current_month_end),
+            PausedDate.id.in_(db.select(latest_pauses.c.id))
+        )
+    ).all()
+    
+    # Query 3: bills with their successful payments
+    bill_rows = db.session.query(Bill, Payment).outerjoin(
+        Payment, db.and_(Payment.bill_id == Bill.id, Payment.status == 'succeeded')
+    ).filter(Bill.customer_id == customer_id).all()
+    
+    # Everything below is in memory
+    month_plans = [(snapshot_row(cp), snapshot_row(plan)) for cp, plan in month_plans]
+    active_plans = [(cp, plan) for cp, plan in month_plans if cp.end_date >= today]  # Not expired
+    
+    month_pauses = sorted(
+        pause.pause_date for pause in pauses
+        if current_month_start <= pause.pause_date <= current_month_end
+    )
+    # Includes plans that ended earlier this month, exactly as the month's bill will
+    estimate = calculate_month_bill(month_plans, month_pauses, today.year, today.month)
+    
+    bills_by_id = {}
+    payments = []
+    for bill, payment in bill_rows:
+        if bill.id not in bills_by_id:
+            bills_by_id[bill.id] = snapshot_row(bill)
+        if payment is not None:
+            payments.append((snapshot_row(payment), bills_by_id[bill.id]))
+    
+    all_bills = sorted(bills_by_id.values(), key=lambda bill: bill.created_at or datetime.min, reverse=True)
+    unpaid_bills = [bill for bill in all_bills if not bill.is_paid]
+    
+    return {
+        'as_of': today,
+        'active_plans': active_plans,
+        'running_plans': [(cp, plan) for cp, plan in active_plans if cp.start_date <= today <= cp.end_date],
+        'upcoming_plans': [(cp, plan) for cp, plan in active_plans if cp.start_date > today],
+        'estimated_bill': estimate['amount'],
+        'paused_this_month': len(month_pauses),
+        'paused_today': today in month_pauses,
+        'recent_pauses': [
+            snapshot_row(pause)
+            for pause in sorted(pauses, key=lambda pause: pause.created_at or datetime.min, reverse=True)[:5]
+        ],
+        'total_days': estimate['total_days'],
+        'unpaid_bills': unpaid_bills,
+        'paid_bills': [bill for bill in all_bills if bill.is_paid],
+        'total_due': sum(bill.amount for bill in unpaid_bills),
+        'recent_payments': sorted(payments, key=lambda row: row[0].updated_at or datetime.min, reverse=True)[:5]
+    }
+
+
+def customer_summary(customer_id):
+    """
+    Cached customer summary, keyed on the customer's data versions so a write committed by any
+    worker moves every worker to a new entry. Entries for old versions age out of the report cache.
+    """
+    today = date.today()
+    key = "customer:{}:summary:{}:{}".format(customer_id, *customer_data_version(customer_id))
+    summary = cached_report(key, lambda: compute_customer_summary(customer_id, today), ttl=CUSTOMER_SUMMARY_TTL)
+    if summary['as_of'] != today:
+        # Cached before midnight: running plans, today's pause and the month window have moved
+        summary = cached_report(key, lambda: compute_customer_summary(customer_id, today),
+                                ttl=CUSTOMER_SUMMARY_TTL, force=True)
+    return summary
+
+
+SHARED_DATA_VERSION = "customer_data_version"  # app_counters row for data every customer sees
+
+
+def release_fingerprint():
+    """Digest of the code, templates and asset manifest, so a deploy changes every page ETag"""
+    digest = hashlib.sha1(json.dumps(_asset_manifest, sort_keys=True).encode())
+    sources = [os.path.abspath(__file__)] + [
+        os.path.join(folder, name)
+        for folder, _, names in os.walk(os.path.join(app.root_path, app.template_folder))
+        for name in sorted(names)
+    ]
+    for path in sources:
+        stat = os.stat(path)
+        digest.update(f"{os.path.relpath(path, app.root_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+PAGE_RELEASE_ID = release_fingerprint()
+
+
+def bump_customer_data_version(customer_id=None):
+    """
+    Record a write to one customer's data, or to data shown to every customer (no id).
+    Call it before committing so the new version lands in the same transaction as the write;
+    every worker then sees both together.
+    """
+    if customer_id is not None:
+        db.session.execute(db.update(User).where(User.id == customer_id).values(data_version=User.data_version + 1))
+    else:
+        bumped = db.session.execute(db.update(AppCounter).where(AppCounter.name == SHARED_DATA_VERSION).values(
+            value=AppCounter.value + 1
+        ))
+        if not bumped.rowcount:
+            db.session.add(AppCounter(name=SHARED_DATA_VERSION, value=1))
+
+
+def customer_data_version(customer_id):
+    """(customer's own version, shared version) as committed, in one primary-key lookup"""
+    shared = db.select(AppCounter.value).where(AppCounter.name == SHARED_DATA_VERSION).scalar_subquery()
+    row = db.session.execute(db.select(User.data_version, shared).where(User.id == customer_id)).first()
+    return (row[0], row[1] or 0) if row else (0, 0)
+
+
+def customer_page_version(customer_id, page):
+    """ETag for a customer page from the data versions stored with the customer and the shared counter"""
+    own_version, shared_version = customer_data_version(customer_id)
+    
+    # Pages also depend on the release, today's date, the query string and the name kept in the session
+    parts = (PAGE_RELEASE_ID, page, customer_id, own_version, shared_version, date.today().isoformat(),
+             request.query_string.decode(), session.get("user_name", ""))
+    return hashlib.sha1("|".join(map(str, parts)).encode()).hexdigest()
+
+
+def conditional_page(page):
+    """
+    Answer 304 for an unchanged customer page before the view queries the database or
+    renders its template. Responses carrying flashed messages are never given a validator.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            customer_id = session.get("user_id")
+            if customer_id is None or session.get("is_admin") or session.get("_flashes"):
+                return view(*args, **kwargs)
             
-            if plan_start <= plan_end:
-                plan_days = (plan_end - plan_start).days + 1
-                total_plan_days += plan_days
-                
-                # Get paused days for this specific plan period
-                plan_paused = PausedDate.query.filter(
-                    PausedDate.customer_id == customer_id,
-                    PausedDate.pause_date >= plan_start,
-                    PausedDate.pause_date <= plan_end
-                ).count()
-                
-                billable_days = plan_days - plan_paused
-                estimated_bill += billable_days * plan.daily_rate
-        
-        # Get recent activity
-        recent_pauses = PausedDate.query.filter_by(customer_id=customer_id).order_by(
-            PausedDate.created_at.desc()
-        ).limit(5).all()
-        
-        # Check if paused today
-        paused_today = PausedDate.query.filter_by(
-            customer_id=customer_id,
-            pause_date=date.today()
-        ).first() is not None
-        
-        # Get customer's bills for payment (separate paid and unpaid)
-        all_bills = Bill.query.filter_by(customer_id=customer_id).order_by(Bill.created_at.desc()).all()
-        unpaid_bills = [bill for bill in all_bills if not bill.is_paid]
-        paid_bills = [bill for bill in all_bills if bill.is_paid]
-        
-        # Get recent payments for history
-        recent_payments = db.session.query(Payment, Bill).join(Bill).filter(
-            Payment.customer_id == customer_id,
-            Payment.status == 'succeeded'
-        ).order_by(Payment.updated_at.desc()).limit(5).all()
+            etag = customer_page_version(customer_id, page)
+            if client_copy_is_current(etag, None):
+                return set_revalidation_headers(Response(status=304), etag, None)
+            
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200 or session.get("_flashes"):
+                return response
+            return set_revalidation_headers(response, etag, None)
+        return wrapper
+    return decorator
+
+
+BILL_ESTIMATE_MAX_MONTHS = 12
+
+
+def compute_bill_estimates(customer_id, year, month, months):
+    """Itemized bill estimates for `months` consecutive months from year/month"""
+    last_index = year * 12 + month - 1 + months - 1
+    window = month_sequence(date(last_index // 12, last_index % 12 + 1, 1), months)
+    first_day = date(year, month, 1)
+    last_day = date(window[-1][0], window[-1][1], monthrange(*window[-1])[1])
+    
+    plans = db.session.query(CustomerPlan, Plan).select_from(CustomerPlan).join(Plan, CustomerPlan.plan_id == Plan.id).filter(
+        CustomerPlan.customer_id == customer_id,
+        CustomerPlan.is_active == True,
+        CustomerPlan.start_date <= last_day,
+        CustomerPlan.end_date >= first_day
+    ).all()
+    pause_dates = [pause_date for (pause_date,) in db.session.query(PausedDate.pause_date).filter(
+        PausedDate.customer_id == customer_id,
+        PausedDate.pause_date.between(first_day, last_day)
+    ).order_by(PausedDate.pause_date)]
+    
+    estimates = []
+    for estimate_year, estimate_month in window:
+        estimate = calculate_month_bill(plans, pause_dates, estimate_year, estimate_month)
+        estimate['label'] = date(estimate_year, estimate_month, 1).strftime('%B %Y')
+        for item in estimate['items']:
+            item['start_date'] = item['start_date'].isoformat()
+            item['end_date'] = item['end_date'].isoformat()
+        estimates.append(estimate)
+    
+    return {'estimates': estimates}
+
+
+@app.route("/api/bills/estimate")
+def bill_estimate_api():
+    """
+    Itemized bill estimate per plan for any month, computed the same way bills are generated.
+    Query params: month, year (default this month), months (consecutive months to include, default 1)
+    """
+    if "user_id" not in session or session.get("is_admin"):
+        return jsonify({"error": "Unauthorized"}), 401
+    
+    today = date.today()
+    month = request.args.get("month", today.month, type=int)
+    year = request.args.get("year", today.year, type=int)
+    months = request.args.get("months", 1, type=int)
+    if not 1 <= month <= 12 or not 2000 <= year <= 2100 or not 1 <= months <= BILL_ESTIMATE_MAX_MONTHS:
+        return jsonify({"error": f"month must be 1-12, year 2000-2100 and months 1-{BILL_ESTIMATE_MAX_MONTHS}"}), 400
+    
+    customer_id = session["user_id"]
+    # The ETag and cache key come from the customer's data versions, so an unchanged
+    # estimate is answered with 304 before anything is computed
+    key = "customer:{}:estimate:{}-{:02d}:{}:{}:{}".format(customer_id, year, month, months,
+                                                          *customer_data_version(customer_id))
+    etag = hashlib.sha1(f"{PAGE_RELEASE_ID}|{key}".encode()).hexdigest()
+    return conditional_json(etag, None, lambda: cached_report(
+        key, lambda: compute_bill_estimates(customer_id, year, month, months), ttl=CUSTOMER_SUMMARY_TTL
+    ))
+
+
+@app.route("/dashboard")
+@conditional_page("dashboard")
+@db_retry(max_retries=3, delay=1)
+def customer_dashboard():
+    if "user_id" not in session or session.get("is_admin"):
+        return redirect(url_for("login"))
+    
+    payment_success = request.args.get('payment') == 'success'
+    
+    try:
+        summary = customer_summary(session["user_id"])
         
         dashboard_data = {
-            'active_plans': active_plans,
-            'running_plans': running_plans,
-            'upcoming_plans': upcoming_plans,
-            'estimated_bill': estimated_bill,
-            'paused_this_month': paused_this_month,
-            'recent_pauses': recent_pauses,
-            'paused_today': paused_today,
-            'total_days': total_plan_days,  # Use actual plan days instead of month days
-            'billable_days': total_plan_days - paused_this_month,
-            'bills': unpaid_bills,  # Only show unpaid bills in pending section
-            'paid_bills': paid_bills,
-            'recent_payments': recent_payments,
+            'active_plans': summary['active_plans'],
+            'running_plans': summary['running_plans'],
+            'upcoming_plans': summary['upcoming_plans'],
+            'estimated_bill': summary['estimated_bill'],
+            'paused_this_month': summary['paused_this_month'],
+            'recent_pauses': summary['recent_pauses'],
+            'paused_today': summary['paused_today'],
+            'total_days': summary['total_days'],  # Use actual plan days instead of month days
+            'billable_days': summary['total_days'] - summary['paused_this_month'],
+            'bills': summary['unpaid_bills'],  # Only show unpaid bills in pending section
+            'paid_bills': summary['paid_bills'],
+            'recent_payments': summary['recent_payments'],
             'payment_success': payment_success,
-            'recent_payment': recent_payment,
+            'recent_payment': summary['recent_payments'][0] if payment_success and summary['recent_payments'] else None,
             'date': date  # Pass date class for template calculations
         }
         
@@ -1971,6 +5089,7 @@ def customer_dashboard():
 
 
 @app.route("/pause")
+@conditional_page("pause")
 def pause_page():
     if "user_id" not in session:
         return redirect(url_for("login"))
@@ -2019,7 +5138,10 @@ def save_pause():
             pause_date=pause_date
         )
     )
+    bump_rollup(pause_date.year, pause_date.month, customer_area(session["user_id"]), pause_days=1)
+    bump_customer_data_version(session["user_id"])
     db.session.commit()
+    record_metric("pause.added", notice="same_day" if pause_date == date.today() else "advance")
     flash("Tiffin paused successfully", "success")
 
     return redirect(url_for("pause_page"))
@@ -2060,7 +5182,10 @@ def remove_pause():
             return jsonify({"error": "Cannot remove pause for past dates"}), 400
 
         db.session.delete(paused)
+        bump_rollup(pause_date.year, pause_date.month, customer_area(session["user_id"]), pause_days=-1)
+        bump_customer_data_version(session["user_id"])
         db.session.commit()
+        record_metric("pause.removed")
 
         return jsonify({
             "success": True,
@@ -2075,6 +5200,7 @@ def remove_pause():
 
 # ---------- Plans ----------
 @app.route("/plans")
+@conditional_page("plans")
 def choose_plans():
     if "user_id" not in session:
         return redirect(url_for("login"))
@@ -2106,8 +5232,11 @@ def cancel_plan(plan_id):
             return jsonify({"error": "Cannot cancel a plan that has already started"}), 400
         
         # Delete the plan
+        rollup_customer_plan(customer_plan, customer_area(customer_id), sign=-1)
         db.session.delete(customer_plan)
+        bump_customer_data_version(customer_id)
         db.session.commit()
+        record_metric("plan.cancelled", plan_id=customer_plan.plan_id)
         
         return jsonify({
             "success": True,
@@ -2202,7 +5331,11 @@ def save_plans():
                     flash(f"Cannot select overlapping dates for the same plan: {plan1['plan_name']}", "error")
                     return redirect(url_for("choose_plans"))
     
+    area = customer_area(customer_id)
+    
     # Remove existing active plans for this customer
+    for existing_plan in CustomerPlan.query.filter_by(customer_id=customer_id, is_active=True):
+        rollup_customer_plan(existing_plan, area, sign=-1)
     CustomerPlan.query.filter_by(customer_id=customer_id, is_active=True).delete()
     db.session.commit()
     
@@ -2216,8 +5349,12 @@ def save_plans():
             is_active=True
         )
         db.session.add(customer_plan)
+        rollup_customer_plan(customer_plan, area)
     
+    bump_customer_data_version(customer_id)
     db.session.commit()
+    for plan_data in selected_plans:
+        record_metric("plan.subscribed", plan_data['duration_days'], plan_id=plan_data['plan_id'])
     
     # Create success message with summary
     if len(selected_plans) == 1:
@@ -2334,6 +5471,7 @@ def plan_payment_success():
                     is_active=True
                 )
                 db.session.add(customer_plan)
+                rollup_customer_plan(customer_plan, customer.area)
                 
                 # Get plan details for receipt
                 plan = Plan.query.get(config['planId'])
@@ -2411,6 +5549,13 @@ def plan_payment_success():
                         month_amount = month_billable * plan.daily_rate
                         
                         if existing_bill:
+                            # Paying now also settles whatever was still due on this bill
+                            if existing_bill.is_paid:
+                                bump_rollup(year, month, customer.area, revenue=month_amount)
+                            else:
+                                bump_rollup(year, month, customer.area,
+                                            revenue=existing_bill.amount + month_amount, payments=1)
+                            
                             # Update existing bill
                             existing_bill.total_days += month_days
                             existing_bill.paused_days += month_paused
@@ -2435,6 +5580,8 @@ def plan_payment_success():
                                 is_paid=True  # Mark as paid since payment was successful
                             )
                             db.session.add(bill)
+                            bump_rollup(year, month, customer.area,
+                                        bills_issued=1, revenue=month_amount, payments=1)
                             created_bills.append({
                                 'month': month,
                                 'year': year,
@@ -2447,7 +5594,13 @@ def plan_payment_success():
                     else:
                         current_date = date(year, month + 1, 1)
             
+            bump_customer_data_version(customer_id)
             db.session.commit()
+            invalidate_report_cache("bills:")
+            
+            record_metric("payment.amount", total_amount_paid, method="card", kind="plan")
+            for plan_info in new_plans:
+                record_metric("plan.subscribed", plan_info['days'], plan_id=plan_info['plan_id'])
             
             # Send receipt email
             if is_email_configured():
@@ -2455,173 +5608,30 @@ def plan_payment_success():
                     # Prepare receipt email
                     subject = f"Payment Receipt - TiffinTrack Order Confirmation"
                     
-                    # Build plan details HTML
-                    plans_html = ""
-                    for idx, plan_info in enumerate(new_plans, 1):
-                        plans_html += f"""
-                        <tr style="border-bottom: 1px solid #eee;">
-                            <td style="padding: 12px; text-align: left;">{idx}</td>
-                            <td style="padding: 12px; text-align: left;">
-                                <strong>{plan_info['plan_name']}</strong><br>
-                                <span style="color: #666; font-size: 13px;">
-                                    {plan_info['start_date'].strftime('%b %d, %Y')} - {plan_info['end_date'].strftime('%b %d, %Y')}
-                                </span>
-                            </td>
-                            <td style="padding: 12px; text-align: center;">{plan_info['days']} days</td>
-                            <td style="padding: 12px; text-align: right; font-weight: 600;">₹{plan_info['amount']}</td>
-                        </tr>
-                        """
-                    
-                    html_body = f"""
-                    <html>
-                    <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333; background: #f5f5f5; padding: 20px;">
-                        <div style="max-width: 600px; margin: 0 auto; background: white; border-radius: 12px; overflow: hidden; box-shadow: 0 4px 6px rgba(0,0,0,0.1);">
-                            <!-- Header -->
-                            <div style="background: linear-gradient(135deg, #ff6b35 0%, #ff8c61 100%); padding: 30px; text-align: center; color: white;">
-                                <h1 style="margin: 0; font-size: 28px;">Payment Successful! 🎉</h1>
-                                <p style="margin: 10px 0 0 0; opacity: 0.9;">Thank you for your order</p>
-                            </div>
-                            
-                            <!-- Content -->
-                            <div style="padding: 30px;">
-                                <p style="font-size: 16px; margin-bottom: 20px;">Dear {customer.fullname},</p>
-                                
-                                <p style="margin-bottom: 25px;">
-                                    Your payment has been successfully processed! Your meal plan(s) are now active and ready to go.
-                                </p>
-                                
-                                <!-- Receipt Details -->
-                                <div style="background: #f8f9fa; padding: 20px; border-radius: 8px; margin-bottom: 25px;">
-                                    <h3 style="margin: 0 0 15px 0; color: #ff6b35; font-size: 18px;">Receipt Details</h3>
-                                    <table style="width: 100%; border-collapse: collapse;">
-                                        <tr style="border-bottom: 1px solid #ddd;">
-                                            <td style="padding: 8px 0; color: #666;">Transaction ID:</td>
-                                            <td style="padding: 8px 0; text-align: right; font-weight: 600;">{payment_intent_id[:20]}...</td>
-                                        </tr>
-                                        <tr style="border-bottom: 1px solid #ddd;">
-                                            <td style="padding: 8px 0; color: #666;">Date:</td>
-                                            <td style="padding: 8px 0; text-align: right; font-weight: 600;">{datetime.now().strftime('%b %d, %Y %I:%M %p')}</td>
-                                        </tr>
-                                        <tr style="border-bottom: 1px solid #ddd;">
-                                            <td style="padding: 8px 0; color: #666;">Payment Method:</td>
-                                            <td style="padding: 8px 0; text-align: right; font-weight: 600;">Card Payment</td>
-                                        </tr>
-                                        <tr>
-                                            <td style="padding: 8px 0; color: #666;">Status:</td>
-                                            <td style="padding: 8px 0; text-align: right;">
-                                                <span style="background: #10b981; color: white; padding: 4px 12px; border-radius: 20px; font-size: 12px; font-weight: 600;">PAID</span>
-                                            </td>
-                                        </tr>
-                                    </table>
-                                </div>
-                                
-                                <!-- Order Summary -->
-                                <h3 style="margin: 0 0 15px 0; color: #333; font-size: 18px;">Order Summary</h3>
-                                <table style="width: 100%; border-collapse: collapse; margin-bottom: 20px; border: 1px solid #eee; border-radius: 8px; overflow: hidden;">
-                                    <thead>
-                                        <tr style="background: #f8f9fa;">
-                                            <th style="padding: 12px; text-align: left; font-weight: 600; color: #666;">#</th>
-                                            <th style="padding: 12px; text-align: left; font-weight: 600; color: #666;">Plan Details</th>
-                                            <th style="padding: 12px; text-align: center; font-weight: 600; color: #666;">Duration</th>
-                                            <th style="padding: 12px; text-align: right; font-weight: 600; color: #666;">Amount</th>
-                                        </tr>
-                                    </thead>
-                                    <tbody>
-                                        {plans_html}
-                                        <tr style="background: #f8f9fa;">
-                                            <td colspan="3" style="padding: 15px; text-align: right; font-weight: 700; font-size: 16px;">Total Paid:</td>
-                                            <td style="padding: 15px; text-align: right; font-weight: 700; font-size: 18px; color: #ff6b35;">₹{total_amount_paid}</td>
-                                        </tr>
-                                    </tbody>
-                                </table>
-                                
-                                <!-- Next Steps -->
-                                <div style="background: #e8f5e9; padding: 20px; border-radius: 8px; border-left: 4px solid #10b981; margin-bottom: 25px;">
-                                    <h4 style="margin: 0 0 10px 0; color: #047857;">What's Next?</h4>
-                                    <ul style="margin: 0; padding-left: 20px; color: #065f46;">
-                                        <li style="margin-bottom: 8px;">Your meal deliveries will start as per your selected dates</li>
-                                        <li style="margin-bottom: 8px;">You can pause meals anytime from your dashboard</li>
-                                        <li style="margin-bottom: 8px;">View your bills and payment history in the billing section</li>
-                                    </ul>
-                                </div>
-                                
-                                <!-- CTA Button -->
-                                <div style="text-align: center; margin: 30px 0;">
-                                    <a href="{request.url_root}dashboard" 
-                                       style="display: inline-block; background: #ff6b35; color: white; padding: 14px 40px; text-decoration: none; border-radius: 8px; font-weight: 600; font-size: 16px;">
-                                        View Dashboard
-                                    </a>
-                                </div>
-                                
-                                <p style="color: #666; font-size: 14px; margin-top: 25px;">
-                                    If you have any questions or concerns, please don't hesitate to contact us.
-                                </p>
-                                
-                                <p style="margin-top: 20px;">
-                                    Best regards,<br>
-                                    <strong>TiffinTrack Team</strong>
-                                </p>
-                            </div>
-                            
-                            <!-- Footer -->
-                            <div style="background: #f8f9fa; padding: 20px; text-align: center; border-top: 1px solid #eee;">
-                                <p style="margin: 0; font-size: 12px; color: #666;">
-                                    TiffinTrack - Fresh, Healthy Meals Delivered Daily<br>
-                                    This is an automated receipt. Please do not reply to this email.
-                                </p>
-                            </div>
-                        </div>
-                    </body>
-                    </html>
-                    """
-                    
-                    text_body = f"""
-                    Payment Receipt - TiffinTrack
-                    
-                    Dear {customer.fullname},
-                    
-                    Your payment has been successfully processed!
-                    
-                    Receipt Details:
-                    - Transaction ID: {payment_intent_id}
-                    - Date: {datetime.now().strftime('%b %d, %Y %I:%M %p')}
-                    - Payment Method: Card Payment
-                    - Status: PAID
-                    
-                    Order Summary:
-                    """
-                    
-                    for idx, plan_info in enumerate(new_plans, 1):
-                        text_body += f"""
-                    {idx}. {plan_info['plan_name']}
-                       Period: {plan_info['start_date'].strftime('%b %d, %Y')} - {plan_info['end_date'].strftime('%b %d, %Y')}
-                       Duration: {plan_info['days']} days
-                       Amount: ₹{plan_info['amount']}
-                    """
-                    
-                    text_body += f"""
-                    
-                    Total Paid: ₹{total_amount_paid}
-                    
-                    What's Next?
-                    - Your meal deliveries will start as per your selected dates
-                    - You can pause meals anytime from your dashboard
-                    - View your bills and payment history in the billing section
-                    
-                    View your dashboard: {request.url_root}dashboard
-                    
-                    Thank you for choosing TiffinTrack!
-                    
-                    Best regards,
-                    TiffinTrack Team
-                    """
+                    html_body, text_body = render_email(
+                        "plan_receipt",
+                        customer=customer,
+                        plans=new_plans,
+                        total_amount_paid=total_amount_paid,
+                        payment_intent_id=payment_intent_id,
+                        paid_at=datetime.now(),
+                        dashboard_url=f"{request.url_root}dashboard"
+                    )
                     
-                    # Send email
-                    send_email(customer.email, subject, html_body, text_body)
-                    print(f"✅ Receipt email sent to {customer.email}")
+                    # Queue email for background delivery
+                    enqueue_email(
+                        customer.email, subject, html_body, text_body,
+                        kind="plan_receipt",
+                        customer_id=customer.id,
+                        dedupe_key=f"plan_receipt:{payment_intent_id}"
+                    )
+                    db.session.commit()
+                    notify_email_worker()
+                    print(f"✅ Receipt email queued for {customer.email}")
                     
                 except Exception as email_error:
-                    print(f"⚠️ Failed to send receipt email: {email_error}")
+                    db.session.rollback()
+                    print(f"⚠️ Failed to queue receipt email: {email_error}")
                     # Don't fail the whole transaction if email fails
             
             # Clear pending configurations
@@ -2645,63 +5655,21 @@ def plan_payment_success():
 
 # ---------- Billing ----------
 @app.route("/billing")
+@conditional_page("billing")
 @db_retry(max_retries=3, delay=1)
 def billing_page():
     """Display customer billing page with all bills and payment history"""
     if "user_id" not in session:
         return redirect(url_for("login"))
     
-    customer_id = session["user_id"]
-    
     try:
-        # Get all bills
-        all_bills = Bill.query.filter_by(customer_id=customer_id).order_by(Bill.created_at.desc()).all()
-        unpaid_bills = [bill for bill in all_bills if not bill.is_paid]
-        paid_bills = [bill for bill in all_bills if bill.is_paid]
-        
-        # Calculate total due
-        total_due = sum(bill.amount for bill in unpaid_bills)
-        
-        # Get current month's estimated bill
-        current_month = date.today().month
-        current_year = date.today().year
-        
-        # Get customer's active plans
-        active_plans = db.session.query(CustomerPlan, Plan).select_from(CustomerPlan).join(
-            Plan, CustomerPlan.plan_id == Plan.id
-        ).filter(
-            CustomerPlan.customer_id == customer_id,
-            CustomerPlan.is_active == True,
-            CustomerPlan.end_date >= date.today()
-        ).all()
-        
-        # Calculate estimated bill for current month
-        estimated_bill = 0
-        current_month_start = date(current_year, current_month, 1)
-        current_month_end = date(current_year, current_month, monthrange(current_year, current_month)[1])
-        
-        for cp, plan in active_plans:
-            plan_start = max(cp.start_date, current_month_start)
-            plan_end = min(cp.end_date, current_month_end)
-            
-            if plan_start <= plan_end:
-                plan_days = (plan_end - plan_start).days + 1
-                
-                # Get paused days
-                plan_paused = PausedDate.query.filter(
-                    PausedDate.customer_id == customer_id,
-                    PausedDate.pause_date >= plan_start,
-                    PausedDate.pause_date <= plan_end
-                ).count()
-                
-                billable_days = plan_days - plan_paused
-                estimated_bill += billable_days * plan.daily_rate
+        summary = customer_summary(session["user_id"])
         
         return render_template("billing.html",
-                             unpaid_bills=unpaid_bills,
-                             paid_bills=paid_bills,
-                             total_due=total_due,
-                             estimated_bill=estimated_bill)
+                             unpaid_bills=summary['unpaid_bills'],
+                             paid_bills=summary['paid_bills'],
+                             total_due=summary['total_due'],
+                             estimated_bill=summary['estimated_bill'])
     
     except Exception as e:
         print(f"❌ Error in billing page: {e}")
@@ -2918,7 +5886,9 @@ def process_payment_success(payment_intent_id, stripe_intent):
         )
         payment.updated_at = datetime.now()
         
-        # Mark bill as paid
+        # Mark bill as paid (the webhook and the client can both report the same payment)
+        if not bill.is_paid:
+            rollup_bill_paid(bill, customer.area)
         bill.is_paid = True
         
         # Create payment success log entry
@@ -2935,11 +5905,14 @@ def process_payment_success(payment_intent_id, stripe_intent):
             "stripe_payment_intent_id": payment_intent_id,
             "billing_period": f"{bill.month}/{bill.year}",
             "billable_days": bill.billable_days,
-            "paused_days": bill.paused_days
+            "paused_days": bill.paused_days,
+            "days_to_pay": (datetime.now() - bill.created_at).days if bill.created_at else None
         }
         
         # Commit to current database (SQLite or PostgreSQL)
+        bump_customer_data_version(customer.id)
         db.session.commit()
+        invalidate_report_cache("bills:")
         
         # Sync to Neon database if currently using SQLite
         sync_payment_to_neon(payment_log)
@@ -3049,21 +6022,12 @@ def sync_payment_to_neon(payment_log):
 
 
 def update_payment_analytics(payment_log):
-    """Update payment analytics and metrics"""
+    """Record the payment in the metrics store; monthly revenue totals live in the rollups"""
     try:
-        # Log payment metrics
-        print(f"📊 Payment Analytics Updated:")
-        print(f"   Customer: {payment_log['customer_name']}")
-        print(f"   Amount: ₹{payment_log['amount']}")
-        print(f"   Period: {payment_log['billing_period']}")
-        print(f"   Method: {payment_log['payment_method']}")
-        print(f"   Days: {payment_log['billable_days']} billable, {payment_log['paused_days']} paused")
-        
-        # Here you could add more analytics like:
-        # - Update monthly revenue totals
-        # - Track payment method preferences
-        # - Calculate customer lifetime value
-        # - Update collection efficiency metrics
+        record_metric("payment.amount", payment_log["amount"],
+                      method=payment_log["payment_method"] or "unknown", kind="bill")
+        if payment_log["days_to_pay"] is not None:
+            record_metric("payment.days_to_pay", payment_log["days_to_pay"])
         
     except Exception as e:
         print(f"⚠️ Error updating analytics: {e}")
@@ -3161,6 +6125,143 @@ def reset_db():
     seed_initial_data()
     print("🔄 Database reset complete!")
 
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups():
+    """Rebuild the monthly analytics rollups from bills, users, plans and pauses"""
+    rows = rebuild_monthly_rollups()
+    print(f"📊 Monthly rollups rebuilt ({rows} rows)")
+
+@app.cli.command("build-daily-facts")
+@click.option("--start", "start", type=click.DateTime(formats=["%Y-%m-%d"]), help="First day to (re)build")
+@click.option("--end", "end", type=click.DateTime(formats=["%Y-%m-%d"]), help="Last day to (re)build (default yesterday)")
+def build_daily_facts_command(start, end):
+    """Nightly job: fill missing daily facts up to yesterday, or rebuild --start..--end for a backfill"""
+    end_date = end.date() if end else date.today() - timedelta(days=1)
+    if start:
+        days = build_daily_facts(start.date(), end_date)
+    else:
+        days = ensure_daily_facts(through=end_date)
+    print(f"📅 Daily facts written for {days} days through {end_date}")
+
+@app.cli.command("refresh-cohorts")
+@click.option("--full", is_flag=True, help="Recompute every cohort instead of only stale months")
+def refresh_cohorts(full):
+    """Refresh the materialized cohort retention matrix"""
+    cells = refresh_cohort_retention(full=full)
+    print(f"👥 Cohort retention refreshed ({cells} cells)")
+
+@app.cli.command("project-revenue")
+@click.option("--start", "start", type=click.DateTime(formats=["%Y-%m-%d"]), help="First day (default: start of next month)")
+@click.option("--months", default=1, show_default=True, help="Calendar months to project")
+@click.option("--top", default=10, show_default=True, help="Customers to list by expected revenue")
+def project_revenue_command(start, months, top):
+    """Print expected billable days and revenue from scheduled plans and pause history"""
+    start_date = start.date() if start else projection_horizons()[0][1]
+    end_year, end_month = start_date.year + (start_date.month + months - 2) // 12, (start_date.month + months - 2) % 12 + 1
+    end_date = date(end_year, end_month, monthrange(end_year, end_month)[1])
+    
+    projection = project_revenue(start_date, end_date)
+    scheduled = projection['scheduled_days'].sum()
+    expected = projection['expected_days'].sum()
+    
+    print(f"📈 Revenue projection {start_date} → {end_date}")
+    print("=" * 60)
+    print("Pause probability: " + ", ".join(
+        f"{name} {probability * 100:.1f}%" for name, probability in zip(WEEKDAY_NAMES, projection['pause_probabilities'])
+    ))
+    print(f"Customers: {len(projection['customer_ids'])}")
+    print(f"Scheduled days: {scheduled:,.0f}, expected billable: {expected:,.1f}")
+    print(f"Expected revenue: ₹{projection['expected_revenue'].sum():,.0f}")
+    
+    if top and len(projection['customer_ids']):
+        order = projection['expected_revenue'].argsort()[::-1][:top]
+        names = dict(db.session.query(User.id, User.fullname).filter(
+            User.id.in_([int(customer_id) for customer_id in projection['customer_ids'][order]])
+        ).all())
+        print("-" * 60)
+        for index in order:
+            customer_id = int(projection['customer_ids'][index])
+            print(f"{names.get(customer_id, customer_id):<30} {projection['expected_days'][index]:>7.1f} days  ₹{projection['expected_revenue'][index]:>10,.0f}")
+
+@app.cli.command("compact-metrics")
+def compact_metrics_command():
+    """Downsample old metric buckets and apply retention (schedule nightly)"""
+    flush_metrics()
+    summary = compact_metrics()
+    expired = summary.pop("expired")
+    for resolution, (read, written) in summary.items():
+        print(f"📉 {read} {resolution}s buckets rolled up into {written}")
+    print(f"🗑️ {expired} buckets past {METRICS_RETENTION_DAYS} days deleted")
+
+
+@app.cli.command("image-worker")
+@click.option("--once", is_flag=True, help="Exit when no plan images are pending")
+@click.option("--rebuild", is_flag=True, help="Queue every plan image first (e.g. after changing IMAGE_DERIVATIVE_WIDTHS)")
+@click.option("--poll-interval", default=IMAGE_WORKER_POLL_INTERVAL, show_default=True, help="Seconds between polls")
+def image_worker(once, rebuild, poll_interval):
+    """Build WebP/JPEG sizes and placeholders for uploaded plan images"""
+    if rebuild:
+        queued = Plan.query.filter(Plan.image_filename.isnot(None)).update({"image_status": "pending"}, synchronize_session=False)
+        db.session.commit()
+        print(f"🖼️ Queued {queued} plan images")
+    print("🖼️ Image worker started" + (" (single pass)" if once else ""))
+    run_image_worker(poll_interval=poll_interval, once=once)
+    print("🖼️ No plan images pending")
+
+
+@app.cli.command("gc-images")
+@click.option("--dry-run", is_flag=True, help="List what would be deleted without deleting it")
+@click.option("--min-age", default=IMAGE_GC_MIN_AGE, show_default=True, help="Only delete files older than this many seconds")
+@click.option("--rehash", is_flag=True, help="First move images saved under upload names to content-addressed names")
+def gc_images(dry_run, min_age, rehash):
+    """Delete plan image files (originals and derivatives) that no plan references"""
+    if rehash and not dry_run:
+        renamed = rehash_plan_images()
+        print(f"🔁 Moved {len(renamed)} plan images to content-addressed names ({len(set(renamed.values()))} distinct)")
+        if renamed:
+            print("ℹ️ Run `flask image-worker --once` to rebuild their sizes")
+    
+    removed = collect_image_garbage(min_age=min_age, dry_run=dry_run)
+    for path, size in removed:
+        print(f"  {'would delete' if dry_run else 'deleted'} {path} ({size / 1024:.0f} KB)")
+    total = sum(size for _, size in removed)
+    print(f"🧹 {'Would free' if dry_run else 'Freed'} {total / 1024 / 1024:.1f} MB in {len(removed)} files")
+
+
+@app.cli.command("build-assets")
+@click.option("--clean", is_flag=True, help="Remove files from earlier builds")
+def build_assets(clean):
+    """Fingerprint and precompress static files into static/dist/ (run on every deploy)"""
+    global _asset_manifest
+    manifest, compressed = build_static_assets(clean=clean)
+    _asset_manifest = load_asset_manifest()
+    print(f"📦 Fingerprinted {len(manifest)} static files, {compressed} compressed variants")
+
+
+@app.cli.command("snapshot-reports")
+@click.option("--report", "reports", multiple=True, type=click.Choice(list(SNAPSHOT_REPORTS)), help="Only these reports (repeatable)")
+def snapshot_reports(reports):
+    """Pre-render today's analytics, bill and kitchen reports (schedule off-peak, e.g. 05:30 daily)"""
+    written = write_report_snapshots(reports or None)
+    removed = prune_report_snapshots()
+    print(f"🗂️ Wrote {len(written)} report snapshots to {REPORT_SNAPSHOT_DIR}, pruned {removed} old days")
+    if not any(path.endswith(".pdf") for path in written):
+        print("ℹ️ Install weasyprint to also write PDF snapshots")
+
+@app.cli.command("email-worker")
+@click.option("--once", is_flag=True, help="Deliver everything that is due, then exit")
+@click.option("--poll-interval", default=EMAIL_WORKER_POLL_INTERVAL, show_default=True, help="Seconds between outbox polls")
+def email_worker(once, poll_interval):
+    """Deliver queued emails from the outbox (use with EMAIL_WORKER_MODE=external)"""
+    print("📬 Email outbox worker started")
+    run_email_worker(poll_interval=poll_interval, once=once)
+    print("📭 Email outbox drained")
+
+# Compile templates at import so each worker's first requests don't pay for it
+if PRECOMPILE_TEMPLATES:
+    _precompile_started = time_module.perf_counter()
+    print(f"🧩 Precompiled {precompile_templates()} templates in {(time_module.perf_counter() - _precompile_started) * 1000:.0f} ms")
+
 # ------------------------
 # Application Entry Point
 # ------------------------
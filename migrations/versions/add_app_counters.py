@@ -0,0 +1,30 @@
+"""Add app counters
+
+Revision ID: add_app_counters
+Revises: add_plan_image_variants
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_app_counters'
+down_revision = 'add_plan_image_variants'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('app_counters',
+    sa.Column('name', sa.String(length=50), nullable=False),
+    sa.Column('value', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+    # Cohort cells written before this marker existed are rebuilt by the next `flask refresh-cohorts`
+
+
+def downgrade():
+    op.drop_table('app_counters')
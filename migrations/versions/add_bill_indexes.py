@@ -0,0 +1,31 @@
+"""Add indexes for bill management queries
+
+Revision ID: add_bill_indexes
+Revises: update_description_text
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_bill_indexes'
+down_revision = 'update_description_text'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Support the aggregate stats, the monthly revenue GROUP BY and the paginated bill list
+    op.create_index('ix_bills_customer_id', 'bills', ['customer_id'])
+    op.create_index('ix_bills_is_paid', 'bills', ['is_paid'])
+    op.create_index('ix_bills_created_at', 'bills', ['created_at'])
+    op.create_index('ix_bills_year_month', 'bills', ['year', 'month'])
+
+
+def downgrade():
+    op.drop_index('ix_bills_year_month', table_name='bills')
+    op.drop_index('ix_bills_created_at', table_name='bills')
+    op.drop_index('ix_bills_is_paid', table_name='bills')
+    op.drop_index('ix_bills_customer_id', table_name='bills')
@@ -0,0 +1,36 @@
+"""Add cohort retention table
+
+Revision ID: add_cohort_retention
+Revises: add_daily_facts
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_cohort_retention'
+down_revision = 'add_daily_facts'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('cohort_retention',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('basis', sa.String(length=20), nullable=False),
+    sa.Column('cohort_year', sa.Integer(), nullable=False),
+    sa.Column('cohort_month', sa.Integer(), nullable=False),
+    sa.Column('months_since', sa.Integer(), nullable=False),
+    sa.Column('cohort_size', sa.Integer(), nullable=False),
+    sa.Column('active_customers', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('basis', 'cohort_year', 'cohort_month', 'months_since', name='uq_cohort_retention_cell')
+    )
+    # Filled on first analytics load, or with `flask refresh-cohorts --full`
+
+
+def downgrade():
+    op.drop_table('cohort_retention')
@@ -0,0 +1,27 @@
+"""Add customer data versions
+
+Revision ID: add_customer_data_versions
+Revises: add_app_counters
+Create Date: 2026-10-19 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_customer_data_versions'
+down_revision = 'add_app_counters'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Customer page ETags are built from these, so every worker agrees on them
+    op.add_column('users', sa.Column('data_version', sa.Integer(), nullable=False, server_default='0'))
+    op.execute("INSERT INTO app_counters (name, value) VALUES ('customer_data_version', 0)")
+
+
+def downgrade():
+    op.execute("DELETE FROM app_counters WHERE name = 'customer_data_version'")
+    op.drop_column('users', 'data_version')
@@ -0,0 +1,37 @@
+"""Add daily facts table
+
+Revision ID: add_daily_facts
+Revises: add_monthly_rollups
+Create Date: 2026-10-19 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_daily_facts'
+down_revision = 'add_monthly_rollups'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('daily_facts',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('fact_date', sa.Date(), nullable=False),
+    sa.Column('scheduled_meals', sa.Integer(), nullable=False),
+    sa.Column('paused_meals', sa.Integer(), nullable=False),
+    sa.Column('late_paused_meals', sa.Integer(), nullable=False),
+    sa.Column('delivered_meals', sa.Integer(), nullable=False),
+    sa.Column('revenue_accrued', sa.BigInteger(), nullable=False),
+    sa.Column('active_customers', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('fact_date')
+    )
+    # History is backfilled with `flask build-daily-facts --start YYYY-MM-DD`
+
+
+def downgrade():
+    op.drop_table('daily_facts')
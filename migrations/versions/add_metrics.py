@@ -0,0 +1,38 @@
+"""Add metrics store table
+
+Revision ID: add_metrics
+Revises: add_rollup_versions
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_metrics'
+down_revision = 'add_rollup_versions'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('metrics',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('tags', sa.String(length=255), nullable=False),
+    sa.Column('resolution', sa.Integer(), nullable=False),
+    sa.Column('bucket_start', sa.DateTime(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('total', sa.Float(), nullable=False),
+    sa.Column('min_value', sa.Float(), nullable=False),
+    sa.Column('max_value', sa.Float(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_metrics_name_bucket', 'metrics', ['name', 'bucket_start'])
+
+
+def downgrade():
+    op.drop_index('ix_metrics_name_bucket', table_name='metrics')
+    op.drop_table('metrics')
@@ -0,0 +1,103 @@
+"""Add monthly analytics rollups
+
+Revision ID: add_monthly_rollups
+Revises: add_email_outbox
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from calendar import monthrange
+from collections import defaultdict
+from datetime import date, timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_monthly_rollups'
+down_revision = 'add_email_outbox'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('monthly_rollups',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('year', sa.Integer(), nullable=False),
+    sa.Column('month', sa.Integer(), nullable=False),
+    sa.Column('area', sa.String(length=100), nullable=False),
+    sa.Column('plan_id', sa.Integer(), nullable=False),
+    sa.Column('revenue', sa.BigInteger(), nullable=False),
+    sa.Column('payments', sa.Integer(), nullable=False),
+    sa.Column('bills_issued', sa.Integer(), nullable=False),
+    sa.Column('new_customers', sa.Integer(), nullable=False),
+    sa.Column('active_plans', sa.Integer(), nullable=False),
+    sa.Column('plan_days', sa.Integer(), nullable=False),
+    sa.Column('pause_days', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), server_default=sa.text('(CURRENT_TIMESTAMP)'), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('year', 'month', 'area', 'plan_id', name='uq_monthly_rollups_key')
+    )
+    backfill_rollups()
+
+
+def backfill_rollups():
+    """Load existing data so the dashboard is correct straight after the upgrade"""
+    connection = op.get_bind()
+    metrics = ('revenue', 'payments', 'bills_issued', 'new_customers', 'active_plans', 'plan_days', 'pause_days')
+    totals = defaultdict(lambda: dict.fromkeys(metrics, 0))
+    
+    bills = connection.execute(sa.text(
+        "SELECT b.year, b.month, u.area, b.is_paid, b.amount FROM bills b JOIN users u ON u.id = b.customer_id"
+    ))
+    for year, month, area, is_paid, amount in bills:
+        row = totals[(year, month, area or '', 0)]
+        row['bills_issued'] += 1
+        if is_paid:
+            row['payments'] += 1
+            row['revenue'] += amount or 0
+    
+    customers = connection.execute(sa.text(
+        "SELECT created_at, area FROM users WHERE is_admin = :is_admin AND created_at IS NOT NULL"
+    ), {'is_admin': False})
+    for created_at, area in customers:
+        created_at = as_date(created_at)
+        totals[(created_at.year, created_at.month, area or '', 0)]['new_customers'] += 1
+    
+    pauses = connection.execute(sa.text(
+        "SELECT p.pause_date, u.area FROM paused_dates p JOIN users u ON u.id = p.customer_id"
+    ))
+    for pause_date, area in pauses:
+        pause_date = as_date(pause_date)
+        totals[(pause_date.year, pause_date.month, area or '', 0)]['pause_days'] += 1
+    
+    plans = connection.execute(sa.text(
+        "SELECT cp.start_date, cp.end_date, cp.plan_id, u.area FROM customer_plans cp JOIN users u ON u.id = cp.customer_id"
+    ))
+    for start_date, end_date, plan_id, area in plans:
+        start_date, end_date = as_date(start_date), as_date(end_date)
+        current = date(start_date.year, start_date.month, 1)
+        while current <= end_date:
+            month_end = date(current.year, current.month, monthrange(current.year, current.month)[1])
+            row = totals[(current.year, current.month, area or '', plan_id)]
+            row['active_plans'] += 1
+            row['plan_days'] += (min(end_date, month_end) - max(start_date, current)).days + 1
+            current = month_end + timedelta(days=1)
+    
+    if totals:
+        rollups = sa.table('monthly_rollups', *(sa.column(name) for name in ('year', 'month', 'area', 'plan_id') + metrics))
+        op.bulk_insert(rollups, [
+            dict(year=year, month=month, area=area, plan_id=plan_id, **values)
+            for (year, month, area, plan_id), values in totals.items()
+        ])
+
+
+def as_date(value):
+    """SQLite hands dates back as strings"""
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value.date() if hasattr(value, 'date') else value
+
+
+def downgrade():
+    op.drop_table('monthly_rollups')
@@ -0,0 +1,29 @@
+"""Add plan image derivative columns
+
+Revision ID: add_plan_image_variants
+Revises: add_metrics
+Create Date: 2026-10-19 17:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_plan_image_variants'
+down_revision = 'add_metrics'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('plans', sa.Column('image_status', sa.String(length=20), nullable=True))
+    op.add_column('plans', sa.Column('image_variants', sa.Text(), nullable=True))
+
+    # Existing uploads are picked up by the image worker
+    op.execute("UPDATE plans SET image_status = 'pending' WHERE image_filename IS NOT NULL")
+
+
+def downgrade():
+    op.drop_column('plans', 'image_variants')
+    op.drop_column('plans', 'image_status')
@@ -0,0 +1,25 @@
+"""Add version counter to monthly rollups
+
+Revision ID: add_rollup_versions
+Revises: add_cohort_retention
+Create Date: 2026-10-19 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'add_rollup_versions'
+down_revision = 'add_cohort_retention'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Analytics API ETags are derived from the sum of these counters
+    op.add_column('monthly_rollups', sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+
+
+def downgrade():
+    op.drop_column('monthly_rollups', 'version')
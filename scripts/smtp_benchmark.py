@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+SMTP Throughput Benchmark for TiffinTrack
+Runs a local SMTP stub and compares one-connection-per-message sending
+against the pooled, concurrent sender used for bill reminders
+"""
+
+import os
+import sys
+import argparse
+import smtplib
+import socketserver
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class SMTPStubHandler(socketserver.StreamRequestHandler):
+    """Minimal SMTP server session that accepts and discards every message"""
+
+    def reply(self, line):
+        time.sleep(self.server.latency)  # Simulated network round trip
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply("220 tiffintrack-stub ESMTP ready")
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors="replace").strip().upper()
+
+            if command.startswith("EHLO"):
+                self.wfile.write(b"250-tiffintrack-stub\r\n250-AUTH PLAIN LOGIN\r\n")
+                self.reply("250 8BITMIME")
+            elif command.startswith("HELO"):
+                self.reply("250 tiffintrack-stub")
+            elif command.startswith("AUTH"):
+                self.reply("235 2.7.0 Authentication successful")
+            elif command.startswith(("MAIL", "RCPT", "RSET", "NOOP")):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                self.server.messages += 1
+                self.reply("250 OK: queued")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class SMTPStubServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0):
+        super().__init__(address, SMTPStubHandler)
+        self.latency = latency
+        self.connections = 0
+        self.messages = 0
+
+
+def start_stub(port=0, latency=0.0):
+    """Start the SMTP stub in a background thread and return the server"""
+    server = SMTPStubServer(("127.0.0.1", port), latency=latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def sample_emails(count):
+    html_body = "<p>Dear Customer,</p><p>Your TiffinTrack bill is due.</p>" * 20
+    text_body = "Dear Customer,\nYour TiffinTrack bill is due.\n" * 20
+    return [
+        (f"customer{i}@example.com", f"Payment Reminder #{i}", html_body, text_body)
+        for i in range(count)
+    ]
+
+
+def run_benchmark(count, latency, workers, rate_limit):
+    from app import SMTPConnectionPool, build_email_message, send_emails_bulk, MAIL_DEFAULT_SENDER
+
+    emails = sample_emails(count)
+
+    # Baseline: a fresh connection and login for every message, sent serially
+    stub = start_stub(latency=latency)
+    host, port = stub.server_address
+    started = time.perf_counter()
+    for to_email, subject, html_body, text_body in emails:
+        with smtplib.SMTP(host, port, timeout=10) as server:
+            server.login("stub", "stub")
+            server.sendmail(MAIL_DEFAULT_SENDER, [to_email], build_email_message(to_email, subject, html_body, text_body))
+    serial_time = time.perf_counter() - started
+    serial_connections = stub.connections
+    stub.shutdown()
+    stub.server_close()
+
+    # Pooled: reused authenticated sessions with bounded concurrency
+    stub = start_stub(latency=latency)
+    host, port = stub.server_address
+    pool = SMTPConnectionPool(host, port, username="stub", password="stub",
+                              security="plain", size=workers, timeout=10)
+    started = time.perf_counter()
+    results = send_emails_bulk(emails, pool=pool, rate_limit=rate_limit)
+    pooled_time = time.perf_counter() - started
+    pool.close_all()
+    pooled_connections = stub.connections
+    stub.shutdown()
+    stub.server_close()
+
+    failed = sum(1 for success, _ in results if not success)
+
+    print("📨 SMTP Throughput Benchmark")
+    print("=" * 60)
+    print(f"Messages: {count}, simulated latency: {latency * 1000:.0f} ms, workers: {workers}")
+    print("-" * 60)
+    print(f"Per-message connection: {serial_time:.2f}s ({count / serial_time:.1f} msg/s, {serial_connections} connections)")
+    print(f"Pooled + concurrent:    {pooled_time:.2f}s ({count / pooled_time:.1f} msg/s, {pooled_connections} connections)")
+    print(f"Speedup: {serial_time / pooled_time:.1f}x")
+    if failed:
+        print(f"⚠️ {failed} pooled sends failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pooled SMTP delivery against a local stub")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.005, help="Simulated seconds per SMTP reply")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate-limit", type=float, default=0, help="Messages per second (0 = unlimited)")
+    parser.add_argument("--serve", action="store_true", help="Only run the stub server on --port")
+    parser.add_argument("--port", type=int, default=1025)
+    args = parser.parse_args()
+
+    if args.serve:
+        stub = start_stub(port=args.port, latency=args.latency)
+        print(f"📭 SMTP stub listening on 127.0.0.1:{args.port} (Ctrl+C to stop)")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print(f"\n👋 Stub stopped after {stub.messages} messages on {stub.connections} connections")
+    else:
+        run_benchmark(args.messages, args.latency, args.workers, args.rate_limit)
@@ -0,0 +1,490 @@
+import os
+import sys
+import tempfile
+
+# Point the app at a throwaway SQLite database and keep background threads off
+# before it is imported
+TEST_DIR = tempfile.mkdtemp(prefix="tiffintrack-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TEST_DIR, 'test.db')}"
+os.environ["EMAIL_WORKER_MODE"] = "external"
+os.environ["IMAGE_WORKER_MODE"] = "external"
+os.environ["METRICS_ENABLED"] = "0"
+os.environ["PRECOMPILE_TEMPLATES"] = "false"
+os.environ["TEMPLATE_CACHE_DIR"] = os.path.join(TEST_DIR, "jinja_cache")
+os.environ["REPORT_SNAPSHOT_DIR"] = os.path.join(TEST_DIR, "reports")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import io
+from datetime import date, datetime, timedelta
+
+import pytest
+from PIL import Image
+
+import app as tiffintrack
+from app import app, db, User, Plan, Bill, CustomerPlan, PausedDate, EmailOutbox
+
+
+@pytest.fixture(autouse=True)
+def database():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        tiffintrack.seed_initial_data()
+        yield
+        db.session.remove()
+
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+
+def login_admin(client):
+    client.post("/login", data={"email": "admin@tiffintrack.com", "password": "admin123"})
+
+
+def login_customer(client, customer):
+    with client.session_transaction() as sess:
+        sess["user_id"] = customer.id
+        sess["user_name"] = customer.fullname
+
+
+def first_customer():
+    return User.query.filter_by(is_admin=False).order_by(User.id).first()
+
+
+# -----------------------------
+# EMAIL OUTBOX TESTS
+# -----------------------------
+def test_reminders_queue_once_per_bill_per_day(client, monkeypatch):
+    monkeypatch.setattr(tiffintrack, "is_email_configured", lambda: True)
+    customer = first_customer()
+    db.session.add(Bill(customer_id=customer.id, month=1, year=2026, total_days=31,
+                        paused_days=0, billable_days=31, amount=3720, is_paid=False))
+    db.session.commit()
+    login_admin(client)
+
+    first = client.post("/bills/send-reminders").get_json()
+    second = client.post("/bills/send-reminders").get_json()
+
+    assert first["queued"] == 1
+    assert second["queued"] == 0 and second["skipped"] == 1
+    assert EmailOutbox.query.filter_by(kind="bill_reminder").count() == 1
+
+
+def test_reminders_skip_rows_created_before_local_midnight(client, monkeypatch):
+    monkeypatch.setattr(tiffintrack, "is_email_configured", lambda: True)
+    customer = first_customer()
+    bill = Bill(customer_id=customer.id, month=1, year=2026, total_days=31,
+                paused_days=0, billable_days=31, amount=3720, is_paid=False)
+    db.session.add(bill)
+    db.session.commit()
+    # A UTC server clock can stamp today's reminder with yesterday's date
+    tiffintrack.enqueue_email(customer.email, "Reminder", "<p>Pay</p>", kind="bill_reminder",
+                              customer_id=customer.id, bill_id=bill.id,
+                              dedupe_key=f"bill_reminder:{bill.id}:{date.today().isoformat()}")
+    db.session.flush()
+    EmailOutbox.query.update({"created_at": datetime.now() - timedelta(days=1)})
+    db.session.commit()
+    login_admin(client)
+
+    response = client.post("/bills/send-reminders")
+
+    assert response.status_code == 200
+    assert response.get_json()["skipped"] == 1
+
+
+# -----------------------------
+# MONTHLY ROLLUP TESTS
+# -----------------------------
+def stored_rollups():
+    rows = {}
+    for row in tiffintrack.MonthlyRollup.query.all():
+        metrics = {metric: getattr(row, metric) for metric in tiffintrack.ROLLUP_METRICS}
+        if any(metrics.values()):
+            rows[(row.year, row.month, row.area, row.plan_id)] = metrics
+    return rows
+
+
+def live_rollups():
+    return {key: metrics for key, metrics in tiffintrack.collect_rollup_totals().items() if any(metrics.values())}
+
+
+def test_incremental_rollups_match_a_rebuild(client):
+    tiffintrack.rebuild_monthly_rollups()
+    customer, other = User.query.filter_by(is_admin=False).order_by(User.id).limit(2).all()
+    plan = Plan.query.first()
+    start = date.today() + timedelta(days=1)
+    end = start + timedelta(days=45)
+
+    login_customer(client, customer)
+    client.post("/plans/save", data={f"plan_{plan.id}": "1", f"start_{plan.id}": start.isoformat(),
+                                     f"end_{plan.id}": end.isoformat()})
+    client.post("/pause/save", data={"pause_date": (start + timedelta(days=2)).isoformat()})
+
+    login_admin(client)
+    client.get(f"/bills/generate/{start.month}/{start.year}")
+    bill = Bill.query.filter_by(customer_id=customer.id).first()
+    client.get(f"/bills/mark-paid/{bill.id}")
+    db.session.expire_all()
+
+    assert stored_rollups() == live_rollups()
+
+    # A customer without running plans moves to another area
+    past_pause = date.today() - timedelta(days=40)
+    db.session.add(PausedDate(customer_id=other.id, pause_date=past_pause))
+    tiffintrack.bump_rollup(past_pause.year, past_pause.month, other.area, pause_days=1)
+    db.session.commit()
+    login_customer(client, other)
+    new_area = next(area for area in tiffintrack.NAVI_MUMBAI_AREAS if area != other.area)
+    client.post("/profile", data={"fullname": other.fullname, "email": other.email, "phone": other.phone,
+                                  "addr1": other.addr1, "addr2": other.addr2 or "", "city": other.city,
+                                  "state": other.state, "pincode": other.pincode, "area": new_area})
+    db.session.expire_all()
+
+    assert db.session.get(User, other.id).area == new_area
+    assert stored_rollups() == live_rollups()
+
+
+# -----------------------------
+# REPORT CACHE TESTS
+# -----------------------------
+def test_invalidation_drops_only_matching_in_flight_reports():
+    tiffintrack.invalidate_report_cache()
+    calls = []
+
+    def compute_during_bill_write():
+        calls.append(1)
+        tiffintrack.invalidate_report_cache("bills:")
+        return len(calls)
+
+    assert tiffintrack.cached_report("bills:stats", compute_during_bill_write) == 1
+    assert tiffintrack.cached_report("bills:stats", compute_during_bill_write) == 2
+    assert tiffintrack.cached_report("analytics:2026-01", compute_during_bill_write) == 3
+    assert tiffintrack.cached_report("analytics:2026-01", compute_during_bill_write) == 3
+
+
+def test_report_cache_evicts_expired_and_oldest_entries(monkeypatch):
+    tiffintrack.invalidate_report_cache()
+    monkeypatch.setattr(tiffintrack, "REPORT_CACHE_MAX_ENTRIES", 2)
+    tiffintrack.cached_report("report:expired", lambda: "old", ttl=0, stale_ttl=0)
+    monkeypatch.setattr(tiffintrack, "_report_cache_swept_at", 0.0)
+    tiffintrack.cached_report("report:a", lambda: "a")
+
+    assert "report:expired" not in tiffintrack._report_cache
+
+    tiffintrack.cached_report("report:b", lambda: "b")
+    tiffintrack.cached_report("report:c", lambda: "c")
+
+    assert list(tiffintrack._report_cache) == ["report:b", "report:c"]
+
+
+# -----------------------------
+# DAILY FACT TESTS
+# -----------------------------
+def test_analytics_reads_daily_facts_without_writing_them(client):
+    customer = first_customer()
+    plan = Plan.query.first()
+    today = date.today()
+    db.session.add(CustomerPlan(customer_id=customer.id, plan_id=plan.id, start_date=today - timedelta(days=10),
+                                end_date=today + timedelta(days=10), is_active=True))
+    advance = today - timedelta(days=5)
+    late = today - timedelta(days=3)
+    db.session.add(PausedDate(customer_id=customer.id, pause_date=advance,
+                              created_at=datetime.combine(advance - timedelta(days=1), datetime.min.time())))
+    db.session.add(PausedDate(customer_id=customer.id, pause_date=late,
+                              created_at=datetime.combine(late, datetime.min.time()) + timedelta(hours=9)))
+    db.session.commit()
+    tiffintrack.invalidate_report_cache()
+    login_admin(client)
+
+    assert client.get("/analytics").status_code == 200
+    assert tiffintrack.DailyFact.query.count() == 0
+
+    report = tiffintrack.compute_analytics_report(today - timedelta(days=30), today)
+    # Ten scheduled days up to yesterday, one of them paused after the cutoff
+    assert report["food_waste"] == 10.0
+
+
+# -----------------------------
+# COHORT RETENTION TESTS
+# -----------------------------
+def stored_cohort_cells(basis):
+    return {
+        (row.cohort_year * 12 + row.cohort_month - 1, row.months_since): (row.cohort_size, row.active_customers)
+        for row in tiffintrack.CohortRetention.query.filter_by(basis=basis)
+    }
+
+
+def test_cohorts_follow_changes_to_past_months(client):
+    customers = User.query.filter_by(is_admin=False).order_by(User.id).limit(2).all()
+    plan = Plan.query.first()
+    today = date.today()
+    for customer in customers:
+        running = CustomerPlan(customer_id=customer.id, plan_id=plan.id, start_date=today - timedelta(days=70),
+                               end_date=today + timedelta(days=20), is_active=True)
+        db.session.add(running)
+        tiffintrack.rollup_customer_plan(running, customer.area)
+    db.session.commit()
+    tiffintrack.refresh_cohort_retention()
+    before = tiffintrack.CohortRetention.query.count()
+
+    # Replacing a running plan rewrites the months it already covered
+    login_customer(client, customers[0])
+    start = today + timedelta(days=1)
+    client.post("/plans/save", data={f"plan_{plan.id}": "1", f"start_{plan.id}": start.isoformat(),
+                                     f"end_{plan.id}": (start + timedelta(days=30)).isoformat()})
+    tiffintrack.invalidate_report_cache()
+    login_admin(client)
+    client.get("/analytics")
+
+    assert tiffintrack.CohortRetention.query.count() == before
+    for basis in tiffintrack.COHORT_BASES:
+        assert tiffintrack.cohort_retention_cells(basis) == tiffintrack.compute_cohort_retention(basis)
+
+    tiffintrack.refresh_cohort_retention()
+
+    for basis in tiffintrack.COHORT_BASES:
+        assert stored_cohort_cells(basis) == tiffintrack.compute_cohort_retention(basis)
+
+
+# -----------------------------
+# CONDITIONAL PAGE TESTS
+# -----------------------------
+def test_customer_page_revalidates_until_a_write(client):
+    customer = first_customer()
+    login_customer(client, customer)
+    first = client.get("/pause")
+    etag = first.headers["ETag"]
+
+    assert client.get("/pause", headers={"If-None-Match": etag}).status_code == 304
+
+    client.post("/pause/save", data={"pause_date": (date.today() + timedelta(days=3)).isoformat()})
+    client.get("/pause")  # Consume the flashed message
+    changed = client.get("/pause", headers={"If-None-Match": etag})
+
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+
+
+def test_page_versions_come_from_the_database(client):
+    customer = first_customer()
+    login_customer(client, customer)
+    etag = client.get("/plans").headers["ETag"]
+
+    # A write committed by another worker process only touches the database
+    db.session.execute(db.text("UPDATE app_counters SET value = value + 1 WHERE name = 'customer_data_version'"))
+    db.session.execute(db.text("INSERT INTO app_counters (name, value) SELECT 'customer_data_version', 1 "
+                               "WHERE NOT EXISTS (SELECT 1 FROM app_counters WHERE name = 'customer_data_version')"))
+    db.session.commit()
+
+    assert client.get("/plans", headers={"If-None-Match": etag}).status_code == 200
+
+
+def test_admin_plan_change_revalidates_customer_pages(client):
+    customer = first_customer()
+    login_customer(client, customer)
+    etag = client.get("/plans").headers["ETag"]
+    plan = Plan.query.first()
+
+    login_admin(client)
+    client.post(f"/admin/plans/toggle/{plan.id}")
+    login_customer(client, customer)
+    client.get("/admin/plans")  # Drop the admin's flashed message
+
+    assert client.get("/plans", headers={"If-None-Match": etag}).status_code == 200
+
+
+# -----------------------------
+# CUSTOMER SUMMARY TESTS
+# -----------------------------
+def test_summary_follows_writes_from_other_workers():
+    tiffintrack.invalidate_report_cache()
+    customer = first_customer()
+    assert tiffintrack.customer_summary(customer.id)["paused_this_month"] == 0
+
+    # Another worker pauses today's meal: it writes the pause and bumps the version, nothing else
+    db.session.add(PausedDate(customer_id=customer.id, pause_date=date.today()))
+    tiffintrack.bump_customer_data_version(customer.id)
+    db.session.commit()
+
+    assert tiffintrack.customer_summary(customer.id)["paused_this_month"] == 1
+
+
+# -----------------------------
+# BILL ESTIMATE TESTS
+# -----------------------------
+def test_estimate_answers_304_without_computing(client, monkeypatch):
+    customer = first_customer()
+    login_customer(client, customer)
+    etag = client.get("/api/bills/estimate?months=2").headers["ETag"]
+
+    tiffintrack.invalidate_report_cache()
+    def fail(*args):
+        raise AssertionError("estimate computed for an unchanged version")
+    monkeypatch.setattr(tiffintrack, "compute_bill_estimates", fail)
+
+    assert client.get("/api/bills/estimate?months=2", headers={"If-None-Match": etag}).status_code == 304
+
+
+def test_estimate_etag_changes_after_a_write(client):
+    customer = first_customer()
+    plan = Plan.query.first()
+    start = date.today() + timedelta(days=1)
+    url = f"/api/bills/estimate?month={start.month}&year={start.year}"
+    login_customer(client, customer)
+    etag = client.get(url).headers["ETag"]
+
+    client.post("/plans/save", data={f"plan_{plan.id}": "1", f"start_{plan.id}": start.isoformat(),
+                                     f"end_{plan.id}": (start + timedelta(days=10)).isoformat()})
+    response = client.get(url, headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.get_json()["estimates"][0]["items"]
+
+
+# -----------------------------
+# PLAN IMAGE TESTS
+# -----------------------------
+def test_first_request_starts_worker_for_queued_images(client, monkeypatch):
+    started = []
+    monkeypatch.setattr(tiffintrack, "IMAGE_WORKER_MODE", "inline")
+    monkeypatch.setattr(tiffintrack, "_image_backlog_checked", False)
+    monkeypatch.setattr(tiffintrack, "notify_image_worker", lambda: started.append(True))
+    Plan.query.update({"image_filename": "plan.jpg", "image_status": "pending"})
+    db.session.commit()
+
+    client.get("/login")
+    client.get("/login")
+
+    assert started == [True]
+
+
+def png_bytes(size=64):
+    image = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buffer = io.BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def upload_folder(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, "UPLOAD_FOLDER", str(tmp_path))
+    return tmp_path
+
+
+def stored_image(folder):
+    temporary = folder / ".upload-test.tmp"
+    temporary.write_bytes(png_bytes())
+    return tiffintrack.store_image_file(str(temporary))
+
+
+def test_image_is_deleted_with_the_last_plan_using_it(client, upload_folder):
+    image_filename = stored_image(upload_folder)
+    first, second = Plan.query.order_by(Plan.id).limit(2).all()
+    first.image_filename = second.image_filename = image_filename
+    db.session.commit()
+    an_hour_ago = datetime.now().timestamp() - 3600
+    os.utime(upload_folder / image_filename, (an_hour_ago, an_hour_ago))
+    login_admin(client)
+
+    client.post(f"/admin/plans/delete/{first.id}")
+    assert (upload_folder / image_filename).exists()
+
+    client.post(f"/admin/plans/delete/{second.id}")
+    assert not (upload_folder / image_filename).exists()
+
+
+def test_image_over_the_pixel_limit_is_refused(upload_folder, monkeypatch):
+    monkeypatch.setattr(tiffintrack, "IMAGE_MAX_PIXELS", 64 * 64 - 1)
+
+    with pytest.raises(ValueError, match="too large"):
+        stored_image(upload_folder)
+    assert list(upload_folder.iterdir()) == []
+
+
+def test_reuploaded_image_survives_its_last_plan_release(client, upload_folder):
+    data = png_bytes()
+    (upload_folder / ".upload-test.tmp").write_bytes(data)
+    image_filename = tiffintrack.store_image_file(str(upload_folder / ".upload-test.tmp"))
+    plan = Plan.query.first()
+    plan.image_filename = image_filename
+    db.session.commit()
+    an_hour_ago = datetime.now().timestamp() - 3600
+    os.utime(upload_folder / image_filename, (an_hour_ago, an_hour_ago))
+
+    # Another admin uploads the same picture for a plan that hasn't been saved yet
+    (upload_folder / ".upload-test.tmp").write_bytes(data)
+    assert tiffintrack.store_image_file(str(upload_folder / ".upload-test.tmp")) == image_filename
+    login_admin(client)
+    client.post(f"/admin/plans/delete/{plan.id}")
+
+    assert (upload_folder / image_filename).exists()
+    assert not (upload_folder / ".upload-test.tmp").exists()
+
+
+def test_image_gc_keeps_referenced_and_recent_files(upload_folder):
+    live = stored_image(upload_folder)
+    Plan.query.first().image_filename = live
+    db.session.commit()
+    orphan = upload_folder / ("a" * 64 + ".png")
+    orphan.write_bytes(b"old")
+    recent = upload_folder / ("b" * 64 + ".png")
+    recent.write_bytes(b"new")
+    an_hour_ago = datetime.now().timestamp() - 3600
+    for path in (upload_folder / live, orphan):
+        os.utime(path, (an_hour_ago, an_hour_ago))
+
+    assert [path for path, _ in tiffintrack.collect_image_garbage(min_age=60, dry_run=True)] == [orphan.name]
+    assert orphan.exists()
+
+    tiffintrack.collect_image_garbage(min_age=60)
+
+    assert not orphan.exists()
+    assert (upload_folder / live).exists() and recent.exists()
+
+
+# -----------------------------
+# CHUNKED UPLOAD TESTS
+# -----------------------------
+def test_chunked_upload_resumes_from_the_server_offset(client, upload_folder, monkeypatch):
+    monkeypatch.setattr(tiffintrack, "IMAGE_UPLOAD_CHUNK_SIZE", 256)
+    data = png_bytes()
+    login_admin(client)
+    started = client.post("/admin/uploads", json={"filename": "dish.png", "size": len(data)})
+    upload_id = started.get_json()["upload_id"]
+    url = f"/admin/uploads/{upload_id}"
+
+    assert started.status_code == 201
+    assert client.put(url, data=data[:256], headers={"Upload-Offset": "0"}).status_code == 200
+
+    # A retried or skipped chunk is refused with the offset to resume from
+    mismatch = client.put(url, data=data[256:512], headers={"Upload-Offset": "512"})
+    assert mismatch.status_code == 409
+    assert mismatch.get_json()["received"] == 256
+
+    offset = 256
+    while offset < len(data):
+        chunk = data[offset:offset + 256]
+        assert client.put(url, data=chunk, headers={"Upload-Offset": str(offset)}).status_code == 200
+        offset += len(chunk)
+
+    assert client.get(url).get_json()["received"] == len(data)
+    image_filename = tiffintrack.finish_chunked_upload(upload_id)
+    assert (upload_folder / image_filename).read_bytes() == data
+
+
+def test_chunk_past_the_declared_size_is_rejected(client, upload_folder):
+    login_admin(client)
+    upload_id = client.post("/admin/uploads", json={"filename": "dish.png", "size": 10}).get_json()["upload_id"]
+    url = f"/admin/uploads/{upload_id}"
+
+    assert client.put(url, data=b"x" * 11, headers={"Upload-Offset": "0"}).status_code == 413
+    assert client.get(url).get_json()["received"] == 0
+
+
+def test_chunked_uploads_are_admin_only(client, upload_folder):
+    login_customer(client, first_customer())
+
+    assert client.post("/admin/uploads", json={"filename": "dish.png", "size": 10}).status_code == 401